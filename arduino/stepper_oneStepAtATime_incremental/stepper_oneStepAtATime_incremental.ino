@@ -30,6 +30,9 @@ Stepper myStepper(stepsPerRevolution, 8, 9, 10, 11);
 int stepCount = 0;         // number of steps the motor has taken
 char last_state = 1;
 
+// 'v' reports this; firmware without it answers 'v' like any other character, with the step count
+const int firmwareVersion = 2;
+
 void setup() {
   // initialize the serial port:
   Serial.begin(9600);
@@ -62,6 +65,33 @@ void loop() {
     if (newInputChar == 'r') {
       stepCount = 0;
     }
+    else if (newInputChar == 'v') {
+      Serial.print("version: ");
+      Serial.println(firmwareVersion);
+      continue;
+    }
+    else if (newInputChar == 'm' || newInputChar == 'e') {
+      // m<count>\n takes count steps (back for a negative count) in one go; e<count>\n does the same but stops as
+      // soon as the index switch changes. Either way there is one reply, after the last step.
+      long count = Serial.parseInt();
+      if (Serial.peek() == '\n') {
+        Serial.read();
+      }
+      int direction = (count < 0) ? -1 : 1;
+      int startState = digitalRead(5);
+      digitalWrite(12,HIGH);
+      digitalWrite(13,HIGH);
+      for (long k = 0; k < abs(count); k++) {
+        myStepper.step(2*direction);
+        stepCount += direction;
+        if (newInputChar == 'e' && digitalRead(5) != startState) {
+          break;
+        }
+      }
+      delay(300);
+      digitalWrite(12,LOW);
+      digitalWrite(13,LOW);
+    }
     else {
       if (newInputChar == 'a') {
         digitalWrite(12,HIGH);
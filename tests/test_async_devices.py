@@ -0,0 +1,128 @@
+import threading
+import time
+import unittest
+
+from xystage import async_devices, emulator, stage, stepper
+
+
+class Counter(object):
+    # A blocking device that remembers the order of its calls
+    def __init__(self):
+        self.calls = []
+        self.label = 'counter'
+
+    def add(self, value, delay=0):
+        time.sleep(delay)
+        self.calls.append(value)
+        return value
+
+    def fail(self):
+        raise IOError("device gone")
+
+
+class DeviceWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.worker = async_devices.DeviceWorker('test')
+
+    def tearDown(self):
+        self.worker.close()
+
+    def test_order(self):
+        counter = Counter()
+        operations = [self.worker.submit(counter.add, k, delay=0.01 * (k % 2)) for k in range(10)]
+        self.assertEqual(async_devices.gather(*operations), range(10))
+        self.assertEqual(counter.calls, range(10))
+
+    def test_exception(self):
+        counter = Counter()
+        failed = self.worker.submit(counter.fail)
+        after = self.worker.submit(counter.add, 1)
+        self.assertRaises(IOError, failed.wait)
+        # The worker goes on with the next call
+        self.assertEqual(after.wait(), 1)
+        self.assertRaises(IOError, async_devices.gather, after, failed)
+
+    def test_wait_timeout(self):
+        release = threading.Event()
+        operation = self.worker.submit(release.wait)
+        self.assertRaises(RuntimeError, operation.wait, 0.01)
+        release.set()
+        self.assertTrue(operation.wait(1))
+
+    def test_callback(self):
+        done = []
+        called = threading.Event()
+        operation = self.worker.submit(Counter().add, 3, delay=0.01)
+        operation.add_done_callback(lambda operation: (done.append(operation.wait()), called.set()))
+        self.assertTrue(called.wait(1))
+        # Once finished, a callback is called right away
+        operation.add_done_callback(lambda operation: done.append(operation.wait()))
+        self.assertEqual(done, [3, 3])
+
+
+class BoundedWorkerTest(unittest.TestCase):
+    def test_maxsize(self):
+        worker = async_devices.DeviceWorker('bounded', maxsize=2)
+        release = threading.Event()
+        worker.submit(release.wait)
+        time.sleep(0.05)
+        # The first call is running; two more fit in the queue and the next submit blocks until one is taken
+        counter = Counter()
+        worker.submit(counter.add, 1)
+        worker.submit(counter.add, 2)
+        submitted = threading.Event()
+
+        def submit():
+            worker.submit(counter.add, 3)
+            submitted.set()
+        thread = threading.Thread(target=submit)
+        thread.start()
+        self.assertFalse(submitted.wait(0.1))
+        release.set()
+        self.assertTrue(submitted.wait(1))
+        thread.join()
+        worker.close()
+        self.assertEqual(counter.calls, [1, 2, 3])
+
+    def test_close_drains(self):
+        worker = async_devices.DeviceWorker('draining')
+        counter = Counter()
+        operations = [worker.submit(counter.add, k, delay=0.01) for k in range(5)]
+        worker.close()
+        self.assertTrue(all(operation.done() for operation in operations))
+        self.assertEqual(counter.calls, range(5))
+
+
+class AsyncDeviceTest(unittest.TestCase):
+    def test_forwarding(self):
+        counter = Counter()
+        device = async_devices.AsyncDevice(counter)
+        self.addCleanup(device.close)
+        operation = device.add(5)
+        self.assertTrue(isinstance(operation, async_devices.Operation))
+        self.assertEqual(operation.wait(), 5)
+        self.assertEqual(device.call('add', 6).wait(), 6)
+        # Plain attributes are read directly
+        self.assertEqual(device.label, 'counter')
+        self.assertRaises(IOError, device.fail().wait)
+
+    def test_stage_and_stepper(self):
+        # Both devices move at once, each on its own worker
+        controller = emulator.L6474Controller(speedup=20)
+        self.addCleanup(controller.stop)
+        hwp_controller = emulator.HWPStepperController(speedup=20)
+        self.addCleanup(hwp_controller.stop)
+        s = async_devices.AsyncStage(stage.Stage(controller.port(), cache=True))
+        self.addCleanup(s.close)
+        hwp = async_devices.AsyncSimpleStepper(stepper.SimpleStepper(hwp_controller.port()))
+        self.addCleanup(hwp.close)
+        s.initialize().wait()
+        s.reset_home().wait()
+        hwp.initialize().wait()
+        async_devices.gather(s.go_to_position(100, 200), hwp.move(5))
+        self.assertEqual(s.get_position().wait(), (100, 200))
+        self.assertEqual(hwp.get_state().wait()['steps'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import netCDF4
+import numpy as np
+
+from xystage import beam_analysis
+
+
+def beam(x, y, x0, y0, sigma_major, sigma_minor, angle, amplitude, offset):
+    c, s = np.cos(angle), np.sin(angle)
+    u = (x - x0) * c + (y - y0) * s
+    v = -(x - x0) * s + (y - y0) * c
+    return amplitude * np.exp(-0.5 * (u ** 2 / sigma_major ** 2 + v ** 2 / sigma_minor ** 2)) + offset
+
+
+class FitTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.x = np.arange(200, 4401, 200.)
+        self.y = np.arange(200, 4401, 200.)
+        self.X, self.Y = np.meshgrid(self.x, self.y, indexing='ij')
+
+    def test_fit_gaussians(self):
+        truth = [(2000, 2500, 500, 350, 0.3, 1e-3, 1e-5), (1500, 3000, 600, 600, 0.0, 2e-3, 0),
+                 (3000, 1200, 400, 250, -0.8, 5e-4, -2e-5)]
+        planes = np.array([beam(self.X, self.Y, *p) + 2e-6 * np.random.randn(*self.X.shape) for p in truth])
+        # An unfinished map
+        planes[0, 15:, 12:] = np.nan
+        fits = beam_analysis.fit_gaussians(self.x, self.y, planes)
+        self.assertTrue(fits['converged'].all())
+        for k, (x0, y0, sigma_major, sigma_minor, angle, amplitude, offset) in enumerate(truth):
+            self.assertAlmostEqual(fits['x0'][k], x0, delta=2)
+            self.assertAlmostEqual(fits['y0'][k], y0, delta=2)
+            self.assertAlmostEqual(fits['sigma_major'][k], sigma_major, delta=2)
+            self.assertAlmostEqual(fits['sigma_minor'][k], sigma_minor, delta=2)
+            self.assertAlmostEqual(fits['amplitude'][k] / amplitude, 1, delta=0.01)
+            if sigma_major != sigma_minor:
+                self.assertAlmostEqual(fits['angle'][k], np.degrees(angle), delta=0.5)
+        self.assertEqual(fits['pixels'][0], self.X.size - 7 * 10)
+
+    def test_empty_plane(self):
+        planes = np.array([np.full(self.X.shape, np.nan), beam(self.X, self.Y, 2000, 2000, 500, 500, 0, 1, 0)])
+        fits = beam_analysis.fit_gaussians(self.x, self.y, planes)
+        self.assertEqual(list(fits['converged']), [False, True])
+
+    def test_hwp_modulation(self):
+        angles = 2 * np.pi * np.arange(100) / 100.
+        amplitudes = 2e-3 * (1 + 0.1 * np.cos(2 * (angles - np.radians(30))) + 0.3 * np.cos(4 * (angles -
+                                                                                               np.radians(10))))
+        m0, m2, angle_2, m4, angle_4 = beam_analysis.hwp_modulation(angles, amplitudes)
+        self.assertAlmostEqual(m0, 2e-3)
+        self.assertAlmostEqual(m2, 0.1)
+        self.assertAlmostEqual(angle_2, 30)
+        self.assertAlmostEqual(m4, 0.3)
+        self.assertAlmostEqual(angle_4, 10)
+
+
+class AnalyseTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.output = os.path.join(self.directory, 'summary')
+        x = np.arange(0, 2001, 200.)
+        X, Y = np.meshgrid(x, x, indexing='ij')
+        steps = np.arange(0, 100, 10.)
+        frequencies = np.array([140e9, 150e9, 160e9])
+        amplitude = 1e-3 * (1 + 0.3 * np.cos(4 * (2 * np.pi * steps / 100 - np.radians(10))))
+        nc = netCDF4.Dataset(os.path.join(self.directory, 'hwp.nc'), mode='w')
+        group = nc.createGroup('map_20160101120000')
+        for name, values in [('x', x), ('y', x), ('hwp_step', steps), ('mmw_frequency', frequencies)]:
+            group.createDimension(name, len(values))
+            group.createVariable(name, np.float, dimensions=(name,))[:] = values
+        z = group.createVariable('z', np.float, dimensions=('x', 'y', 'hwp_step', 'mmw_frequency'))
+        z[:] = (beam(X[..., None, None], Y[..., None, None], 1000, 900, 400, 300, 0.2, amplitude[:, None], 0) +
+                1e-6 * np.random.randn(len(x), len(x), len(steps), len(frequencies)))
+        nc.close()
+
+    def test_analyse(self):
+        fits, modulation = beam_analysis.analyse([self.directory], self.output, processes=1, planes_per_task=12)
+        self.assertEqual(len(fits), 10 * 3)
+        self.assertTrue(all(row[-1] for row in fits))
+        self.assertEqual(len(modulation), 3)
+        for row in modulation:
+            self.assertAlmostEqual(row[6], 0.3, delta=0.01)
+            self.assertAlmostEqual(row[7], 10, delta=0.5)
+        for name in ['beam_fits.csv', 'hwp_modulation.csv']:
+            self.assertEqual(len(open(os.path.join(self.output, name)).readlines()), 1 + {'beam_fits.csv': 30,
+                                                                                         'hwp_modulation.csv': 3}[name])
+
+    def test_cache(self):
+        first = beam_analysis.analyse([self.directory], self.output, processes=1)
+        # Unchanged files are not read again
+        plan_tasks = beam_analysis.plan_tasks
+        beam_analysis.plan_tasks = None
+        try:
+            second = beam_analysis.analyse([self.directory], self.output, processes=1)
+        finally:
+            beam_analysis.plan_tasks = plan_tasks
+        self.assertEqual(len(first[0]), len(second[0]))
+        self.assertEqual([row[4] for row in first[0]], [row[4] for row in second[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
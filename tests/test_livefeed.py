@@ -0,0 +1,141 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from xystage import livefeed
+
+
+def make_header(shape=(3, 2, 1)):
+    coordinates = {'x': [0., 100., 200.][:shape[0]], 'y': [0., 100.][:shape[1]], 'frequency': [-1.] * shape[2]}
+    return {'filename': '/tmp/map.nc', 'group': 'map_1', 'description': 'test', 'shape': list(shape),
+            'dimensions': ['x', 'y', 'frequency'], 'coordinates': coordinates}
+
+
+class LiveFeedTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.address = os.path.join(directory, 'live.sock')
+
+    def publisher(self, **kwargs):
+        publisher = livefeed.Publisher(self.address, **kwargs)
+        self.addCleanup(publisher.close)
+        return publisher
+
+    def subscriber(self, publisher, count=1):
+        # Connects, and waits until the publisher has taken the connection
+        subscriber = livefeed.Subscriber(self.address)
+        self.addCleanup(subscriber.close)
+        self.wait_for(lambda: len(publisher._subscribers) == count)
+        return subscriber
+
+    def wait_for(self, condition, timeout=2):
+        end = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < end, "timed out")
+            time.sleep(0.01)
+
+
+class RoundTripTest(LiveFeedTestCase):
+    def test_round_trip(self):
+        publisher = self.publisher()
+        subscriber = self.subscriber(publisher)
+        z = np.ma.masked_all((3, 2, 1))
+        z[0, 0, 0] = 1.5
+        publisher.start_map(make_header(), z)
+        publisher.publish((1, 1, 0), np.float64(2.5), sensitivity=np.int16(20))
+        publisher.end_map()
+        message = subscriber.get(timeout=2)
+        self.assertEqual(message['type'], 'map')
+        self.assertEqual(message['group'], 'map_1')
+        self.assertEqual(message['z'].shape, (3, 2, 1))
+        self.assertEqual(message['z'][0, 0, 0], 1.5)
+        self.assertEqual(np.isnan(message['z']).sum(), 5)
+        message = subscriber.get(timeout=2)
+        self.assertEqual((message['type'], message['index'], message['value']), ('point', [1, 1, 0], 2.5))
+        self.assertEqual((message['position'], message['sensitivity']), ([100., 100.], 20))
+        self.assertEqual(subscriber.get(timeout=2)['type'], 'end')
+        self.assertEqual(subscriber.poll(), [])
+
+    def test_late_subscriber(self):
+        # Connecting during a map gets the readings so far along with the header
+        publisher = self.publisher()
+        publisher.start_map(make_header())
+        publisher.publish((2, 1, 0), 3.0)
+        subscriber = self.subscriber(publisher)
+        message = subscriber.get(timeout=2)
+        self.assertEqual(message['type'], 'map')
+        self.assertEqual(message['z'][2, 1, 0], 3.0)
+        publisher.publish((0, 1, 0), 4.0)
+        self.assertEqual(subscriber.get(timeout=2)['value'], 4.0)
+
+    def test_nothing_before_map(self):
+        publisher = self.publisher()
+        subscriber = self.subscriber(publisher)
+        publisher.publish((0, 0, 0), 1.0)
+        publisher.end_map()
+        self.assertRaises(RuntimeError, subscriber.get, 0.1)
+
+    def test_publisher_closed(self):
+        publisher = livefeed.Publisher(self.address)
+        subscriber = self.subscriber(publisher)
+        publisher.close()
+        self.assertEqual(subscriber.get(timeout=2), None)
+        self.assertEqual(list(subscriber), [])
+        self.assertFalse(subscriber.connected)
+        self.assertFalse(os.path.exists(self.address))
+
+
+class AddressTest(LiveFeedTestCase):
+    def test_stale_socket(self):
+        # A socket file left by a publisher that did not close is removed
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.address)
+        stale.close()
+        self.assertTrue(os.path.exists(self.address))
+        publisher = self.publisher()
+        subscriber = self.subscriber(publisher)
+        publisher.start_map(make_header())
+        self.assertEqual(subscriber.get(timeout=2)['type'], 'map')
+
+    def test_in_use(self):
+        self.publisher()
+        self.assertRaises(ValueError, livefeed.Publisher, self.address)
+        # The running publisher keeps its socket
+        self.assertTrue(os.path.exists(self.address))
+
+
+class SlowSubscriberTest(LiveFeedTestCase):
+    def test_dropped(self):
+        # A viewer that stops reading fills its socket buffer, then its queue, and is dropped; the others carry on
+        publisher = self.publisher(max_queue=10)
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(stuck.close)
+        stuck.connect(self.address)
+        self.wait_for(lambda: len(publisher._subscribers) == 1)
+        subscriber = self.subscriber(publisher, count=2)
+        publisher.start_map(make_header())
+        padding = 'x' * 10000
+        published = 0
+        while len(publisher._subscribers) > 1:
+            self.assertTrue(published < 10000, "the stuck subscriber was never dropped")
+            for k in range(5):
+                publisher.publish((0, 0, 0), published, padding=padding)
+                published += 1
+            # Gives the subscriber that is reading time to keep up
+            time.sleep(0.005)
+        publisher.end_map()
+        messages = [subscriber.get(timeout=2)]
+        while messages[-1]['type'] != 'end':
+            messages.append(subscriber.get(timeout=2))
+        self.assertEqual(messages[0]['type'], 'map')
+        self.assertEqual([message['value'] for message in messages[1:-1]], range(published))
+
+
+if __name__ == '__main__':
+    unittest.main()
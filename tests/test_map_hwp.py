@@ -0,0 +1,213 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+import netCDF4
+import numpy as np
+
+from xystage import basemapper, benchmarks, emulator, map_hwp, mapwriter, stage, stepper
+
+
+class EmulatedHittite(object):
+    # Remembers the frequencies it was tuned to
+    def __init__(self):
+        self.frequencies = []
+        self.power = None
+
+    def set_power(self, power):
+        self.power = power
+
+    def on(self):
+        pass
+
+    def set_freq(self, frequency):
+        self.frequencies.append(frequency)
+
+
+class EmulatedMapper(map_hwp.Mapper):
+    """
+    A map_hwp.Mapper with an emulated stage, HWP and lockin, which reads 1 mV plus 1 mV per 1000 steps of x. The
+    stage is taken to be homed where it starts, unless homed=False.
+    """
+    def __init__(self, test, homed=True, use_hittite=True, speedup=20):
+        basemapper.BaseMapper.__init__(self)
+        stage_controller = emulator.L6474Controller(speedup=speedup)
+        test.addCleanup(stage_controller.stop)
+        hwp_controller = emulator.HWPStepperController(speedup=5 * speedup)
+        test.addCleanup(hwp_controller.stop)
+        self.stage = stage.Stage(stage_controller.port(), cache=True)
+        self.stage.transport.telemetry = self.telemetry
+        self.stage.initialize()
+        self.hwp = stepper.SimpleStepper(hwp_controller.port())
+        self.hwp.transport.telemetry = self.telemetry
+        with benchmarks.quiet():
+            self.hwp.initialize()
+        if homed:
+            self.stage.reset_home()
+            self._have_found_home = True
+        self.lockin = emulator.SR830Lockin(self.signal, speedup=speedup)
+        self.lockin_time_constant = self.lockin.time_constant
+        self.hittite = EmulatedHittite() if use_hittite else None
+
+    def signal(self):
+        return 1e-3 * (1 + self.stage.positions[0] / 1000.)
+
+
+class MapTestCase(unittest.TestCase):
+    # Maps are 3 x 2 pixels, the lockin reading each with the HWP at 3 positions and 2 mmw frequencies
+    xsteps = np.arange(0, 600, 200)
+    ysteps = np.arange(0, 400, 200)
+    hwp_steps = np.arange(3)
+    mmw_frequencies = np.array([140e9, 150e9])
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'map.nc')
+
+    def do_simple_map(self, mapper, **kwargs):
+        nc = netCDF4.Dataset(self.filename, mode='w')
+        try:
+            with benchmarks.quiet():
+                mapper.do_simple_map(self.xsteps, self.ysteps, hwp_steps=self.hwp_steps,
+                                     mmw_frequencies=self.mmw_frequencies, time_constant_wait=0, nc=nc, **kwargs)
+        finally:
+            nc.close()
+
+    def read_map(self):
+        nc = netCDF4.Dataset(self.filename)
+        try:
+            group = mapwriter.find_map_group(nc)
+            return (mapwriter.missing_cells(group), group.variables['z'][:],
+                    group.variables['hwp_step_reading'][:], group.__dict__)
+        finally:
+            nc.close()
+
+    def check_map(self, z):
+        expected = 1e-3 * (1 + self.xsteps / 1000.)
+        self.assertTrue(np.allclose(z, expected[:, None, None, None] * np.ones(z.shape)))
+
+
+class MapTest(MapTestCase):
+    def check_simple_map(self, mapper, **kwargs):
+        self.do_simple_map(mapper, **kwargs)
+        missing, z, steps, attributes = self.read_map()
+        self.assertFalse(missing.any())
+        self.check_map(z)
+        # The HWP takes one step before the readings at each of its positions
+        pixels = len(self.xsteps) * len(self.ysteps)
+        self.assertEqual(sorted(steps[:, :, :, 0].ravel()), range(1, pixels * len(self.hwp_steps) + 1))
+        self.assertTrue((steps[..., 0] == steps[..., 1]).all())
+        self.assertEqual(attributes['scan_mode'], 'simple')
+        # The Hittite is driven at a twelfth of the mmw frequency, for each reading
+        self.assertEqual(len(mapper.hittite.frequencies), z.size)
+        self.assertEqual(set(mapper.hittite.frequencies), set(self.mmw_frequencies / 12.0))
+
+    def test_simple_map(self):
+        self.check_simple_map(EmulatedMapper(self))
+
+    def test_pipelined_map(self):
+        self.check_simple_map(EmulatedMapper(self), pipelined=True)
+
+    def test_adaptive_settling(self):
+        mapper = EmulatedMapper(self, use_hittite=False)
+        self.mmw_frequencies = np.array([-1])
+        self.do_simple_map(mapper, settle_mode='adaptive')
+        missing, z, steps, attributes = self.read_map()
+        self.assertFalse(missing.any())
+        self.check_map(z)
+        self.assertEqual(attributes['settle_mode'], 'adaptive')
+
+
+class ScheduledMapTest(MapTestCase):
+    def do_scheduled_map(self, mapper, **kwargs):
+        nc = netCDF4.Dataset(self.filename, mode='w')
+        try:
+            with benchmarks.quiet():
+                mapper.do_scheduled_map(self.xsteps, self.ysteps, hwp_steps=self.hwp_steps,
+                                        mmw_frequencies=self.mmw_frequencies, settle_time=0, time_constant_wait=0,
+                                        nc=nc, **kwargs)
+        finally:
+            nc.close()
+
+    def check_scheduled_map(self, mapper):
+        missing, z, steps, attributes = self.read_map()
+        self.assertFalse(missing.any())
+        self.check_map(z)
+        # Index 0 is home, and the HWP only ever steps forward through its turn
+        self.assertTrue((steps % len(self.hwp_steps) == self.hwp_steps[None, None, :, None]).all())
+        self.assertEqual(attributes['scan_mode'], 'scheduled')
+        return attributes
+
+    def test_quickest(self):
+        # The stage and HWP are homed first
+        mapper = EmulatedMapper(self, homed=False)
+        self.do_scheduled_map(mapper)
+        self.assertTrue(mapper._have_found_home)
+        attributes = self.check_scheduled_map(mapper)
+        self.assertEqual(sorted(attributes['loop_order'].split(',')), ['hwp_step', 'mmw_frequency', 'x', 'y'])
+        # Retuning is quicker than anything else, so the frequency is innermost
+        self.assertEqual(attributes['loop_order'].split(',')[-1], 'mmw_frequency')
+
+    def test_order(self):
+        mapper = EmulatedMapper(self)
+        order = ['hwp_step', 'mmw_frequency', 'y', 'x']
+        self.do_scheduled_map(mapper, order=order)
+        attributes = self.check_scheduled_map(mapper)
+        self.assertEqual(attributes['loop_order'], ','.join(order))
+        # The frequency snakes inside each HWP position, so it only changes four times: 140, 150 | 150, 140 | 140, 150
+        self.assertEqual(mapper.hittite.frequencies, list(self.mmw_frequencies[[0, 1, 0, 1]] / 12.0))
+
+
+class ResumeTest(MapTestCase):
+    def interrupted_map(self, mapper, moves, **kwargs):
+        # A do_simple_map whose stage fails after the given number of moves
+        go_to_position = mapper.stage.go_to_position
+        calls = [0]
+
+        def failing(*args, **kwargs):
+            calls[0] += 1
+            if calls[0] > moves:
+                raise IOError("stage gone")
+            return go_to_position(*args, **kwargs)
+        mapper.stage.go_to_position = failing
+        self.assertRaises(IOError, self.do_simple_map, mapper, **kwargs)
+        mapper.stage.go_to_position = go_to_position
+
+    def resume(self, mapper, **kwargs):
+        with benchmarks.quiet():
+            mapper.resume(self.filename, **kwargs)
+        mapper.mapfile.nc.close()
+
+    def check_resume(self, pipelined):
+        mapper = EmulatedMapper(self)
+        self.interrupted_map(mapper, 3)
+        missing, before, steps, attributes = self.read_map()
+        self.assertEqual(missing.sum(), 3 * len(self.hwp_steps) * len(self.mmw_frequencies))
+        homed = []
+        find_home = mapper.hwp.find_home
+        mapper.hwp.find_home = lambda: homed.append(find_home())
+        self.resume(mapper, pipelined=pipelined)
+        # Where the HWP stopped is unknown, so it is homed again
+        self.assertEqual(len(homed), 1)
+        missing, after, steps, attributes = self.read_map()
+        self.assertFalse(missing.any())
+        self.check_map(after)
+        done = ~np.ma.getmaskarray(before)
+        self.assertTrue((after[done] == before[done]).all())
+        # Resuming a finished map measures nothing
+        self.resume(mapper)
+        self.assertEqual(len(homed), 1)
+
+    def test_resume(self):
+        self.check_resume(pipelined=False)
+
+    def test_resume_pipelined(self):
+        self.check_resume(pipelined=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
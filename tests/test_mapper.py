@@ -0,0 +1,374 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+import netCDF4
+import numpy as np
+
+from xystage import benchmarks, emulator, mapper, mapwriter, settling, stage
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'map.nc')
+        self.mapper, controller = benchmarks.emulated_mapper(speedup=20)
+        self.addCleanup(controller.stop)
+
+    def interrupted_map(self, readings, **kwargs):
+        # A do_simple_map whose lockin fails after the given number of readings
+        lockin = self.mapper.lockin
+        measure = lockin.auto_range_measure
+        calls = [0]
+
+        def failing(*args, **kwargs):
+            calls[0] += 1
+            if calls[0] > readings:
+                raise IOError("lockin gone")
+            return measure(*args, **kwargs)
+        lockin.auto_range_measure = failing
+        nc = netCDF4.Dataset(self.filename, mode='w')
+        with benchmarks.quiet():
+            self.assertRaises(IOError, self.mapper.do_simple_map, np.arange(600, 1200, 200), np.arange(600, 1000, 200),
+                              settle_time=0, nc=nc, **kwargs)
+        nc.close()
+        lockin.auto_range_measure = measure
+
+    def missing(self):
+        nc = netCDF4.Dataset(self.filename)
+        try:
+            return mapwriter.missing_cells(mapwriter.find_map_group(nc)).sum()
+        finally:
+            nc.close()
+
+    def readings(self):
+        nc = netCDF4.Dataset(self.filename)
+        try:
+            return mapwriter.find_map_group(nc).variables['z'][:]
+        finally:
+            nc.close()
+
+    def resume(self, **kwargs):
+        with benchmarks.quiet():
+            self.mapper.resume(self.filename, **kwargs)
+        self.mapper.mapfile.nc.close()
+
+    def test_resume(self):
+        self.interrupted_map(4, settle_mode='adaptive')
+        self.assertEqual(self.missing(), 2)
+        before = self.readings()
+        self.resume()
+        self.assertEqual(self.missing(), 0)
+        after = self.readings()
+        # Readings already taken are kept
+        done = ~np.ma.getmaskarray(before)
+        self.assertTrue((after[done] == before[done]).all())
+        self.assertTrue(np.isfinite(after).all())
+
+    def test_nothing_left(self):
+        self.interrupted_map(4)
+        self.resume(pipelined=True)
+        after = self.readings()
+        self.resume()
+        self.assertEqual(self.missing(), 0)
+        self.assertTrue((self.readings() == after).all())
+
+    def test_moved_stage(self):
+        # Where the stage is no longer agrees with where it was left, e.g. after a power cycle of the controller, so
+        # it is homed again before the rest is measured
+        self.interrupted_map(2)
+        self.mapper.stage.positions = [500, 500]
+        homed = []
+        find_home = self.mapper.stage.find_home
+        self.mapper.stage.find_home = lambda **kwargs: homed.append(find_home(**kwargs))
+        self.resume(plan=False)
+        self.assertEqual(len(homed), 1)
+        self.assertEqual(self.missing(), 0)
+
+    def test_same_position(self):
+        self.interrupted_map(2)
+        self.mapper.stage.find_home = self.fail
+        self.resume()
+        self.assertEqual(self.missing(), 0)
+
+
+class RecordingFeed(object):
+    # Stands in for a livefeed.Publisher
+    def __init__(self):
+        self.headers = []
+        self.points = {}
+        self.ended = 0
+
+    def start_map(self, header, z=None):
+        self.headers.append(header)
+
+    def publish(self, index, value, **extra):
+        self.points[tuple(index)] = value
+
+    def end_map(self):
+        self.ended += 1
+
+
+def fly_row(positions, lag, forward=True, duration=1.0, sample_interval=0.01, position_interval=0.05):
+    # A row of a fly scan over positions at constant velocity, of a signal that the lockin reports lag seconds late
+    sample_times = np.arange(0, duration + sample_interval / 2, sample_interval)
+    position_times = np.arange(0, duration + position_interval / 2, position_interval)
+    path = np.linspace(positions[0], positions[-1], len(position_times))
+    if not forward:
+        path = path[::-1]
+    true_positions = np.interp(sample_times - lag, position_times, path)
+    samples = np.exp(-((true_positions - 500) / 200.) ** 2)
+    return sample_times, samples, position_times, path
+
+
+class FlyScanTest(unittest.TestCase):
+    xsteps = np.arange(0, 1001, 100)
+
+    def test_grid_row(self):
+        row = fly_row([0, 1000], 0.0)
+        z = mapper.grid_row(self.xsteps, row, 0.0)
+        self.assertTrue(np.allclose(z, np.exp(-((self.xsteps - 500) / 200.) ** 2), atol=1e-3))
+        # Backward rows come out the same way round
+        z = mapper.grid_row(self.xsteps, fly_row([0, 1000], 0.0, forward=False), 0.0)
+        self.assertTrue(np.allclose(z, np.exp(-((self.xsteps - 500) / 200.) ** 2), atol=1e-3))
+        # Positions the row did not reach are NaN
+        z = mapper.grid_row(self.xsteps, fly_row([200, 800], 0.0), 0.0)
+        self.assertTrue(np.isnan(z[:2]).all() and np.isnan(z[-2:]).all())
+        self.assertFalse(np.isnan(z[2:-2]).any())
+
+    def test_lag(self):
+        rows = [fly_row([0, 1000], 0.1, forward=k % 2 == 0) for k in range(4)]
+        self.assertAlmostEqual(mapper.estimate_lag(self.xsteps, rows, 0.3, num_lags=31), 0.1)
+        # The right lag undoes the shift
+        z = mapper.grid_row(self.xsteps, rows[1], 0.1)
+        self.assertTrue(np.allclose(z[2:], np.exp(-((self.xsteps[2:] - 500) / 200.) ** 2), atol=1e-3))
+
+    def test_position_logger(self):
+        controller = emulator.L6474Controller(speedup=20)
+        self.addCleanup(controller.stop)
+        s = stage.Stage(controller.port(), cache=True)
+        s.initialize()
+        s.reset_home()
+        logger = mapper.PositionLogger(s, 0, 800, 0.01)
+        s.go_to_position(800, 0, block=False)
+        logger.start()
+        logger.join(5)
+        self.assertTrue(logger.finished.is_set())
+        self.assertEqual(logger.positions[-1], 800)
+        self.assertTrue((np.diff(logger.positions) >= 0).all())
+        self.assertTrue((np.diff(logger.times) > 0).all())
+
+    def test_fly_map(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'map.nc')
+        m, controller = benchmarks.emulated_mapper(speedup=20)
+        self.addCleanup(controller.stop)
+        axis = controller.axes[0]
+        m.lockin.signal = lambda: 1e-3 * (1 + axis.position(controller.now()) / 1000.)
+        m.feed = RecordingFeed()
+        xsteps = np.arange(0, 801, 200)
+        ysteps = np.arange(0, 201, 100)
+        nc = netCDF4.Dataset(filename, mode='w')
+        with benchmarks.quiet():
+            # Without overscan the first and last cells of a row may fall between samples
+            m.do_fly_map(xsteps, ysteps, velocity=100, sample_interval=0.01, position_interval=0.01, overscan=50,
+                         description='fly test', nc=nc)
+        nc.close()
+        nc = netCDF4.Dataset(filename)
+        self.addCleanup(nc.close)
+        group = mapwriter.find_map_group(nc)
+        z = group.variables['z'][:, :, 0]
+        expected = 1e-3 * (1 + xsteps / 1000.)
+        self.assertTrue(np.allclose(z, expected[:, None] * np.ones(z.shape), atol=2e-5))
+        self.assertEqual((group.scan_mode, group.description, group.velocity, group.lag), ('fly', 'fly test', 100, 0))
+        self.assertTrue(group.phase_time_fly > 0)
+        self.assertEqual(set(group.variables['sample_row'][:]), set(range(len(ysteps))))
+        self.assertFalse(os.path.exists(mapwriter.journal_filename(nc, group)))
+        # Every gridded reading went out on the live feed
+        self.assertEqual(len(m.feed.headers), 1)
+        self.assertEqual(m.feed.ended, 1)
+        self.assertEqual(sorted(m.feed.points), [(x, y, 0) for x in range(len(xsteps)) for y in range(len(ysteps))])
+
+
+class AdaptiveMapTest(unittest.TestCase):
+    def test_refines_peak(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'map.nc')
+        centre = (1100, 700)
+        width = 150.
+        m, controller = benchmarks.emulated_mapper(speedup=20, centre=centre, width=width)
+        self.addCleanup(controller.stop)
+        # Coarse squares of 400 x 400 steps
+        xsteps = np.arange(0, 2001, 50)
+        ysteps = np.arange(0, 1601, 50)
+        nc = netCDF4.Dataset(filename, mode='w')
+        with benchmarks.quiet():
+            m.do_adaptive_map(xsteps, ysteps, coarse_stride=8, max_points=80, gradient_threshold=0.2,
+                              signal_threshold=0.2, settle_time=0, nc=nc)
+        nc.close()
+        nc = netCDF4.Dataset(filename)
+        self.addCleanup(nc.close)
+        group = mapwriter.find_map_group(nc)
+        points = zip(group.variables['point_x_index'][:], group.variables['point_y_index'][:])
+        levels = group.variables['point_level'][:]
+        self.assertTrue(len(points) <= 80)
+        self.assertEqual(len(set(points)), len(points))
+        self.assertTrue(group.levels > 1)
+        self.assertEqual((levels == 0).sum(), 6 * 5)
+        # Everything after the coarse grid is refinement, which should stay around the peak
+        distance = lambda (x, y): np.hypot(xsteps[x] - centre[0], ysteps[y] - centre[1])
+        refined = [distance(point) for point, level in zip(points, levels) if level > 0]
+        everywhere = [distance((x, y)) for x in range(len(xsteps)) for y in range(len(ysteps))]
+        self.assertTrue(len(refined) > 0)
+        self.assertTrue(max(refined) < 800)
+        self.assertTrue(np.median(refined) < 0.5 * np.median(everywhere))
+        # z is interpolated wherever the squares reach
+        self.assertTrue(np.isfinite(group.variables['z'][:]).all())
+
+class LockinOnlyMapper(mapper.Mapper):
+    # Enough of a Mapper for _measure and _range_summary
+    def __init__(self, lockin):
+        self.lockin = lockin
+        self.lockin_time_constant = 0
+
+
+class Group(object):
+    pass
+
+
+class SensitivityPredictorTest(unittest.TestCase):
+    shape = (4, 3, 2)
+
+    def setUp(self):
+        self.value = [1e-3]
+        self.lockin = emulator.SR830Lockin(lambda: self.value[0], speedup=1000)
+        self.auto_ranged = []
+        auto_range_measure = self.lockin.auto_range_measure
+
+        def counting(*args, **kwargs):
+            self.auto_ranged.append(self.value[0])
+            return auto_range_measure(*args, **kwargs)
+        self.lockin.auto_range_measure = counting
+        self.mapper = LockinOnlyMapper(self.lockin)
+        self.predictor = self.new_predictor()
+
+    def new_predictor(self, r=None):
+        if r is None:
+            r = np.empty(self.shape) * np.nan
+        return mapper.SensitivityPredictor(-np.ones(self.shape, dtype=int), r)
+
+    def measure(self, cell, value):
+        self.value[0] = value
+        return self.mapper._measure(self.predictor, cell)
+
+    def test_previous_pixel(self):
+        predictor = self.predictor
+        predictor.update((0, 0, 0), 18, 1e-3)
+        self.assertEqual(predictor.estimate(1, 0, 0), 1e-3)
+        predictor.update((1, 0, 0), 18, 2e-3)
+        # Carried on by the change from the pixel before, at most tenfold
+        self.assertAlmostEqual(predictor.estimate(2, 0, 0), 4e-3)
+        predictor.update((2, 0, 0), 18, 1e-1)
+        self.assertAlmostEqual(predictor.estimate(3, 0, 0), 1.0)
+        # Nothing at this frequency yet
+        self.assertTrue(np.isnan(predictor.estimate(3, 0, 1)))
+
+    def test_previous_frequency(self):
+        # At the same pixel, the last frequency read is the best guess
+        self.predictor.update((0, 0, 0), 18, 1e-3)
+        self.predictor.update((1, 0, 0), 18, 3e-3)
+        self.assertEqual(self.predictor.estimate(1, 0, 1), 3e-3)
+
+    def test_rows(self):
+        # With no previous pixel, e.g. when resuming, the larger reading of the rows above and below
+        r = np.empty(self.shape) * np.nan
+        r[2, 0, 1] = 1e-6
+        r[2, 2, 1] = 3e-6
+        predictor = self.new_predictor(r)
+        self.assertEqual(predictor.estimate(2, 1, 1), 3e-6)
+        self.assertTrue(np.isnan(predictor.estimate(1, 1, 1)))
+        self.assertEqual(predictor.predict(1, 1, 1), None)
+
+    def test_predict(self):
+        predictor = self.predictor
+        predictor.update((0, 0, 0), 18, 1e-3)
+        # Puts 1e-3 at the geometric middle of 5% to 90% of full scale, about 21%: 5 mV
+        sensitivity = predictor.predict(1, 0, 0)
+        self.assertEqual(settling.SR830_SENSITIVITIES[sensitivity], 5e-3)
+        # Well inside the current range, so no range change
+        predictor.current = 20
+        self.assertEqual(predictor.predict(1, 0, 0), 20)
+        # Too close to the top of it
+        predictor.current = 18
+        self.assertEqual(predictor.predict(1, 0, 0), sensitivity)
+        predictor.update((1, 0, 0), 26, 100.)
+        self.assertEqual(predictor.predict(2, 0, 0), len(settling.SR830_SENSITIVITIES) - 1)
+
+    def test_in_range(self):
+        self.assertTrue(self.predictor.in_range(1e-3, 19))
+        self.assertFalse(self.predictor.in_range(4.6e-3, 19))
+        self.assertFalse(self.predictor.in_range(2e-4, 19))
+        self.assertFalse(self.predictor.in_range(np.nan, 19))
+        # Nothing is too small for the most sensitive range, or too large for the least
+        self.assertTrue(self.predictor.in_range(1e-12, 0))
+        self.assertTrue(self.predictor.in_range(2., len(settling.SR830_SENSITIVITIES) - 1))
+
+    def test_measure(self):
+        # The first reading has nothing to go on, the next ones are predicted from it
+        r, sensitivity = self.measure((0, 0, 0), 1e-3)
+        self.assertEqual(self.auto_ranged, [1e-3])
+        self.assertEqual(self.predictor.current, sensitivity)
+        self.assertEqual(self.measure((1, 0, 0), 1.2e-3), (1.2e-3, 19))
+        self.assertEqual(self.measure((1, 0, 1), 1.1e-3), (1.1e-3, 19))
+        self.assertEqual(self.auto_ranged, [1e-3])
+        self.assertEqual((self.predictor.auto_ranges, self.predictor.auto_ranges_saved), (1, 2))
+        self.assertEqual(self.predictor.range_changes, 1)
+        self.assertEqual(self.lockin.sensitivity, 19)
+
+    def test_overload(self):
+        self.measure((0, 0, 0), 1e-3)
+        self.measure((1, 0, 0), 1e-3)
+        # The lockin saturates at the predicted range, so the reading is auto-ranged instead
+        r, sensitivity = self.measure((2, 0, 0), 0.5)
+        self.assertAlmostEqual(r, 0.5)
+        self.assertEqual(self.auto_ranged, [1e-3, 0.5])
+        self.assertEqual(self.predictor.fallbacks, 1)
+        self.assertEqual(self.predictor.current, sensitivity)
+        self.assertEqual(self.predictor.sensitivity[2, 0, 0], sensitivity)
+        self.assertTrue(0.5 <= 0.9 * settling.SR830_SENSITIVITIES[sensitivity])
+
+    def test_under_range(self):
+        self.measure((0, 0, 0), 1e-3)
+        self.measure((1, 0, 0), 1e-3)
+        r, sensitivity = self.measure((2, 0, 0), 1e-6)
+        self.assertEqual(self.auto_ranged, [1e-3, 1e-6])
+        self.assertEqual(self.predictor.fallbacks, 1)
+        self.assertTrue(1e-6 >= 0.05 * settling.SR830_SENSITIVITIES[sensitivity])
+        # The next frequency at this pixel is predicted from the new reading
+        r, sensitivity = self.measure((2, 0, 1), 1.1e-6)
+        self.assertEqual(self.auto_ranged, [1e-3, 1e-6])
+        self.assertTrue(self.predictor.in_range(r, sensitivity))
+
+    def test_summary(self):
+        for x, value in enumerate([1e-3, 1e-3, 0.5, 0.5]):
+            self.measure((x, 0, 0), value)
+        mapfile = Group()
+        mapfile.group = Group()
+        with benchmarks.quiet():
+            self.mapper._range_summary(mapfile, self.predictor)
+        self.assertEqual((mapfile.group.auto_ranges, mapfile.group.auto_ranges_saved, mapfile.group.range_changes),
+                         (2, 2, 1))
+        # Nothing is recorded for maps that auto-range every reading
+        mapfile.group = Group()
+        self.mapper._range_summary(mapfile, None)
+        self.assertFalse(hasattr(mapfile.group, 'auto_ranges'))
+
+
+if __name__ == '__main__':
+    unittest.main()
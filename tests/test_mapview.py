@@ -0,0 +1,237 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+import netCDF4
+import numpy as np
+
+from xystage import mapper, mapview
+
+
+def map_message(group, frequencies=(140e9, 150e9, 160e9), z=None):
+    # A 'map' message as livefeed.Subscriber returns it
+    shape = (3, 2, len(frequencies))
+    if z is None:
+        z = np.empty(shape, dtype=np.float32)
+        z[:] = np.nan
+    return {'type': 'map', 'filename': '/data/readout/beams/map.nc', 'group': group, 'description': '',
+            'dimensions': ['x', 'y', 'frequency'], 'shape': list(shape), 'z': z,
+            'coordinates': {'x': [0., 100., 200.], 'y': [0., 100.], 'frequency': list(frequencies)}}
+
+
+def point(index, value):
+    return {'type': 'point', 'index': list(index), 'value': value}
+
+
+class FakeFeed(object):
+    # Stands in for a livefeed.Subscriber; the tests hand messages to update_data themselves
+    def poll(self):
+        return []
+
+    def get(self, timeout=None):
+        return None
+
+
+class LiveMapViewerTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(plt.close, 'all')
+        self.viewer = mapview.LiveMapViewer(feed=FakeFeed(), message=map_message('map_1'), freq_index=1)
+
+    def test_points(self):
+        viewer = self.viewer
+        self.assertEqual(viewer.plane_key, (1,))
+        viewer.update_data([point((0, 0, 1), 1.0), point((2, 1, 1), 3.0), point((1, 1, 0), 5.0)])
+        # Every reading goes into the cube, only those of the plane shown into the image
+        self.assertEqual(viewer.cube[1, 1, 0], 5.0)
+        self.assertEqual((viewer.z[0, 0], viewer.z[2, 1]), (1.0, 3.0))
+        self.assertTrue(viewer.z.mask[1, 1])
+        self.assertEqual(viewer.zlim, (1.0, 3.0))
+        # Other planes are read from the cube when picked
+        viewer.sliders[0].set_val(0)
+        self.assertEqual(viewer.plane_key, (0,))
+        self.assertEqual(viewer.z[1, 1], 5.0)
+        self.assertEqual(viewer.z.count(), 1)
+
+    def test_end(self):
+        self.viewer.update_data([point((0, 0, 1), 1.0), {'type': 'end', 'group': 'map_1'}])
+        self.assertTrue(self.viewer.fig._suptitle.get_text().endswith('(finished)'))
+        self.assertEqual(self.viewer.next_viewer, None)
+
+    def test_next_map(self):
+        viewer = self.viewer
+        viewer.sliders[0].set_val(2)
+        z = np.zeros((3, 2, 3), dtype=np.float32)
+        z[:, :, 2] = 7.0
+        viewer.update_data([point((0, 0, 2), 1.0), {'type': 'end', 'group': 'map_1'}, map_message('map_2', z=z),
+                            point((1, 0, 2), 9.0)])
+        # A viewer for the next map takes over, showing the plane that was picked, with the points after its header
+        next_viewer = viewer.next_viewer
+        self.assertEqual(plt.get_fignums(), [next_viewer.fig.number])
+        self.assertEqual(next_viewer.header['group'], 'map_2')
+        self.assertEqual(next_viewer.plane_key, (2,))
+        self.assertEqual(next_viewer.z[0, 0], 7.0)
+        self.assertEqual(next_viewer.z[1, 0], 9.0)
+        self.assertTrue(np.isnan(viewer.cube[1, 0, 2]))
+
+    def test_next_map_fewer_planes(self):
+        # The plane picked is clipped to what the next map has
+        self.viewer.sliders[0].set_val(2)
+        self.viewer.update_data([map_message('map_2', frequencies=(140e9,))])
+        self.assertEqual(self.viewer.next_viewer.plane_key, (0,))
+
+    def test_hwp_map(self):
+        # map_hwp maps have a plane per HWP step and frequency; both are kept for the next map
+        message = map_message('map_1')
+        message.update(dimensions=['x', 'y', 'hwp_step', 'frequency'], shape=[3, 2, 4, 3],
+                       z=np.empty((3, 2, 4, 3), dtype=np.float32) * np.nan)
+        message['coordinates']['hwp_step'] = [0, 1, 2, 3]
+        viewer = mapview.LiveMapViewer(feed=FakeFeed(), message=message, hwp_index=1, freq_index=2)
+        self.assertEqual(viewer.plane_key, (1, 2))
+        viewer.update_data([point((2, 0, 1, 2), 4.0), point((2, 0, 0, 2), 6.0)])
+        self.assertEqual(viewer.z[2, 0], 4.0)
+        viewer.sliders[0].set_val(3)
+        next_message = dict(message, group='map_2', z=np.zeros((3, 2, 4, 3), dtype=np.float32))
+        viewer.update_data([next_message])
+        self.assertEqual(viewer.next_viewer.plane_key, (3, 2))
+
+
+class PlaneCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+        # Room for three planes of 100 float64 values
+        self.cache = mapview.PlaneCache(self.load, max_bytes=2400)
+
+    def load(self, key):
+        self.loaded.append(key)
+        return np.ones(100) * key
+
+    def test_lru(self):
+        for key in [0, 1, 2, 0, 3]:
+            self.assertEqual(self.cache.get(key)[0], key)
+        # 0 was used again before 3 was read, so 1 is the least recently used
+        self.assertEqual(self.loaded, [0, 1, 2, 3])
+        self.assertEqual(list(self.cache.planes), [2, 0, 3])
+        self.assertEqual(self.cache.nbytes, 2400)
+        self.assertFalse(1 in self.cache)
+        self.cache.get(1)
+        self.assertEqual(self.loaded[-1], 1)
+        self.assertEqual(list(self.cache.planes), [0, 3, 1])
+
+    def test_put(self):
+        self.cache.get(0)
+        self.cache.put(0, np.zeros(50))
+        self.assertEqual(self.cache.nbytes, 400)
+        self.assertEqual(self.cache.get(0).shape, (50,))
+        # A plane larger than max_bytes is still kept, on its own
+        self.cache.put(1, np.zeros(1000))
+        self.assertEqual(list(self.cache.planes), [1])
+        self.assertEqual(self.cache.nbytes, 8000)
+
+    def test_stale_load(self):
+        # The file changes while a plane is being read, e.g. on the prefetch thread: the plane is returned but not
+        # kept, so the next get reads it again
+        def load(key):
+            self.cache.clear()
+            return self.load(key)
+        self.cache.load = load
+        self.assertEqual(self.cache.get(2)[0], 2)
+        self.assertFalse(2 in self.cache)
+        self.assertEqual(self.cache.nbytes, 0)
+        self.cache.load = self.load
+        self.cache.get(2)
+        self.assertTrue(2 in self.cache)
+        self.assertEqual(self.loaded, [2, 2])
+
+    def test_clear(self):
+        self.cache.get(0)
+        self.cache.get(1)
+        self.cache.clear()
+        self.assertEqual((len(self.cache.planes), self.cache.nbytes), (0, 0))
+        self.cache.get(0)
+        self.assertEqual(self.loaded, [0, 1, 0])
+
+
+class MapFileViewerTest(unittest.TestCase):
+    xsteps = np.arange(0, 400, 100)
+    ysteps = np.arange(0, 500, 100)
+    frequencies = np.array([140e9, 150e9, 160e9])
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'map.nc')
+        nc = netCDF4.Dataset(self.filename, mode='w')
+        mapper.MapDataFile(self.xsteps, self.ysteps, self.frequencies, parent_nc=nc)
+        nc.close()
+        self.write_row(0)
+        self.viewer = mapview.MapFileViewer(self.filename, freq_index=1, full_refresh_interval=2)
+        self.addCleanup(plt.close, 'all')
+        self.addCleanup(self.viewer.loader.close)
+
+    def row_values(self, y):
+        return (np.arange(len(self.xsteps))[:, None] + 10 * y + 100 * np.arange(len(self.frequencies))[None, :])
+
+    def write_row(self, y):
+        # As a mapper in another process would; the viewer's handle is closed first, since HDF5 will not open a
+        # file for writing that this process has open
+        viewer = getattr(self, 'viewer', None)
+        if viewer is not None:
+            viewer.loader.submit(lambda: None).wait()
+            viewer.nc.close()
+            viewer.nc = None
+        nc = netCDF4.Dataset(self.filename, mode='a')
+        group = nc.groups.values()[0]
+        group.variables['z'][:, y, :] = self.row_values(y)
+        nc.close()
+
+    def test_initial_plane(self):
+        viewer = self.viewer
+        self.assertEqual(viewer.plane_key, (1,))
+        self.assertEqual(viewer.z[:, 0].tolist(), self.row_values(0)[:, 1].tolist())
+        self.assertTrue(np.ma.getmaskarray(viewer.z[:, 1:]).all())
+
+    def test_incremental(self):
+        viewer = self.viewer
+        self.write_row(1)
+        viewer.reopen()
+        self.assertEqual(viewer.read_changed_rows(), [1])
+        self.assertEqual(viewer.z[:, 1].tolist(), self.row_values(1)[:, 1].tolist())
+        # Nothing new
+        self.assertEqual(viewer.read_changed_rows(), [])
+
+    def test_stops_at_empty_row(self):
+        viewer = self.viewer
+        self.write_row(3)
+        viewer.reopen()
+        # Row 1 is still empty, so row 3 is only found by a full refresh
+        self.assertEqual(viewer.read_changed_rows(), [])
+        self.assertTrue(np.ma.getmaskarray(viewer.z[:, 3]).all())
+        self.assertEqual(viewer.read_changed_rows(full=True), [3])
+        self.assertEqual(viewer.z[:, 3].tolist(), self.row_values(3)[:, 1].tolist())
+
+    def test_periodic_full_refresh(self):
+        viewer = self.viewer
+        self.write_row(3)
+        mtime = os.path.getmtime(self.filename)
+        # The first refresh after a change reads up to the first empty row only, every second one reads them all
+        os.utime(self.filename, (mtime + 1, mtime + 1))
+        viewer.update_data(None)
+        self.assertTrue(np.ma.getmaskarray(viewer.z[:, 3]).all())
+        # The modification time has not changed, so the file is not read
+        viewer.update_data(None)
+        self.assertEqual(viewer._refreshes, 1)
+        os.utime(self.filename, (mtime + 2, mtime + 2))
+        viewer.update_data(None)
+        self.assertEqual(viewer.z[:, 3].tolist(), self.row_values(3)[:, 1].tolist())
+        # Cached planes are dropped for missing the new row; the one shown is kept
+        self.assertTrue(viewer.plane_key in viewer.planes)
+        viewer.loader.submit(lambda: None).wait()
+        self.assertEqual(viewer.planes.get((2,))[:, 3].tolist(), self.row_values(3)[:, 2].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
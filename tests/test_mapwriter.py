@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import netCDF4
+import numpy as np
+
+from xystage import mapwriter
+
+
+class RecordingVariable(object):
+    # Records the index of every read and write of a netCDF variable
+    def __init__(self, variable):
+        self.variable = variable
+        self.reads = []
+        self.writes = []
+
+    def __getattr__(self, name):
+        return getattr(self.variable, name)
+
+    def __getitem__(self, index):
+        self.reads.append(index)
+        return self.variable[index]
+
+    def __setitem__(self, index, value):
+        self.writes.append(index)
+        self.variable[index] = value
+
+
+class RecordingGroup(object):
+    def __init__(self, group):
+        self.group = group
+        self.variables = dict((name, RecordingVariable(variable)) for name, variable in group.variables.items())
+
+    def __getattr__(self, name):
+        return getattr(self.group, name)
+
+
+class MapWriterTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'map.nc')
+
+    def create(self, storage='image', shape=(4, 3, 5)):
+        nc = netCDF4.Dataset(self.filename, mode='w')
+        group = nc.createGroup('map_20160101120000')
+        profile = mapwriter.storage_profile(storage)
+        dimensions = ('x', 'y', 'frequency')
+        for dimension, size in zip(dimensions, shape):
+            group.createDimension(dimension, None if dimension == 'y' and profile.unlimited else size)
+        group.createVariable('y', np.float, dimensions=('y',))[:] = np.arange(shape[1])
+        profile.create_variable(group, 'z', dimensions)
+        if profile.unlimited:
+            mapwriter.extend_rows(group, ['z'])
+        return nc, group
+
+    def test_buffered(self):
+        nc, group = self.create()
+        writer = mapwriter.BufferedMapWriter(nc, group, flush_interval=1e6, flush_points=3)
+        writer.write('z', (1, 2, 0), 1.5)
+        writer.write('z', (1, 2, 4), 2.5)
+        self.assertTrue(np.ma.is_masked(group.variables['z'][1, 2, 0]))
+        writer.write('z', (0, 0, 0), 3.5)
+        # The third reading filled the buffer
+        self.assertEqual(group.variables['z'][1, 2, 0], 1.5)
+        self.assertEqual(group.variables['z'][0, 0, 0], 3.5)
+        writer.write('z', (1, 2, 1), 4.5)
+        writer.close()
+        self.assertFalse(os.path.exists(writer.journal_filename))
+        np.testing.assert_array_equal(np.ma.filled(group.variables['z'][1, 2], np.nan),
+                                      [1.5, 4.5, np.nan, np.nan, 2.5])
+        nc.close()
+
+    def test_frequency_outermost(self):
+        # Readings of one plane are written in one call, touching no other plane
+        nc, group = self.create()
+        self.addCleanup(nc.close)
+        recording = RecordingGroup(group)
+        z = recording.variables['z']
+        writer = mapwriter.BufferedMapWriter(nc, recording, flush_interval=1e6, flush_points=12)
+        for y in range(3):
+            for x in range(4):
+                writer.write('z', (x, y, 0), x + 10 * y)
+        self.assertEqual((z.reads, z.writes), ([], [(slice(0, 4), slice(0, 3), 0)]))
+        # Scattered readings of a plane: the box around them is read first so the cells in between are kept
+        writer.write('z', (0, 0, 2), 1.0)
+        writer.write('z', (2, 1, 2), 2.0)
+        writer.flush()
+        self.assertEqual(z.reads, [(slice(0, 3), slice(0, 2), 2)])
+        self.assertEqual(z.writes[1:], z.reads)
+        writer.close()
+        np.testing.assert_array_equal(group.variables['z'][:, :, 0], np.arange(4)[:, None] + 10 * np.arange(3))
+        plane = group.variables['z'][:, :, 2]
+        self.assertEqual((plane[0, 0], plane[2, 1], plane.count()), (1.0, 2.0, 2))
+        self.assertEqual(group.variables['z'][:, :, [1, 3, 4]].count(), 0)
+
+    def test_frequency_innermost(self):
+        # Readings of few pixels are written a pixel at a time, whole pixels without reading them first
+        nc, group = self.create()
+        self.addCleanup(nc.close)
+        group.variables['z'][2, 1, 4] = 9.0
+        recording = RecordingGroup(group)
+        z = recording.variables['z']
+        writer = mapwriter.BufferedMapWriter(nc, recording, flush_interval=1e6)
+        for f in range(5):
+            writer.write('z', (1, 1, f), f)
+        writer.write('z', (2, 1, 0), 5.0)
+        writer.write('z', (2, 1, 1), 6.0)
+        writer.flush()
+        self.assertEqual(z.reads, [(2, 1)])
+        self.assertEqual(sorted(z.writes), [(1, 1), (2, 1)])
+        np.testing.assert_array_equal(group.variables['z'][1, 1], np.arange(5))
+        np.testing.assert_array_equal(np.ma.filled(group.variables['z'][2, 1], np.nan),
+                                      [5.0, 6.0, np.nan, np.nan, 9.0])
+        writer.close()
+
+    def test_any_order(self):
+        # Whatever the order and the flushes, the file ends up with every reading and nothing else
+        random = np.random.RandomState(0)
+        for storage in ['image', 'spectrum', 'legacy']:
+            nc, group = self.create(storage, shape=(5, 4, 6))
+            expected = np.empty((5, 4, 6)) * np.nan
+            writer = mapwriter.BufferedMapWriter(nc, group, flush_interval=1e6, flush_points=7)
+            cells = [(x, y, f) for x in range(5) for y in range(4) for f in range(6)]
+            for k in random.permutation(len(cells))[:100]:
+                value = random.rand()
+                writer.write('z', cells[k], value)
+                expected[cells[k]] = value
+            writer.close()
+            z = np.ma.filled(group.variables['z'][:].astype(np.float), np.nan)
+            np.testing.assert_array_equal(z, expected.astype(group.variables['z'].dtype))
+            nc.close()
+
+    def test_journal_replay(self):
+        nc, group = self.create()
+        writer = mapwriter.BufferedMapWriter(nc, group, flush_interval=1e6)
+        writer.write('z', (0, 1, 2), 0.25)
+        writer.write('z', (3, 0, 1), -1.0)
+        # A crash: the readings only made it to the journal
+        nc.close()
+        nc = netCDF4.Dataset(self.filename, mode='a')
+        group = mapwriter.find_map_group(nc)
+        self.assertEqual(mapwriter.replay_journal(nc, group), 2)
+        self.assertEqual(group.variables['z'][0, 1, 2], 0.25)
+        self.assertEqual(group.variables['z'][3, 0, 1], -1.0)
+        self.assertFalse(os.path.exists(mapwriter.journal_filename(nc, group)))
+        self.assertEqual(mapwriter.replay_journal(nc, group), 0)
+        nc.close()
+
+    def test_missing_cells(self):
+        nc, group = self.create()
+        group.variables['z'][:] = 1.0
+        group.variables['z'][2, 1, 3] = np.nan
+        mapwriter.record_path(group, [(2, 1), (0, 0)])
+        missing = mapwriter.missing_cells(group)
+        self.assertEqual(missing.shape, (4, 3, 5))
+        self.assertEqual(zip(*np.nonzero(missing)), [(2, 1, 3)])
+        nc.close()
+
+
+class StorageProfileTest(unittest.TestCase):
+    def test_profiles(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name, chunks in [('image', [8, 6, 5]), ('spectrum', [1, 1, 5]), ('legacy', 'contiguous')]:
+            nc = netCDF4.Dataset(os.path.join(directory, name + '.nc'), mode='w')
+            profile = mapwriter.storage_profile(name)
+            nc.createDimension('x', 8)
+            nc.createDimension('y', None if profile.unlimited else 6)
+            nc.createDimension('frequency', 5)
+            nc.createVariable('y', np.float, dimensions=('y',))[:] = np.arange(6)
+            z = profile.create_variable(nc, 'z', ('x', 'y', 'frequency'))
+            self.assertEqual(z.chunking(), chunks)
+            self.assertEqual(z.dtype, np.dtype(profile.dtype))
+            nc.close()
+        self.assertRaises(ValueError, mapwriter.storage_profile, 'tape')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import time
+import unittest
+
+import numpy as np
+
+from xystage import emulator, motion, stage
+
+
+class MotionModelTest(unittest.TestCase):
+    def test_profile(self):
+        # Long enough to cruise: ramps of (400^2 - 200^2) / (2 * 200) = 300 steps each way
+        profile = motion.MoveProfile(1000, 200, 200, 200, 400)
+        self.assertEqual(profile.peak_speed, 400)
+        self.assertAlmostEqual(profile.duration, 1 + 400 / 400. + 1)
+        self.assertAlmostEqual(profile.distance(profile.duration), 1000)
+        # Too short to reach max_speed
+        self.assertLess(motion.MoveProfile(100, 200, 200, 200, 400).peak_speed, 400)
+
+    def test_vectorized(self):
+        steps = np.array([0, 1, 50, 300, 600, 601, 5000])
+        expected = [motion.move_time(n, 200, 300, 200, 400) for n in steps]
+        np.testing.assert_allclose(motion.move_times(steps, 200, 300, 200, 400), expected)
+
+    def test_against_emulator(self):
+        controller = emulator.L6474Controller(speedup=1)
+        self.addCleanup(controller.stop)
+        s = stage.Stage(controller.port(), cache=True)
+        s.initialize()
+        s.reset_home()
+        model = motion.StageMotionModel.from_stage(s)
+        for target in [(100, 40), (0, 0)]:
+            start = s.get_position()
+            tic = time.time()
+            s.go_to_position(*target)
+            self.assertAlmostEqual(time.time() - tic, model.move_time(start, target), delta=0.1)
+
+
+class ScanTimerTest(unittest.TestCase):
+    def test_remaining(self):
+        timer = motion.ScanTimer({'move': 10.0, 'measure': 10.0}, num_points=10, prior_weight=0.0)
+        for k in range(5):
+            # Moves take twice as long as predicted, readings as predicted
+            timer.record('move', 2.0, 1.0)
+            timer.record('measure', 1.0, 1.0)
+            timer.point_done()
+        self.assertAlmostEqual(timer.scale('move'), 2.0)
+        self.assertAlmostEqual(timer.remaining(), 5 * 2.0 + 5 * 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
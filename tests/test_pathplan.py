@@ -0,0 +1,67 @@
+import unittest
+
+import numpy as np
+
+from xystage import motion, pathplan
+
+
+class PlanPathTest(unittest.TestCase):
+    xsteps = np.arange(0, 2001, 200)
+    ysteps = np.arange(0, 1601, 200)
+
+    def setUp(self):
+        self.model = motion.StageMotionModel(acceleration=160, min_speed=100, max_speed=400, overhead=0.05)
+
+    def check(self, points, model=None, start=(0, 0)):
+        # The planned path visits the same points, and is predicted to be no slower than visiting them in the
+        # serpentine order of do_simple_map
+        model = model or self.model
+        planned = pathplan.plan_path(points, self.xsteps, self.ysteps, model, start=start)
+        self.assertEqual(sorted(planned.points), sorted(points))
+        self.assertEqual(len(set(planned.points)), len(points))
+        positions = pathplan.point_positions(planned.points, self.xsteps, self.ysteps)
+        np.testing.assert_array_equal(planned.positions, positions)
+        serpentine = [point for point in pathplan.serpentine_points(self.xsteps, self.ysteps) if point in points]
+        reference = pathplan.path_time(pathplan.point_positions(serpentine, self.xsteps, self.ysteps), model, start)
+        self.assertAlmostEqual(planned.predicted_time, pathplan.path_time(positions, model, start))
+        self.assertTrue(planned.predicted_time <= reference + 1e-9)
+        return planned
+
+    def test_grid(self):
+        points = pathplan.grid_points(self.xsteps, self.ysteps)
+        np.random.RandomState(0).shuffle(points)
+        self.check(points)
+
+    def test_aperture(self):
+        self.check(pathplan.aperture_points(self.xsteps, self.ysteps, center=(1000, 800), radius=700))
+
+    def test_polar(self):
+        points = pathplan.polar_points(self.xsteps, self.ysteps, (1000, 800), [200, 500, 800], 12)
+        self.check(points, start=None)
+
+    def test_random(self):
+        random = np.random.RandomState(1)
+        grid = pathplan.grid_points(self.xsteps, self.ysteps)
+        for k in range(5):
+            points = [grid[index] for index in random.choice(len(grid), 30, replace=False)]
+            self.check(points, start=tuple(random.randint(0, 2000, 2)))
+
+    def test_slow_axis(self):
+        # With y much slower than x the serpentine is already good, and planning must not make it worse
+        model = motion.StageMotionModel(acceleration=[400, 40], min_speed=100, max_speed=[800, 100])
+        self.check(pathplan.grid_points(self.xsteps, self.ysteps), model=model)
+
+    def test_two_opt(self):
+        points = pathplan.aperture_points(self.xsteps, self.ysteps, center=(1000, 800), radius=900)
+        greedy = pathplan.plan_path(points, self.xsteps, self.ysteps, self.model, start=(0, 0), two_opt=False)
+        improved = pathplan.plan_path(points, self.xsteps, self.ysteps, self.model, start=(0, 0))
+        self.assertTrue(improved.predicted_time <= greedy.predicted_time)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, pathplan.plan_path, [], self.xsteps, self.ysteps, self.model)
+        planned = pathplan.plan_path([(0, 0), (1, 1)], self.xsteps, self.ysteps, self.model)
+        self.assertRaises(ValueError, planned.report, [(0, 0), (2, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+
+from xystage import motion, scheduler
+
+
+class ScheduleTest(unittest.TestCase):
+    def setUp(self):
+        model = motion.StageMotionModel(acceleration=200, min_speed=200, max_speed=400, overhead=0.04)
+        self.axes = scheduler.stage_axes(model, np.array([0, 100, 250, 300]), np.arange(0, 300, 100),
+                                         settle_time=0.3) + [
+            scheduler.ScanAxis('hwp_step', np.arange(4), move_time=0.37, settle_time=0.5, period=4),
+            scheduler.ScanAxis('mmw_frequency', [1., 2.], move_time=0.05, settle_time=0.5, distance=False)]
+        self.candidates = scheduler.schedules(self.axes, measure_time=0.05)
+
+    def walk(self, schedule):
+        # Time of every transition cell by cell, against which the closed form predictions are checked
+        cells = list(schedule.cells())
+        total = schedule.num_cells * schedule.measure_time
+        phases = {'measure': total}
+        for start, end in zip(cells[:-1], cells[1:]):
+            moves = [(axis, a, b) for axis, a, b in zip(self.axes, start, end) if a != b]
+            for phase, time in scheduler.transition_times(moves, parts=True).items():
+                phases[phase] = phases.get(phase, 0.) + float(time)
+        return cells, phases
+
+    def test_cells(self):
+        for schedule in self.candidates:
+            cells = list(schedule.cells())
+            self.assertEqual(len(set(cells)), schedule.num_cells)
+            self.assertEqual(len(cells), schedule.num_cells)
+
+    def test_predict(self):
+        self.assertEqual(len(self.candidates), 4 * 3 * 2 * 1 * 2 ** 3)
+        for schedule in self.candidates[::5]:
+            cells, phases = self.walk(schedule)
+            self.assertAlmostEqual(schedule.predicted_time, sum(phases.values()))
+            predicted = schedule.predict(by_phase=True)
+            for phase in phases:
+                self.assertAlmostEqual(predicted.get(phase, 0.), phases[phase])
+
+    def test_quickest_first(self):
+        times = [schedule.predicted_time for schedule in self.candidates]
+        self.assertEqual(times, sorted(times))
+
+    def test_find_schedule(self):
+        schedule = scheduler.find_schedule(self.candidates, ['y', 'x', 'hwp_step', 'mmw_frequency'], snake=['x'])
+        self.assertEqual(schedule.names[-4:], ['y', 'x', 'hwp_step', 'mmw_frequency'])
+        self.assertRaises(ValueError, scheduler.find_schedule, self.candidates, ['x', 'y'])
+
+    def test_single_values(self):
+        # Axes with a single value never move, and may be named in the order or snake or not
+        axes = [scheduler.ScanAxis(name, [0.], move_time=1.) for name in ['x', 'y', 'frequency']]
+        candidates = scheduler.schedules(axes, measure_time=0.1)
+        schedule = scheduler.find_schedule(candidates, ['y', 'x', 'frequency'], snake=['x'])
+        self.assertEqual(list(schedule.cells()), [(0, 0, 0)])
+        self.assertEqual(schedule.predict(by_phase=True), {'measure': 0.1})
+        self.assertEqual(schedule.transition((0, 0, 0), (0, 0, 0)), {'measure': 0.1, 'settle': 0.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
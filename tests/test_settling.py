@@ -0,0 +1,40 @@
+import itertools
+import unittest
+
+from xystage import settling
+
+
+class SettlerTest(unittest.TestCase):
+    def test_settles(self):
+        settler = settling.Settler(time_constant=0.001, agreements=2)
+        readings = iter([1.0, 0.5, 0.8, 0.9, 0.9, 0.9, 0.9])
+        reading, waited, settled = settler.settle(lambda: next(readings))
+        self.assertTrue(settled)
+        self.assertEqual(reading, 0.9)
+        self.assertEqual(list(settler.differences), [0.0])
+
+    def test_timeout_not_learned(self):
+        # A point that runs out of time is still settling, so its differences must not raise the noise
+        settler = settling.Settler(time_constant=0.001, max_time=0.01)
+        counter = itertools.count()
+        reading, waited, settled = settler.settle(lambda: float(next(counter)))
+        self.assertFalse(settled)
+        self.assertEqual(len(settler.differences), 0)
+        self.assertEqual(settler.noise, 0.0)
+
+    def test_nan_never_agrees(self):
+        settler = settling.Settler(time_constant=0.001, max_time=0.01)
+        reading, waited, settled = settler.settle(lambda: float('nan'))
+        self.assertFalse(settled)
+
+    def test_noise_threshold(self):
+        settler = settling.Settler(time_constant=0.001, tolerance=0.0, noise_factor=3.0)
+        settler.differences.extend([0.1] * 10)
+        readings = itertools.cycle([1.0, 1.2])
+        reading, waited, settled = settler.settle(lambda: next(readings))
+        self.assertTrue(settled)
+        self.assertAlmostEqual(settler.noise, 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+
+from xystage import emulator, stage
+
+
+class HomingTest(unittest.TestCase):
+    def connect(self, positions=(300, 200), speedup=4):
+        # Continuous homing stops on the first poll that sees the switch, and a speedup also multiplies how far the
+        # stage runs past it while the host polls, so keep it low
+        controller = emulator.L6474Controller(positions=positions, speedup=speedup)
+        self.addCleanup(controller.stop)
+        s = stage.Stage(controller.port(), cache=True)
+        s.initialize()
+        return controller, s
+
+    def home_errors(self, controller):
+        # Full steps between home and where the limit switch of each axis closes
+        return [axis.home_offset - axis.lower_limit for axis in controller.axes]
+
+    def test_stepped(self):
+        controller, s = self.connect()
+        self.assertIsNone(s.find_home(method='stepped'))
+        self.assertIsNone(s.home_repeatability)
+        self.assertEqual(tuple(s.get_position()), (0, 0))
+        for error in self.home_errors(controller):
+            self.assertLess(abs(error), 1)
+
+    def test_continuous(self):
+        controller, s = self.connect()
+        self.assertIsNone(s.find_home(method='continuous'))
+        self.assertEqual(len(s.home_repeatability), 2)
+        self.assertEqual(tuple(s.get_position()), (0, 0))
+        for error in self.home_errors(controller):
+            self.assertLess(abs(error), 4)
+        # Speeds are put back after the fine approaches
+        self.assertEqual(s.registers[(0, 'max_speed')], 400)
+
+    def test_switch_not_reached(self):
+        # A move that ends before the switch closes, e.g. a travel too short or a broken switch
+        controller, s = self.connect()
+        self.assertRaises(IOError, s.find_home, method='continuous', travel=100)
+        self.assertFalse(any(axis.is_active(controller.now()) for axis in controller.axes))
+
+    def test_unknown_method(self):
+        controller, s = self.connect()
+        self.assertRaises(ValueError, s.find_home, method='fast')
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = emulator.L6474Controller(speedup=20)
+        self.addCleanup(self.controller.stop)
+        self.stage = stage.Stage(self.controller.port(), cache=True)
+        self.stage.initialize()
+        commands = self.commands = []
+        transaction = self.stage.transport.transaction
+        self.stage.transport.transaction = lambda batch, timeout=2: (commands.extend(batch),
+                                                                     transaction(batch, timeout=timeout))[1]
+
+    def test_position_dead_reckoned(self):
+        self.stage.go_to_position(40, 30)
+        del self.commands[:]
+        self.assertEqual(self.stage.get_position(), (40, 30))
+        self.assertEqual(self.commands, [])
+        # An idle axis already at its target is not waited on
+        self.stage.go_to_position(40, 30)
+        self.assertEqual([command for command in self.commands if command.startswith('C4 ')], [])
+
+    def test_limits_snapshot(self):
+        limits = self.stage.get_limits()
+        self.assertEqual(self.stage.get_limits(), limits)
+        self.assertEqual(len([command for command in self.commands if command.startswith('C36')]), 1)
+        # Moving forgets the snapshot
+        self.stage.go_to_position(10, 10)
+        self.stage.get_limits()
+        self.assertEqual(len([command for command in self.commands if command.startswith('C36')]), 2)
+
+    def test_invalidated(self):
+        self.stage.go_to_position(40, 30)
+        self.stage.reset_home()
+        self.assertEqual(self.stage.get_position(), (0, 0))
+        self.stage.invalidate()
+        del self.commands[:]
+        self.assertEqual(self.stage.get_position(), (0, 0))
+        self.assertEqual(self.commands, ["C9 0\n", "C9 1\n"])
+
+    def test_registers(self):
+        self.stage.set_speed(100, 300, axis=0)
+        del self.commands[:]
+        self.assertEqual(self.stage.set_speed(100, 300, axis=0), (100, 300))
+        self.assertEqual(self.commands, [])
+        self.assertEqual(self.stage.registers[(0, 'max_speed')], 300)
+        self.stage.reset_stages()
+        self.assertEqual(self.stage.registers, {})
+
+
+class ThreeAxisTest(unittest.TestCase):
+    # The Triple controller
+    def setUp(self):
+        self.controller = emulator.L6474Controller(num_axes=3, positions=[0, 0, 0], speedup=20)
+        self.addCleanup(self.controller.stop)
+        self.stage = stage.Stage(self.controller.port(), cache=True, num_axes=3)
+        batches = self.batches = []
+        transaction = self.stage.transport.transaction
+        self.stage.transport.transaction = lambda batch, timeout=2: (batches.append(list(batch)),
+                                                                     transaction(batch, timeout=timeout))[1]
+
+    def test_initialize(self):
+        self.stage.initialize(max_speed=[400, 400, 600])
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual([self.stage.registers[(axis, 'max_speed')] for axis in range(3)], [400, 400, 600])
+        self.assertEqual([axis.max_speed for axis in self.controller.axes], [400, 400, 600])
+
+    def test_go_to_position(self):
+        self.stage.initialize()
+        self.stage.reset_home()
+        del self.batches[:]
+        self.stage.go_to_position(100, 400, 2000)
+        self.assertEqual(self.stage.get_position(), (100, 400, 2000))
+        self.assertEqual([axis.position(self.controller.now()) for axis in self.controller.axes], [100, 400, 2000])
+        # The moves start together with the first poll of all three axes, the polls go on until only the longest
+        # move is left, and that one is waited for with C24
+        self.assertEqual(self.batches[0], ["C12 0 100\n", "C12 1 400\n", "C12 2 2000\n",
+                                           "C4 0\n", "C4 1\n", "C4 2\n"])
+        self.assertEqual(self.batches[-1], ["C24 2\n"])
+        for batch in self.batches[1:-1]:
+            self.assertTrue(all(command.startswith('C4 ') for command in batch))
+        self.assertTrue(len(self.batches) > 2)
+
+    def test_limits(self):
+        # The first two axes keep the limits of the Dual controller, the third has none
+        self.assertEqual(self.stage.max_positions, stage.MAX_POSITIONS + [None])
+        self.assertRaises(ValueError, self.stage.go_to_position, 0, stage.MAX_POSITIONS[1] + 1, 0)
+        self.assertRaises(ValueError, self.stage.go_to_position, 0, 0, 0, 0)
+
+    def test_timeout(self):
+        self.stage.initialize()
+        self.stage.go_to_position(4000, 4000, 4000, block=False)
+        self.assertRaises(IOError, self.stage.wait_while_active, timeout=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
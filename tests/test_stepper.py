@@ -0,0 +1,66 @@
+import unittest
+
+from xystage import emulator, stepper
+
+
+class SimpleStepperTest(unittest.TestCase):
+    def connect(self, firmware_version, position=50):
+        device = emulator.HWPStepperController(position=position, speedup=20, firmware_version=firmware_version)
+        self.addCleanup(device.stop)
+        hwp = stepper.SimpleStepper(device.port())
+        commands = []
+        sendget = hwp.sendget
+        hwp.sendget = lambda command, timeout=2: (commands.append(command), sendget(command, timeout))[1]
+        return device, hwp, commands
+
+    def test_firmware_version(self):
+        for version in [1, 2]:
+            device, hwp, commands = self.connect(version)
+            hwp.initialize()
+            self.assertEqual(hwp.firmware_version, version)
+
+    def test_find_home(self):
+        for version in [1, 2]:
+            homes = []
+            for start in [50, 1, 98]:
+                device, hwp, commands = self.connect(version, position=start)
+                hwp.find_home()
+                homes.append(device.position % device.steps_per_revolution)
+                self.assertEqual((hwp.steps, hwp.switch_state), (0, 1))
+                self.assertEqual(device.step_count, 0)
+            # Home is the last step before the index switch, whichever side the search started from
+            self.assertEqual(homes, [device.steps_per_revolution - 1] * len(homes))
+
+    def test_find_home_commands(self):
+        # Each edge is one command with version 2 firmware, instead of one per step
+        counts = {}
+        for version in [1, 2]:
+            device, hwp, commands = self.connect(version)
+            hwp.find_home()
+            counts[version] = len(commands)
+        self.assertLess(counts[2], 10)
+        self.assertGreater(counts[1], 50)
+
+    def test_move(self):
+        for version in [1, 2]:
+            device, hwp, commands = self.connect(version)
+            hwp.find_home()
+            home = device.position
+            del commands[:]
+            self.assertEqual(hwp.move(37), (37, 1))
+            self.assertEqual(hwp.move(-12), (25, 1))
+            self.assertEqual(hwp.move(0), (25, 1))
+            self.assertEqual(device.position - home, 25)
+            self.assertEqual(len(commands), 2 if version == 2 else 49)
+
+    def test_find_edge(self):
+        for version in [1, 2]:
+            device, hwp, commands = self.connect(version)
+            hwp.find_home()
+            self.assertEqual(hwp.find_edge(1), (1, 0))
+            self.assertEqual(hwp.find_edge(1), (1 + device.switch_width, 1))
+            self.assertEqual(hwp.find_edge(1, max_steps=5), (6 + device.switch_width, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
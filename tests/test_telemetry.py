@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import netCDF4
+
+from xystage import telemetry
+
+
+class HistogramTest(unittest.TestCase):
+    def test_bins(self):
+        histogram = telemetry.Histogram()
+        self.assertEqual(len(histogram.counts), (telemetry.HIGH - telemetry.LOW) * telemetry.BINS_PER_DECADE)
+        # Five bins a decade from 1 us: 1.2 ms is in bin (3 + log10(1.2)) * 5 = 15.4
+        histogram.add(1.2e-3)
+        self.assertEqual(histogram.counts[15], 1)
+        self.assertTrue(histogram.edge(15) <= 1.2e-3 < histogram.edge(16))
+        self.assertAlmostEqual(histogram.edge(15), 1e-3)
+        self.assertAlmostEqual(histogram.edge(16), 10 ** -2.8)
+        # Out of range and zero durations go in the first and last bins
+        for seconds in [0, 1e-9, 5e3]:
+            histogram.add(seconds)
+        self.assertEqual((histogram.counts[0], histogram.counts[-1]), (2, 1))
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.total, 5e3 + 1.2e-3 + 1e-9)
+        self.assertEqual((histogram.min, histogram.max), (0, 5e3))
+
+    def test_quantile(self):
+        histogram = telemetry.Histogram()
+        self.assertNotEqual(histogram.quantile(0.5), histogram.quantile(0.5))
+        for k in range(90):
+            histogram.add(1.2e-3)
+        for k in range(10):
+            histogram.add(0.5)
+        # Upper edge of the bin, but never past the longest duration
+        self.assertAlmostEqual(histogram.quantile(0.5), histogram.edge(16))
+        self.assertAlmostEqual(histogram.quantile(0.9), histogram.edge(16))
+        self.assertEqual(histogram.quantile(0.99), 0.5)
+
+    def test_summary(self):
+        self.assertEqual(telemetry.Histogram().summary(), dict(count=0, total=0.0))
+        histogram = telemetry.Histogram()
+        histogram.add(1.2e-3)
+        histogram.add(1.2e-3)
+        histogram.add(3e-3)
+        summary = histogram.summary()
+        self.assertEqual((summary['count'], summary['first_bin'], summary['counts']), (3, 15, [2, 0, 1]))
+        self.assertAlmostEqual(summary['mean'], 5.4e-3 / 3)
+
+
+class TelemetryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.directory = directory
+
+    def record(self, t):
+        t.phase('move', 1.0)
+        t.phase('move', 2.0)
+        t.phase('settle', 0.5)
+        t.command('stage', 'C9', 0.01, 5, 12)
+        t.command('stage', 'C9', 0.02, 5, 12)
+        t.command('stage', 'C24', 1.0, 7, 9)
+        t.command('hwp_motor', 'increment', 0.2, 10, 30)
+
+    def test_totals(self):
+        t = telemetry.Telemetry()
+        t.start('map_1')
+        self.record(t)
+        t.point_done()
+        totals = t.totals()
+        self.assertEqual(totals['name'], 'map_1')
+        self.assertEqual(totals['points'], 1)
+        self.assertEqual(totals['phases'], {'move': 3.0, 'settle': 0.5})
+        self.assertEqual(totals['commands'], {'stage': 3, 'hwp_motor': 1})
+        self.assertEqual((totals['bytes_out'], totals['bytes_in']), ({'stage': 17, 'hwp_motor': 10},
+                                                                     {'stage': 33, 'hwp_motor': 30}))
+        summary = t.summary()
+        self.assertEqual(summary['commands']['stage C9']['count'], 2)
+        self.assertEqual(summary['phases']['move']['max'], 2.0)
+        self.assertEqual(summary['bins'], dict(low=telemetry.LOW, bins_per_decade=telemetry.BINS_PER_DECADE))
+        report = t.report()
+        self.assertTrue(report.splitlines()[0].endswith('move 3.0 s, settle 0.5 s'))
+        self.assertTrue('stage C9: 2 commands' in report)
+        # Starting again forgets everything
+        t.start('map_2')
+        self.assertEqual((t.phases, t.commands, t.points), ({}, {}, 0))
+
+    def test_write_attributes(self):
+        nc = netCDF4.Dataset(os.path.join(self.directory, 'map.nc'), mode='w')
+        self.addCleanup(nc.close)
+        group = nc.createGroup('map_1')
+        t = telemetry.Telemetry()
+        t.start('map_1')
+        self.record(t)
+        t.finish(group)
+        self.assertEqual((group.phase_time_move, group.phase_time_settle), (3.0, 0.5))
+        self.assertEqual((group.serial_commands, group.serial_bytes_out, group.serial_bytes_in), (4, 27, 63))
+        self.assertTrue(group.elapsed_time >= 0)
+        summary = json.loads(group.telemetry)
+        self.assertEqual(summary['name'], 'map_1')
+        self.assertEqual(summary['commands']['hwp_motor increment']['count'], 1)
+
+    def test_metrics_file(self):
+        filename = os.path.join(self.directory, 'metrics.jsonl')
+        t = telemetry.Telemetry(metrics_file=filename, stream_interval=0)
+        t.start('map_1')
+        self.record(t)
+        t.point_done()
+        t.phase('move', 1.0)
+        t.point_done()
+        t.finish()
+        records = [json.loads(line) for line in open(filename)]
+        self.assertEqual([record['points'] for record in records], [1, 2, 2])
+        self.assertEqual([record['phases']['move'] for record in records[:2]], [3.0, 4.0])
+        # The last record is the full summary
+        self.assertEqual(records[-1]['phases']['move']['count'], 3)
+
+    def test_stream_interval(self):
+        # Totals are only streamed once stream_interval has passed since the last ones
+        filename = os.path.join(self.directory, 'metrics.jsonl')
+        t = telemetry.Telemetry(metrics_file=filename, stream_interval=60)
+        for k in range(10):
+            t.point_done()
+        self.assertFalse(os.path.exists(filename))
+        t._last_stream -= 60
+        t.point_done()
+        t.point_done()
+        self.assertEqual(len(open(filename).readlines()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import time
+import unittest
+
+from xystage import emulator, stage, telemetry, transport
+
+
+class SilentDevice(emulator.EmulatedDevice):
+    # Takes every byte and never answers
+    def handle_char(self, char):
+        pass
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = emulator.L6474Controller(speedup=20)
+        self.addCleanup(self.controller.stop)
+        self.stage = stage.Stage(self.controller.port())
+
+    def test_replies_in_order(self):
+        # Many more bytes than the window and the controller's receive buffer, none of them lost
+        self.stage.transaction(["C12 0 1234\n", "C12 1 567\n", "C24 0\n", "C24 1\n"])
+        commands = ["C9 %d\n" % (k % 2) for k in range(40)]
+        self.assertTrue(sum(map(len, commands)) > 2 * emulator.EmulatedDevice.rx_buffer_size)
+        replies = self.stage.transaction(commands)
+        self.assertEqual([self.stage.parse_reply(reply) for reply in replies], [1234, 567] * 20)
+        self.assertEqual(self.controller.bytes_dropped, 0)
+        self.assertEqual(self.controller.commands_executed, 44)
+
+    def test_slow_command_in_window(self):
+        # Commands queued behind a wait are held back until it is answered, so the receive buffer cannot overflow
+        self.stage.transaction(["C12 0 400\n"])
+        replies = self.stage.transaction(["C24 0\n"] + ["C9 0\n"] * 30)
+        self.assertEqual(self.stage.parse_reply(replies[-1]), 400)
+        self.assertEqual(self.controller.bytes_dropped, 0)
+
+    def test_echo_checked(self):
+        # A reply to a different command, e.g. one left over from an exchange that timed out
+        transaction = self.stage.transport.transaction
+        self.stage.transport.transaction = lambda commands, timeout=2: transaction(commands[::-1], timeout=timeout)
+        self.assertRaises(ValueError, self.stage.transaction, ["C9 0\n", "C7 1\n"])
+
+    def test_telemetry(self):
+        t = self.stage.transport.telemetry = telemetry.Telemetry()
+        commands = ["C9 0\n", "C9 1\n", "C7 0\n"] * 10
+        replies = self.stage.transaction(commands)
+        self.assertEqual(t.commands[('stage', 'C9')].count, 20)
+        self.assertEqual(t.commands[('stage', 'C7')].count, 10)
+        self.assertEqual(t.bytes_out['stage'], sum(map(len, commands)))
+        self.assertEqual(t.bytes_in['stage'], sum(map(len, replies)))
+
+
+class TimeoutTest(unittest.TestCase):
+    def test_timeout(self):
+        device = SilentDevice(speedup=20)
+        self.addCleanup(device.stop)
+        t = transport.SerialTransport(device.port(), poll_interval=0.01)
+        self.assertRaises(IOError, t.transaction, ["C9 0\n", "C9 1\n"], timeout=0.1)
+
+    def test_recovers(self):
+        # After a timeout, whatever arrives late is flushed before the next exchange
+        controller = emulator.L6474Controller(speedup=20)
+        self.addCleanup(controller.stop)
+        s = stage.Stage(controller.port())
+        s.transaction(["C12 0 2000\n"])
+        self.assertRaises(IOError, s.transport.transaction, ["C24 0\n"], timeout=0.05)
+        # The move takes about 7 s at the controller's power-on acceleration, 0.35 s at speedup 20
+        time.sleep(1)
+        self.assertEqual(s.parse_reply(s.transaction(["C9 0\n"])[0]), 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
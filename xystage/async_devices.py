@@ -0,0 +1,145 @@
+"""
+Non-blocking front ends for the stage, the HWP stepper and bench instruments.
+
+Every device gets its own worker thread that owns its serial port, so calls on one device run in order while calls on
+different devices overlap. Each call returns an Operation right away; wait() on it (or gather() several) to get the
+results. The blocking Stage and SimpleStepper classes are unchanged and used underneath.
+
+Example:
+    stage = AsyncStage('/dev/ttyACM0')
+    hwp = AsyncSimpleStepper('/dev/ttyACM1')
+    lockin = AsyncDevice(Lockin(LOCKIN_SERIAL_PORT))
+    gather(stage.go_to_position(1000, 2000), hwp.increment())
+    r, theta = lockin.snap(3, 4).wait()
+"""
+import Queue
+import sys
+import threading
+
+import stage
+import stepper
+
+
+class Operation(object):
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError("Operation did not finish within %s s" % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+def gather(*operations, **kwargs):
+    timeout = kwargs.get('timeout')
+    return [operation.wait(timeout) for operation in operations]
+
+
+class DeviceWorker(object):
+    def __init__(self, name='device', maxsize=0):
+        # With maxsize > 0, submit blocks while that many calls are waiting, which bounds the work held in memory
+        self._queue = Queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            operation, function, args, kwargs = item
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                operation._finish(exc_info=sys.exc_info())
+            else:
+                operation._finish(result)
+
+    def submit(self, function, *args, **kwargs):
+        operation = Operation()
+        self._queue.put((operation, function, args, kwargs))
+        return operation
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class AsyncDevice(object):
+    """
+    Wraps any blocking device object: calling one of its methods through the wrapper queues the call on the
+    device's worker and returns an Operation. Plain attributes are passed through.
+    """
+    def __init__(self, device, name=None):
+        self.device = device
+        self.worker = DeviceWorker(name or type(device).__name__)
+
+    def call(self, method, *args, **kwargs):
+        return self.worker.submit(getattr(self.device, method), *args, **kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.device, name)
+        if not callable(attribute):
+            return attribute
+
+        def submit(*args, **kwargs):
+            return self.worker.submit(attribute, *args, **kwargs)
+        return submit
+
+    def close(self):
+        self.worker.close()
+
+
+class AsyncStage(AsyncDevice):
+    """
+    A Stage, or a new one on port, behind a worker. Its methods are forwarded by AsyncDevice; e.g. go_to_position
+    with block=True returns an Operation that finishes when the move has, while other devices keep running.
+    """
+    def __init__(self, port=stage.default_port, **kwargs):
+        if isinstance(port, stage.Stage):
+            device = port
+        else:
+            device = stage.Stage(port, **kwargs)
+        super(AsyncStage, self).__init__(device, name='stage')
+
+
+class AsyncSimpleStepper(AsyncDevice):
+    """
+    A SimpleStepper, or a new one on port, behind a worker. Its methods are forwarded by AsyncDevice.
+    """
+    def __init__(self, port='/dev/ttyACM1'):
+        if isinstance(port, stepper.SimpleStepper):
+            device = port
+        else:
+            device = stepper.SimpleStepper(port)
+        super(AsyncSimpleStepper, self).__init__(device, name='hwp_motor')
+
+    def get_state(self):
+        # state is a property, which AsyncDevice would read right away rather than on the worker
+        return self.worker.submit(lambda: self.device.state)
@@ -0,0 +1,171 @@
+"""
+What the xy stage mapper (mapper.Mapper) and the HWP mapper (map_hwp.Mapper) share: the live feed and telemetry,
+homing checks, settling modes, the preparation of resume, and the loop of do_scheduled_map.
+
+A subclass sets self.stage, self.lockin and self.lockin_time_constant, and provides _prepare(frequencies), which
+homes the stage (and whatever else must be homed) unless _have_found_home, and gets the source ready for the
+frequencies given.
+"""
+import time
+
+import numpy as np
+
+import livefeed
+import mapwriter
+import motion
+import pathplan
+import scheduler
+import settling
+import telemetry
+
+
+class BaseMapper(object):
+    # What a map visits the cells of, for messages
+    point_name = 'points'
+
+    def __init__(self, live_address=None, metrics_file=None):
+        # With a live_address, e.g. livefeed.DEFAULT_ADDRESS, readings are published there for mapview.LiveMapViewer.
+        # Only one mapper at a time can publish at an address.
+        # Where the time of each map goes is written to its group attributes and, if given, to metrics_file, see
+        # telemetry.Telemetry.
+        if live_address is None:
+            self.feed = None
+        else:
+            self.feed = livefeed.Publisher(live_address)
+        self.telemetry = telemetry.Telemetry(metrics_file)
+        self._have_found_home = False
+
+    def _begin_map(self, mapfile, description, scan_mode, settle_mode='fixed', max_settle_time=None, **attributes):
+        # Record how the map is taken in its group and return its settler, see _settler; settle_mode=None for scans
+        # that do not wait to settle
+        mapfile.group.description = description
+        mapfile.group.scan_mode = scan_mode
+        for name, value in attributes.items():
+            setattr(mapfile.group, name, value)
+        self.mapfile = mapfile
+        if settle_mode is None:
+            return None
+        return self._settler(mapfile, settle_mode, max_settle_time)
+
+    def _start_feed(self, mapfile, z=None):
+        if self.feed is not None:
+            self.feed.start_map(livefeed.map_header(mapfile), z)
+
+    def _finish_map(self, mapfile):
+        # Also on errors, so whatever was measured ends up in the file
+        mapfile.writer.close()
+        self._telemetry_summary(mapfile)
+        if self.feed is not None:
+            self.feed.end_map()
+
+    def _verify_home(self):
+        # A USB reset or power cycle of the controller loses its position; home again if it disagrees with ours
+        if not self._have_found_home:
+            return
+        expected = list(self.stage.positions)
+        self.stage.invalidate()
+        position = self.stage.get_position()
+        if None not in expected and max(abs(np.array(position) - expected)) > 1:
+            print "stage at %s instead of %s, homing again" % (position, expected)
+            self._have_found_home = False
+
+    def _settler(self, mapfile, settle_mode, max_settle_time=None):
+        # None for fixed settle times; the mode is recorded in mapfile, if given, so resume can use it again
+        if settle_mode == 'fixed':
+            settler = None
+        elif settle_mode == 'adaptive':
+            settler = settling.Settler(self.lockin_time_constant, max_time=max_settle_time)
+        else:
+            raise ValueError("Unknown settle mode %r, must be 'fixed' or 'adaptive'" % settle_mode)
+        if mapfile is not None:
+            mapfile.group.settle_mode = settle_mode
+            if settler is not None:
+                mapfile.group.max_settle_time = settler.max_time
+        return settler
+
+    def _telemetry_summary(self, mapfile):
+        self.telemetry.finish(mapfile.group)
+        print self.telemetry.report()
+
+    def _prepare_resume(self, mapfile, frequencies, plan=True):
+        """
+        Get ready to finish mapfile, an interrupted do_simple_map or do_scheduled_map opened for appending: recover
+        the readings left in its crash journal, home again if needed and _prepare for the source frequencies. Returns
+        todo, the boolean array of the cells with no reading or a NaN one, the (x_index, y_index) points to visit,
+        in the order pathplan.plan_path predicts is quickest from where the stage is (serpentine with plan=False),
+        and the settler the map was taken with. points is empty, and nothing is prepared, if no cell is left.
+        """
+        if getattr(mapfile.group, 'scan_mode', 'simple') not in ['simple', 'scheduled']:
+            raise ValueError("Only maps from do_simple_map or do_scheduled_map can be resumed, not %s scans"
+                             % mapfile.group.scan_mode)
+        self.mapfile = mapfile
+        recovered = mapwriter.replay_journal(mapfile.nc, mapfile.group)
+        if recovered:
+            print "recovered %d readings from the journal" % recovered
+        todo = mapwriter.missing_cells(mapfile.group)
+        xsteps = mapfile.x[:]
+        ysteps = mapfile.y[:]
+        points = [(x, y) for (x, y) in pathplan.serpentine_points(xsteps, ysteps) if todo[x, y].any()]
+        print "%d of %d cells left to measure at %d %s" % (todo.sum(), todo.size, len(points), self.point_name)
+        if not points:
+            return todo, points, None
+        self._verify_home()
+        self._prepare(frequencies[:])
+        if plan and len(points) > 1:
+            model = motion.StageMotionModel.from_stage(self.stage)
+            points = pathplan.plan_path(points, xsteps, ysteps, model, start=self.stage.get_position()).points
+        self._start_feed(mapfile, mapfile.z[:])
+        settler = self._settler(None, getattr(mapfile.group, 'settle_mode', 'fixed'),
+                                getattr(mapfile.group, 'max_settle_time', None))
+        return todo, points, settler
+
+    def _choose_schedule(self, mapfile, axes, measure_time, reference, order=None):
+        # The quickest schedule of axes, or the one nesting them in order; the predicted time of each is printed
+        # next to that of reference, the order do_simple_map uses. The choice is recorded in mapfile.
+        candidates = scheduler.schedules(axes, measure_time)
+        scheduler.report(candidates, scheduler.find_schedule(candidates, reference, snake=['x']))
+        if order is None:
+            schedule = candidates[0]
+        else:
+            schedule = scheduler.find_schedule(candidates, order)
+        print "scanning", schedule
+        mapfile.group.loop_order = ','.join(schedule.names)
+        mapfile.group.snake = ','.join([name for name, snake in zip(schedule.names, schedule.snake) if snake])
+        mapfile.group.predicted_time = schedule.predicted_time
+        return schedule
+
+    def _run_schedule(self, mapfile, schedule, measure, flush_interval=10.0):
+        """
+        Visit the cells of schedule, whose first two axes are the stage x and y indices of mapfile. The stage is
+        moved where needed, then measure(index, moved, predicted, timer) does the rest at each cell: moved lists the
+        axes that changed since the last cell (all of them at the first), predicted is the time schedule predicts for
+        each phase of the transition, and timer is the motion.ScanTimer to record those phases in.
+        """
+        xsteps = mapfile.x[:]
+        ysteps = mapfile.y[:]
+        self._start_feed(mapfile)
+        mapfile.open_writer(flush_interval=flush_interval, telemetry=self.telemetry)
+        innermost = schedule.order[-1]
+        previous = None
+        timer = motion.ScanTimer(schedule.predict(by_phase=True), schedule.num_cells, telemetry=self.telemetry)
+        self.telemetry.start(mapfile.group.name)
+        timer.start()
+        try:
+            for index in schedule.cells():
+                if previous is None:
+                    moved = range(len(index))
+                    predicted = dict((phase, 0.) for phase in timer.predicted)
+                else:
+                    moved = [k for k in range(len(index)) if index[k] != previous[k]]
+                    predicted = schedule.transition(previous, index)
+                if 0 in moved or 1 in moved:
+                    tic = time.time()
+                    self.stage.go_to_position(xsteps[index[0]], ysteps[index[1]])
+                    timer.record('stage', time.time() - tic, predicted.get('stage', 0.))
+                measure(index, moved, predicted, timer)
+                previous = index
+                timer.point_done()
+                if moved != [innermost]:
+                    timer.report()
+        finally:
+            self._finish_map(mapfile)
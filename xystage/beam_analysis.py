@@ -0,0 +1,379 @@
+"""
+Fit a 2D Gaussian beam to every frequency plane, and every HWP step, of a batch of map files from mapper or map_hwp,
+and collect the centroids, FWHM and ellipticity in a summary table, along with how the beam amplitude of HWP maps is
+modulated by the HWP angle.
+
+z is read a block of frequencies at a time, all HWP steps together, and the planes of a block are fitted at once by
+vectorized least squares: a weighted linear fit of a quadratic to log(z) for the starting point, then
+Levenberg-Marquardt iterations on the Gaussian plus an offset. Blocks are fitted by a pool of processes. The results
+for each file are cached in the output directory along with the size and modification time of the file, so files
+that have not changed since the last run are not read again.
+
+Positions and widths are in stage steps, like x and y in the files; angles are in degrees, that of the major axis
+counterclockwise from x.
+
+Example:
+    python beam_analysis.py '/data/readout/hwp_mapping/*.nc' --output /data/readout/beam_summary
+"""
+import argparse
+import csv
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import netCDF4
+import numpy as np
+
+# Bump when the fits change, so cached results are not reused
+ANALYSIS_VERSION = 2
+
+FWHM_PER_SIGMA = 2 * np.sqrt(2 * np.log(2))
+
+FIT_COLUMNS = ['file', 'group', 'frequency', 'hwp_step', 'amplitude', 'x0', 'y0', 'fwhm', 'fwhm_major', 'fwhm_minor',
+               'angle', 'ellipticity', 'offset', 'rms_residual', 'pixels', 'converged']
+MODULATION_COLUMNS = ['file', 'group', 'frequency', 'mean_amplitude', 'modulation_2', 'angle_2', 'modulation_4',
+                      'angle_4', 'hwp_steps']
+
+
+def _design(u, v):
+    return np.array([np.ones_like(u), u, v, u * u, u * v, v * v]).T
+
+
+def initial_guess(u, v, z, valid, threshold=0.2):
+    """
+    Parameters (amplitude, u0, v0, a, b, c, offset) of a Gaussian amplitude * exp(-(a du^2 + 2 b du dv + c dv^2) / 2)
+    + offset for each row of z, sampled at u, v, from a fit of a quadratic to the log of the samples above threshold
+    of the peak, weighted by their square. Planes where that fails start from their peak instead.
+    """
+    samples = np.where(valid, z, np.nan)
+    samples[~valid.any(axis=1)] = 0
+    offset = np.nanpercentile(samples, 10, axis=1)
+    signal = z - offset[:, None]
+    peak = np.where(valid, signal, -np.inf).max(axis=1)
+    use = valid & (signal > threshold * peak[:, None]) & (signal > 0)
+    weights = np.where(use, signal, 0.) ** 2
+    logs = np.log(np.where(use, signal, 1.))
+    design = _design(u, v)
+    normal = np.einsum('nm,mi,mj->nij', weights, design, design)
+    normal += 1e-12 * (1 + normal.max(axis=(1, 2)))[:, None, None] * np.eye(6)
+    coefficients = np.linalg.solve(normal, np.einsum('nm,mi,nm->ni', weights, design, logs)[..., None])[..., 0]
+    a, b, c = -2 * coefficients[:, 3], -coefficients[:, 4], -2 * coefficients[:, 5]
+    det = a * c - b * b
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        u0 = (c * coefficients[:, 1] - b * coefficients[:, 2]) / det
+        v0 = (a * coefficients[:, 2] - b * coefficients[:, 1]) / det
+        amplitude = np.exp(coefficients[:, 0] + 0.5 * (a * u0 * u0 + 2 * b * u0 * v0 + c * v0 * v0))
+        good = ((use.sum(axis=1) >= 6) & (a > 0) & (c > 0) & (det > 0) & (abs(u0) < 1.5) & (abs(v0) < 1.5) &
+                np.isfinite(amplitude))
+    brightest = np.where(valid, signal, -np.inf).argmax(axis=1)
+    params = np.array([np.where(good, amplitude, np.maximum(peak, 0)),
+                       np.where(good, u0, u[brightest]), np.where(good, v0, v[brightest]),
+                       np.where(good, a, 1 / 0.3 ** 2), np.where(good, b, 0.), np.where(good, c, 1 / 0.3 ** 2),
+                       offset]).T
+    params[~np.isfinite(params)] = 0
+    return params
+
+
+def _model(params, u, v):
+    du = u[None] - params[:, 1:2]
+    dv = v[None] - params[:, 2:3]
+    g = np.exp(-0.5 * (params[:, 3:4] * du * du + 2 * params[:, 4:5] * du * dv + params[:, 5:6] * dv * dv))
+    return params[:, 0:1] * g + params[:, 6:7], g, du, dv
+
+
+def _cost(params, u, v, z, valid):
+    residual = np.where(valid, z - _model(params, u, v)[0], 0.)
+    cost = (residual * residual).sum(axis=1)
+    # Only beams that fall off in every direction
+    positive = (params[:, 3] > 0) & (params[:, 5] > 0) & (params[:, 3] * params[:, 5] > params[:, 4] ** 2)
+    return np.where(positive, cost, np.inf)
+
+
+def fit_gaussians(x, y, planes, max_iterations=50, tolerance=1e-6):
+    """
+    Fit a 2D Gaussian plus offset to each of planes, an (n, len(x), len(y)) array with NaN where there is no reading.
+    Returns a dictionary of arrays of length n: amplitude, x0, y0, sigma_major, sigma_minor, angle, offset,
+    rms_residual, pixels (readings used) and converged. A fit has converged once an iteration lowers the sum of
+    squared residuals by no more than tolerance of it.
+    """
+    x = np.asarray(x, dtype=np.float)
+    y = np.asarray(y, dtype=np.float)
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    # Fit in coordinates running from -1 to 1 across the map, which keeps the normal equations well conditioned
+    centre = np.array([(x.max() + x.min()) / 2., (y.max() + y.min()) / 2.])
+    scale = np.maximum([(x.max() - x.min()) / 2., (y.max() - y.min()) / 2.], 1.)
+    u = ((X - centre[0]) / scale[0]).ravel()
+    v = ((Y - centre[1]) / scale[1]).ravel()
+    z = np.asarray(planes, dtype=np.float).reshape(len(planes), -1)
+    valid = np.isfinite(z)
+    z = np.where(valid, z, 0.)
+    params = initial_guess(u, v, z, valid)
+    cost = _cost(params, u, v, z, valid)
+    damping = np.full(len(z), 1e-3)
+    done = valid.sum(axis=1) < 7
+    for iteration in range(max_iterations):
+        active = np.flatnonzero(~done)
+        if not len(active):
+            break
+        p, zk, vk = params[active], z[active], valid[active]
+        model, g, du, dv = _model(p, u, v)
+        residual = np.where(vk, zk - model, 0.)
+        ag = p[:, 0:1] * g
+        jacobian = np.array([g, ag * (p[:, 3:4] * du + p[:, 4:5] * dv), ag * (p[:, 4:5] * du + p[:, 5:6] * dv),
+                             -0.5 * ag * du * du, -ag * du * dv, -0.5 * ag * dv * dv, np.ones_like(g)])
+        jacobian = np.where(vk[None], jacobian, 0.).transpose(1, 2, 0)
+        jtj = np.einsum('nmi,nmj->nij', jacobian, jacobian)
+        jtr = np.einsum('nmi,nm->ni', jacobian, residual)
+        diagonal = np.einsum('nii->ni', jtj)
+        ridge = damping[active, None] * diagonal + 1e-12 * (1 + diagonal.max(axis=1))[:, None]
+        damped = jtj + ridge[:, :, None] * np.eye(7)
+        trial = p + np.linalg.solve(damped, jtr[..., None])[..., 0]
+        trial_cost = _cost(trial, u, v, zk, vk)
+        better = trial_cost < cost[active]
+        improvement = np.where(better, cost[active] - trial_cost, 0.)
+        params[active] = np.where(better[:, None], trial, p)
+        damping[active] = np.where(better, damping[active] / 3., damping[active] * 4.)
+        done[active] = ((better & (improvement <= tolerance * cost[active])) | (damping[active] > 1e8) |
+                        (cost[active] == 0))
+        cost[active] = np.where(better, trial_cost, cost[active])
+
+    # Covariance of the Gaussian in stage steps, then its principal axes
+    a, b, c = params[:, 3], params[:, 4], params[:, 5]
+    det = a * c - b * b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cxx = c / det * scale[0] ** 2
+        cyy = a / det * scale[1] ** 2
+        cxy = -b / det * scale[0] * scale[1]
+        spread = np.sqrt(((cxx - cyy) / 2.) ** 2 + cxy ** 2)
+        sigma_major = np.sqrt((cxx + cyy) / 2. + spread)
+        sigma_minor = np.sqrt((cxx + cyy) / 2. - spread)
+    pixels = valid.sum(axis=1)
+    converged = (done & np.isfinite(cost) & (pixels >= 7) & (abs(params[:, 1]) <= 1) & (abs(params[:, 2]) <= 1) &
+                 (params[:, 0] > 0))
+    return dict(amplitude=params[:, 0], x0=centre[0] + scale[0] * params[:, 1], y0=centre[1] + scale[1] * params[:, 2],
+                sigma_major=sigma_major, sigma_minor=sigma_minor,
+                angle=np.degrees(0.5 * np.arctan2(2 * cxy, cxx - cyy)), offset=params[:, 6],
+                rms_residual=np.sqrt(cost / np.maximum(pixels, 1)), pixels=pixels, converged=converged)
+
+
+def hwp_modulation(angles, amplitudes):
+    """
+    Fit amplitude = m0 (1 + m2 cos(2 (angle - angle_2)) + m4 cos(4 (angle - angle_4))), angles in radians of HWP
+    rotation, and return m0, m2, angle_2, m4 and angle_4, the angles in degrees.
+    """
+    design = np.array([np.ones_like(angles), np.cos(2 * angles), np.sin(2 * angles), np.cos(4 * angles),
+                       np.sin(4 * angles)]).T
+    m = np.linalg.lstsq(design, amplitudes, rcond=None)[0]
+    return (m[0], np.hypot(m[1], m[2]) / m[0], np.degrees(np.arctan2(m[2], m[1]) / 2), np.hypot(m[3], m[4]) / m[0],
+            np.degrees(np.arctan2(m[4], m[3]) / 4))
+
+
+def _coordinate(group, dimension, size):
+    if dimension in group.variables:
+        return np.asarray(group.variables[dimension][:size], dtype=np.float)
+    return np.arange(size, dtype=np.float)
+
+
+def map_groups(nc):
+    # Every map group holding z on an (x, y, ...) grid
+    return [name for name in sorted(nc.groups) if name.startswith('map_') and 'z' in nc.groups[name].variables and
+            nc.groups[name].variables['z'].ndim >= 3]
+
+
+def plan_tasks(filename, planes_per_task=2000):
+    """
+    (filename, group, start, stop) for blocks of the frequencies of each map in filename, the last dimension of z,
+    with about planes_per_task planes each.
+    """
+    nc = netCDF4.Dataset(filename, mode='r')
+    try:
+        tasks = []
+        for name in map_groups(nc):
+            shape = nc.groups[name].variables['z'].shape
+            block = max(1, planes_per_task // max(int(np.prod(shape[2:-1])), 1))
+            tasks += [(filename, name, start, min(start + block, shape[-1])) for start in range(0, shape[-1], block)]
+        return tasks
+    finally:
+        nc.close()
+
+
+def fit_block(filename, group_name, start, stop, max_iterations=50):
+    """
+    Fit every plane of frequencies start to stop of a map, for every HWP step of map_hwp files. Returns a row of
+    FIT_COLUMNS for each, hwp_step None for maps without one.
+    """
+    nc = netCDF4.Dataset(filename, mode='r')
+    try:
+        group = nc.groups[group_name]
+        z = group.variables['z']
+        shape = z.shape
+        x = _coordinate(group, 'x', shape[0])
+        y = _coordinate(group, 'y', shape[1])
+        frequencies = _coordinate(group, z.dimensions[-1], shape[-1])[start:stop]
+        if z.ndim == 4:
+            hwp_steps = _coordinate(group, z.dimensions[2], shape[2])
+        else:
+            hwp_steps = [None]
+        block = np.ma.filled(z[..., start:stop].astype(np.float), np.nan)
+    finally:
+        nc.close()
+    # One plane per (HWP step, frequency), the frequency changing fastest
+    planes = np.moveaxis(block.reshape(shape[:2] + (-1,)), -1, 0)
+    fits = fit_gaussians(x, y, planes, max_iterations=max_iterations)
+    rows = []
+    for k, (hwp_step, frequency) in enumerate(itertools.product(hwp_steps, frequencies)):
+        sigma = np.sqrt(fits['sigma_major'][k] * fits['sigma_minor'][k])
+        rows.append([os.path.basename(filename), group_name, float(frequency), hwp_step,
+                     float(fits['amplitude'][k]), float(fits['x0'][k]), float(fits['y0'][k]),
+                     float(FWHM_PER_SIGMA * sigma), float(FWHM_PER_SIGMA * fits['sigma_major'][k]),
+                     float(FWHM_PER_SIGMA * fits['sigma_minor'][k]), float(fits['angle'][k]),
+                     float(1 - fits['sigma_minor'][k] / fits['sigma_major'][k]), float(fits['offset'][k]),
+                     float(fits['rms_residual'][k]), int(fits['pixels'][k]), bool(fits['converged'][k])])
+    return rows
+
+
+def _fit_task(arguments):
+    # Runs in the pool; errors come back as a message so one bad file does not stop the batch
+    task, max_iterations = arguments
+    try:
+        return task, fit_block(*task, max_iterations=max_iterations), None
+    except Exception, e:
+        return task, [], '%s: %s' % (type(e).__name__, e)
+
+
+def modulation_rows(fits, steps_per_revolution=100):
+    """
+    A row of MODULATION_COLUMNS for each map and frequency with converged fits at five or more HWP steps.
+    """
+    amplitudes = {}
+    for row in fits:
+        if row[3] is not None and row[-1]:
+            amplitudes.setdefault(tuple(row[:3]), []).append((row[3], row[4]))
+    rows = []
+    for key in sorted(amplitudes):
+        steps, amplitude = np.array(amplitudes[key]).T
+        if len(steps) >= 5:
+            angles = 2 * np.pi * steps / steps_per_revolution
+            rows.append(list(key) + [float(value) for value in hwp_modulation(angles, amplitude)] + [len(steps)])
+    return rows
+
+
+def expand(patterns):
+    # Directories stand for the netCDF files in them
+    filenames = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.nc')
+        filenames += glob.glob(os.path.expanduser(pattern))
+    return sorted(set(os.path.abspath(filename) for filename in filenames))
+
+
+def _cache_filename(cache_dir, filename):
+    return os.path.join(cache_dir, hashlib.sha1(filename).hexdigest() + '.json')
+
+
+def _signature(filename, settings):
+    status = os.stat(filename)
+    return dict(size=status.st_size, mtime=status.st_mtime, settings=settings)
+
+
+def write_table(filename, columns, rows):
+    with open(filename, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(['' if value is None else value for value in row])
+
+
+def analyse(patterns, output, processes=None, planes_per_task=2000, max_iterations=50, steps_per_revolution=100,
+            force=False):
+    """
+    Fit the maps in the files matching patterns (file names, globs or directories) and write the fits of every
+    plane to output/beam_fits.csv and the HWP modulation of every frequency to output/hwp_modulation.csv. Files
+    whose size and modification time match those cached in output/cache from an earlier run are not read again,
+    unless force. processes=1 fits in this process instead of a pool.
+    """
+    cache_dir = os.path.join(output, 'cache')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    settings = dict(version=ANALYSIS_VERSION, max_iterations=max_iterations, steps_per_revolution=steps_per_revolution)
+    filenames = expand(patterns)
+    results = {}
+    tasks = []
+    for filename in filenames:
+        cache_filename = _cache_filename(cache_dir, filename)
+        signature = _signature(filename, settings)
+        if not force and os.path.exists(cache_filename):
+            cached = json.load(open(cache_filename))
+            if cached['signature'] == signature:
+                results[filename] = cached
+                continue
+        try:
+            tasks += plan_tasks(filename, planes_per_task)
+        except (IOError, RuntimeError), e:
+            print "skipping %s: %s" % (filename, e)
+            continue
+        results[filename] = dict(signature=signature, fits=[], modulation=[], errors=[])
+    print "%d files, %d unchanged since the last run, %d blocks to fit" % (len(filenames), len(filenames) -
+                                                                           len(set(task[0] for task in tasks)),
+                                                                           len(tasks))
+    remaining = {}
+    for task in tasks:
+        remaining[task[0]] = remaining.get(task[0], 0) + 1
+    tic = time.time()
+    pool = None
+    if processes != 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes)
+        outcomes = pool.imap_unordered(_fit_task, [(task, max_iterations) for task in tasks])
+    else:
+        outcomes = itertools.imap(_fit_task, [(task, max_iterations) for task in tasks])
+    try:
+        for task, rows, error in outcomes:
+            filename = task[0]
+            result = results[filename]
+            result['fits'] += rows
+            if error is not None:
+                print "failed to fit %s %s frequencies %d to %d: %s" % (task[:4] + (error,))
+                result['errors'].append(error)
+            remaining[filename] -= 1
+            if not remaining[filename]:
+                result['fits'].sort(key=lambda row: (row[1], row[2], row[3]))
+                result['modulation'] = modulation_rows(result['fits'], steps_per_revolution)
+                # A file that failed is tried again next time
+                if not result['errors']:
+                    with open(_cache_filename(cache_dir, filename), 'w') as f:
+                        json.dump(result, f)
+                print "%s: %d planes fitted, %d converged, %.1f s so far" % (
+                    os.path.basename(filename), len(result['fits']), sum([row[-1] for row in result['fits']]),
+                    time.time() - tic)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    fits = [row for filename in filenames if filename in results for row in results[filename]['fits']]
+    modulation = [row for filename in filenames if filename in results for row in results[filename]['modulation']]
+    write_table(os.path.join(output, 'beam_fits.csv'), FIT_COLUMNS, fits)
+    write_table(os.path.join(output, 'hwp_modulation.csv'), MODULATION_COLUMNS, modulation)
+    return fits, modulation
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit 2D Gaussian beams to every plane of a batch of map files.")
+    parser.add_argument('inputs', nargs='+', help="map files, globs or directories of .nc files")
+    parser.add_argument('--output', required=True, help="directory for the summary tables and the cache")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes, by default one per CPU")
+    parser.add_argument('--planes-per-task', type=int, default=2000, help="planes fitted together in each task")
+    parser.add_argument('--max-iterations', type=int, default=50, help="Levenberg-Marquardt iterations per fit")
+    parser.add_argument('--steps-per-revolution', type=float, default=100, help="HWP steps in a full turn")
+    parser.add_argument('--force', action='store_true', help="fit every file again, changed or not")
+    args = parser.parse_args(argv)
+    analyse(args.inputs, args.output, processes=args.processes, planes_per_task=args.planes_per_task,
+            max_iterations=args.max_iterations, steps_per_revolution=args.steps_per_revolution, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
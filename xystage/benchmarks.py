@@ -0,0 +1,445 @@
+"""
+Benchmarks that run against the emulated controllers in emulator.py, so no hardware is needed.
+
+Times are reported in device seconds (wall time multiplied by the emulator speedup), except for the map file
+benchmarks, which run against a temporary netCDF file and report wall time. The host's own overhead is multiplied by
+the speedup too, so benchmarks that are mostly serial traffic, short moves or polling (homing) run the emulator in
+real time.
+
+Run as a script to run them all and save the results as JSON, and compare two such files to see what got slower:
+    python benchmarks.py --output before.json
+    python benchmarks.py --output after.json --compare before.json
+    python benchmarks.py --compare before.json after.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import netCDF4
+import numpy as np
+
+import emulator
+import mapwriter
+import motion
+import stage
+import telemetry
+
+
+def benchmark_commands(count=200, speedup=1):
+    """
+    Rate of position queries (C9) one at a time through Stage.sendget and pipelined through Stage.transaction, and
+    the median round trip of a single one.
+    """
+    ctrl = emulator.L6474Controller(speedup=speedup)
+    s = stage.Stage(ctrl.port())
+    try:
+        latencies = []
+        for k in range(count):
+            tic = time.time()
+            s.sendget("C9 0\n")
+            latencies.append((time.time() - tic) * speedup)
+        sendget_time = sum(latencies)
+        tic = time.time()
+        s.transaction(["C9 0\n"] * count)
+        transaction_time = (time.time() - tic) * speedup
+    finally:
+        ctrl.stop()
+    return dict(commands=count, sendget_rate=count / sendget_time, transaction_rate=count / transaction_time,
+                latency=float(np.median(latencies)))
+
+
+def benchmark_moves(distances=(10, 100, 1000), repeats=3, speedup=1):
+    """
+    Time from go_to_position to the end of wait_while_active for moves of both axes over each distance (steps),
+    along with what motion.StageMotionModel predicts for them.
+    """
+    ctrl = emulator.L6474Controller(speedup=speedup)
+    s = stage.Stage(ctrl.port(), cache=True)
+    results = []
+    try:
+        s.initialize()
+        s.reset_home()
+        model = motion.StageMotionModel.from_stage(s)
+        for distance in distances:
+            durations = []
+            for k in range(repeats):
+                # Out and back, so every repeat starts from home
+                for target in [distance, 0]:
+                    tic = time.time()
+                    s.go_to_position(target, target, block=False)
+                    s.wait_while_active()
+                    durations.append((time.time() - tic) * speedup)
+            results.append(dict(distance=distance, duration=float(np.median(durations)), max_duration=max(durations),
+                                predicted=model.move_time((0, 0), (distance, distance))))
+    finally:
+        ctrl.stop()
+    return results
+
+
+def benchmark_homing(method, speedup=1, positions=(1500, 1000), repeats=1):
+    """
+    Time, commands and home error of Stage.find_home from positions (steps). Continuous homing stops on the first
+    poll that sees the switch, so any speedup also multiplies how far past it the stage runs while the host polls.
+    """
+    results = []
+    for k in range(repeats):
+        ctrl = emulator.L6474Controller(positions=positions, speedup=speedup)
+        s = stage.Stage(ctrl.port(), cache=True)
+        try:
+            s.initialize()
+            tic = time.time()
+            s.find_home(method=method)
+            elapsed = (time.time() - tic) * speedup
+            # Distance between where the stage thinks home is and where the switch actually closes, in full steps
+            errors = [axis.home_offset - axis.lower_limit for axis in ctrl.axes]
+        finally:
+            ctrl.stop()
+        results.append(dict(method=method, duration=elapsed, home_error=errors, repeatability=s.home_repeatability,
+                            commands=ctrl.commands_executed, speedup=speedup))
+    return results
+
+
+def benchmark_map_storage(profile, shape=(22, 22, 100, 50), noise=1e-3, repeats=20):
+    """
+    Write a synthetic HWP map of shape (x, y, hwp_step, mmw_frequency) one pixel at a time, as map_hwp does, with
+    the given storage profile, then time reading single frequency planes and single pixel spectra from it.
+    """
+    name = profile
+    profile = mapwriter.storage_profile(profile)
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'map.nc')
+    try:
+        nc = netCDF4.Dataset(filename, mode='w')
+        group = nc.createGroup('map')
+        dimensions = ('x', 'y', 'hwp_step', 'mmw_frequency')
+        for dimension, size in zip(dimensions, shape):
+            if dimension == 'y' and profile.unlimited:
+                size = None
+            group.createDimension(dimension, size)
+        group.createVariable('y', np.float, dimensions=('y',))[:] = np.arange(shape[1])
+        z = profile.create_variable(group, 'z', dimensions)
+        # A Gaussian beam modulated by the HWP angle, plus readout noise
+        x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+        beam = np.exp(-((x - shape[0] / 2.) ** 2 + (y - shape[1] / 2.) ** 2) / (2 * (shape[0] / 6.) ** 2))
+        modulation = 1 + 0.5 * np.cos(4 * np.pi * np.arange(shape[2]) / shape[2])[:, None] * np.ones(shape[3])
+        tic = time.time()
+        for i in range(shape[0]):
+            for j in range(shape[1]):
+                z[i, j] = beam[i, j] * modulation + noise * np.random.randn(*shape[2:])
+            nc.sync()
+        write_time = time.time() - tic
+        nc.close()
+        file_size = os.path.getsize(filename)
+
+        z = netCDF4.Dataset(filename).groups['map'].variables['z']
+        tic = time.time()
+        for k in range(repeats):
+            z[:, :, np.random.randint(shape[2]), np.random.randint(shape[3])]
+        image_read = (time.time() - tic) / repeats
+        tic = time.time()
+        for k in range(repeats):
+            z[np.random.randint(shape[0]), np.random.randint(shape[1])]
+        spectrum_read = (time.time() - tic) / repeats
+    finally:
+        shutil.rmtree(directory)
+    return dict(profile=name, file_size=file_size, write_time=write_time, image_read=image_read,
+                spectrum_read=spectrum_read)
+
+
+@contextlib.contextmanager
+def quiet():
+    # The mappers print every reading
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def emulated_mapper(speedup=1, peak=1e-3, width=500., centre=(1000, 800), noise=1e-6):
+    """
+    A mapper.Mapper with an emulated stage and lockin, which sees a Gaussian beam of peak volts and width steps
+    (standard deviation) centred on centre. Returns the mapper and the stage controller, to stop once done.
+    """
+    import mapper
+    ctrl = emulator.L6474Controller(speedup=speedup)
+
+    class EmulatedMapper(mapper.Mapper):
+        def __init__(self):
+            self.feed = None
+            self.telemetry = telemetry.Telemetry()
+            self.stage = stage.Stage(ctrl.port(), cache=True)
+            self.stage.transport.telemetry = self.telemetry
+            self.stage.initialize()
+            self.stage.reset_home()
+            self.lockin = emulator.SR830Lockin(self.beam, noise=noise, speedup=speedup)
+            self.lockin_time_constant = self.lockin.time_constant
+            self.hittite = None
+            self._have_found_home = True
+
+        def beam(self):
+            x, y = self.stage.positions
+            return peak * np.exp(-((x - centre[0]) ** 2 + (y - centre[1]) ** 2) / (2. * width ** 2))
+    return EmulatedMapper(), ctrl
+
+
+# Representative do_simple_map settings, by name
+SCAN_CONFIGURATIONS = [
+    ('fixed', dict(settle_time=0.3)),
+    ('pipelined', dict(settle_time=0.3, pipelined=True)),
+    ('adaptive', dict(settle_mode='adaptive', pipelined=True)),
+    ('predictive', dict(settle_mode='adaptive', pipelined=True, range_mode='predictive')),
+]
+
+
+def benchmark_scan(name, shape=(5, 4), spacing=200, speedup=1, **kwargs):
+    """
+    Run do_simple_map with the given keyword arguments over a shape grid of pixels spacing steps apart on an
+    emulated stage and lockin, and report readings per hour and the time spent in each phase.
+    """
+    directory = tempfile.mkdtemp()
+    m, ctrl = emulated_mapper(speedup=speedup)
+    try:
+        nc = netCDF4.Dataset(os.path.join(directory, 'map.nc'), mode='w')
+        xsteps = 600 + spacing * np.arange(shape[0])
+        ysteps = 600 + spacing * np.arange(shape[1])
+        tic = time.time()
+        with quiet():
+            m.do_simple_map(xsteps, ysteps, nc=nc, flush_interval=1.0, **kwargs)
+        elapsed = (time.time() - tic) * speedup
+        nc.close()
+    finally:
+        ctrl.stop()
+        shutil.rmtree(directory)
+    readings = shape[0] * shape[1]
+    return dict(name=name, readings=readings, duration=elapsed, points_per_hour=readings * 3600. / elapsed,
+                phases=dict((phase, histogram.total * speedup) for phase, histogram in m.telemetry.phases.items()),
+                range_changes=m.lockin.range_changes)
+
+
+def benchmark_viewer_cursor(fast=True, events=500, event_rate=200.):
+    """
+    Sweep synthetic mouse motion events, event_rate a second, across Viewer2d showing the mapview demo arrays, and
+    report the time spent handling each event and how often the cuts were redrawn.
+    """
+    from matplotlib import pyplot as plt
+    from matplotlib.backend_bases import MouseEvent
+    import mapview
+    x, y, z, A = mapview.demo_data()
+    results = []
+    for name, data in [('300x400', (z, x, y)), ('512x512', (A,))]:
+        viewer = mapview.Viewer2d(*data, fast=fast)
+        canvas = viewer.fig.canvas
+        canvas.draw()
+        renders = [0]
+        render_cursor = viewer.render_cursor
+
+        def counted():
+            renders[0] += 1
+            render_cursor()
+        viewer.render_cursor = counted
+        left, bottom, right, top = viewer.overview.bbox.extents
+        handling = 0
+        for k in range(events):
+            fraction = (k + 0.5) / events
+            event = MouseEvent('motion_notify_event', canvas, left + (right - left) * fraction,
+                               bottom + (top - bottom) * fraction)
+            tic = time.time()
+            canvas.callbacks.process('motion_notify_event', event)
+            elapsed = time.time() - tic
+            handling += elapsed
+            time.sleep(max(0, 1. / event_rate - elapsed))
+        if not fast:
+            renders[0] = events
+        plt.close(viewer.fig)
+        results.append(dict(map=name, fast=fast, time_per_event=handling / events, renders=renders[0], events=events))
+    return results
+
+
+def benchmark_viewer_refresh(shape=(40, 40, 10), storage='image'):
+    """
+    Fill a do_simple_map file of shape (x, y, frequency) a row at a time, as a map does, and time how long
+    mapview.MapFileViewer takes to pick up each new row.
+    """
+    from matplotlib import pyplot as plt
+    import mapper
+    import mapview
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'map.nc')
+    try:
+        nc = netCDF4.Dataset(filename, mode='w')
+        mapfile = mapper.MapDataFile(np.arange(shape[0]), np.arange(shape[1]), np.arange(1, shape[2] + 1),
+                                     parent_nc=nc, storage=storage)
+        nc.close()
+        viewer = mapview.MapFileViewer(filename)
+        viewer.timer.stop()
+        refreshes = []
+        for j in range(shape[1]):
+            # The viewer holds the file open for reading, which HDF5 does not allow alongside a writer in the same
+            # process
+            with viewer.nc_lock:
+                viewer.nc.close()
+                nc = netCDF4.Dataset(filename, mode='a')
+                nc.groups[mapfile.group.name].variables['z'][:, j] = np.random.rand(shape[0], shape[2])
+                nc.close()
+                viewer.nc = netCDF4.Dataset(filename, mode='r')
+            viewer.last_mtime = None
+            tic = time.time()
+            viewer.update_data(None)
+            refreshes.append(time.time() - tic)
+        viewer.loader.close()
+        plt.close(viewer.fig)
+    finally:
+        shutil.rmtree(directory)
+    return dict(shape=shape, storage=storage, refresh_time=float(np.mean(refreshes)), max_refresh_time=max(refreshes))
+
+
+def environment():
+    try:
+        revision = subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.STDOUT,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return dict(time=time.strftime('%Y-%m-%d %H:%M:%S'), host=platform.node(), python=platform.python_version(),
+                numpy=np.__version__, netCDF4=netCDF4.__version__, revision=revision)
+
+
+BENCHMARKS = ['protocol', 'moves', 'homing', 'scan', 'storage', 'viewer']
+
+
+def run(benchmarks=BENCHMARKS, quick=False):
+    """
+    Run the named benchmarks, printing each result, and return a dictionary of the environment, the full results of
+    each benchmark and a flat dictionary of metrics, each a value with its unit and whether 'lower' or 'higher' is
+    better. quick runs shorter versions that are only comparable with other quick runs.
+    """
+    results = {}
+    metrics = {}
+
+    def metric(name, value, unit, better='lower'):
+        metrics[name] = dict(value=float(value), unit=unit, better=better)
+
+    if 'protocol' in benchmarks:
+        result = results['protocol'] = benchmark_commands(count=50 if quick else 200)
+        print "protocol: %(sendget_rate).1f commands/s through sendget, %(transaction_rate).1f commands/s pipelined, " \
+              "%(latency).4f s median round trip" % result
+        metric('sendget_rate', result['sendget_rate'], 'commands/s', 'higher')
+        metric('transaction_rate', result['transaction_rate'], 'commands/s', 'higher')
+        metric('command_latency', result['latency'], 's')
+    if 'moves' in benchmarks:
+        results['moves'] = benchmark_moves(repeats=1 if quick else 3)
+        for result in results['moves']:
+            print "move of %(distance)d steps: %(duration).3f s (predicted %(predicted).3f s)" % result
+            metric('move_%d' % result['distance'], result['duration'], 's')
+    if 'homing' in benchmarks:
+        results['homing'] = []
+        for method in ['stepped', 'continuous']:
+            for result in benchmark_homing(method):
+                print "%(method)s homing: %(duration).1f s, %(commands)d commands, home error %(home_error)s " \
+                      "full steps, repeatability %(repeatability)s steps" % result
+                results['homing'].append(result)
+                metric('homing_%s' % method, result['duration'], 's')
+    if 'scan' in benchmarks:
+        results['scan'] = []
+        for name, kwargs in SCAN_CONFIGURATIONS:
+            result = benchmark_scan(name, shape=(3, 2) if quick else (5, 4), **kwargs)
+            print "%(name)s scan: %(points_per_hour).0f readings per hour, %(readings)d readings in " \
+                  "%(duration).1f s" % result
+            results['scan'].append(result)
+            metric('scan_%s' % name, result['points_per_hour'], 'readings/hour', 'higher')
+    if 'storage' in benchmarks:
+        results['storage'] = []
+        for profile in ['legacy', 'image', 'spectrum']:
+            result = benchmark_map_storage(profile, shape=(8, 8, 20, 10) if quick else (22, 22, 100, 50))
+            print "%(profile)s storage: %(file_size)d bytes, written in %(write_time).2f s, frequency plane read " \
+                  "%(image_read).4f s, pixel spectrum read %(spectrum_read).4f s" % result
+            results['storage'].append(result)
+            metric('storage_%s_write' % profile, result['write_time'], 's')
+            metric('storage_%s_image_read' % profile, result['image_read'], 's')
+            metric('storage_%s_spectrum_read' % profile, result['spectrum_read'], 's')
+    if 'viewer' in benchmarks:
+        results['viewer'] = []
+        for fast in [False, True]:
+            for result in benchmark_viewer_cursor(fast, events=100 if quick else 500):
+                print "%(map)s viewer, fast=%(fast)s: %(time_per_event).4f s per motion event, cuts redrawn " \
+                      "%(renders)d times for %(events)d events" % result
+                results['viewer'].append(result)
+                metric('viewer_cursor_%s%s' % (result['map'], '_fast' if fast else ''), result['time_per_event'],
+                       's')
+        result = benchmark_viewer_refresh(shape=(20, 20, 5) if quick else (40, 40, 10))
+        print "viewer refresh: %(refresh_time).4f s per new row, at most %(max_refresh_time).4f s" % result
+        results['viewer'].append(result)
+        metric('viewer_refresh', result['refresh_time'], 's')
+    return dict(environment=environment(), quick=quick, results=results, metrics=metrics)
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Print the metrics of two runs side by side and return the names of those more than threshold (a fraction)
+    worse in new.
+    """
+    if old.get('quick') != new.get('quick'):
+        print "warning: comparing a quick run with a full one"
+    regressions = []
+    print "%-32s %14s %14s %8s" % ('metric', old['environment'].get('revision'), new['environment'].get('revision'),
+                                   'change')
+    for name in sorted(set(old['metrics']) & set(new['metrics'])):
+        before, after = old['metrics'][name], new['metrics'][name]
+        change = after['value'] / before['value'] - 1 if before['value'] else float('nan')
+        worse = change if after['better'] == 'lower' else -change
+        flag = ''
+        if worse > threshold:
+            regressions.append(name)
+            flag = 'slower'
+        elif worse < -threshold:
+            flag = 'faster'
+        print "%-32s %14.4g %14.4g %+7.1f%% %s %s" % (name, before['value'], after['value'], 100 * change,
+                                                      after['unit'], flag)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stage protocol, homing, scans, map files and "
+                                                 "viewer against emulated hardware.")
+    parser.add_argument('--output', help="save the results to this JSON file")
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help="compare with the results in this JSON file; given two files, compare them without "
+                             "running anything")
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                        help="run only these benchmarks")
+    parser.add_argument('--quick', action='store_true', help="run shorter versions of the benchmarks")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="fraction by which a metric has to get worse to count as a regression")
+    args = parser.parse_args(argv)
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare takes one or two files")
+    if args.compare and len(args.compare) == 2:
+        runs = [json.load(open(filename)) for filename in args.compare]
+    else:
+        import matplotlib
+        # Viewer benchmarks draw off screen
+        matplotlib.use('Agg')
+        runs = [run(args.only, quick=args.quick)]
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(runs[0], f, indent=2, sort_keys=True)
+        if args.compare:
+            runs.insert(0, json.load(open(args.compare[0])))
+    if len(runs) == 2:
+        regressions = compare(runs[0], runs[1], threshold=args.threshold)
+        if regressions:
+            print "%d metrics got worse: %s" % (len(regressions), ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,579 @@
+"""
+Software stand-ins for the Arduino controllers so the stage, HWP stepper and mappers can run without hardware.
+
+L6474Controller speaks the UART protocol of arduino/DualL6474Controller (num_axes=2) and
+arduino/TripleL6474Controller (num_axes=3); HWPStepperController speaks the single character protocol of
+arduino/stepper_oneStepAtATime_incremental. Each device runs in its own thread and can be reached either through an
+in-process serial-like object (device.port(), accepted anywhere a port name is) or a pseudo terminal
+(device.open_pty(), returns a device name that pyserial can open). SR830Lockin stands in for the lockin driver the
+mappers use rather than for a serial protocol.
+
+Motion follows the library's trapezoidal speed profile and every byte costs its 9600 baud link time. speedup > 1 runs
+the whole device clock faster than real time.
+
+Example:
+    ctrl = emulator.L6474Controller(speedup=20)
+    s = stage.Stage(ctrl.port())
+"""
+import atexit
+import collections
+import os
+import random
+import re
+import threading
+import time
+import tty
+
+import motion
+import settling
+
+NB_L6474_UART_COMMAND = 37
+
+# Number of arguments after the target for C1..C36, copied from the firmware
+COMMAND_ARGUMENT_NB = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 2, 0, 1, 1, 1, 0, 0,
+                       1, 1, 0, 0, 0, 0, 1, 0, 0, 2, 0, 0, 0, 1, 1, 0]
+
+L6474_MIN_PWM_FREQ = 30
+L6474_MAX_PWM_FREQ = 10000
+
+# Status register flags that are set when nothing is wrong (they are active low)
+STATUS_OK_FLAGS = 0x1000 | 0x0800 | 0x0400 | 0x0200
+STATUS_DIR = 0x0010
+
+# shieldState_t returned by C4
+ACCELERATING = 0
+DECELERATING = 1
+STEADY = 2
+INACTIVE = 3
+
+# (lower limit bit, upper limit bit) of C36 for each axis; the bit reads 1 while the switch is open
+LIMIT_BITS = {0: (0x02, 0x01), 1: (0x08, 0x04)}
+
+
+def uint32(value):
+    return int(value) & 0xFFFFFFFF
+
+
+def int32(value):
+    value = uint32(value)
+    if value & 0x80000000:
+        value -= 0x100000000
+    return value
+
+
+class EmulatedDevice(object):
+    rx_buffer_size = 64
+
+    def __init__(self, baudrate=9600, speedup=1.0):
+        self.baudrate = baudrate
+        self.speedup = float(speedup)
+        self._t0 = time.time()
+        self._rx = collections.deque()
+        self._rx_condition = threading.Condition()
+        self._sinks = []
+        self.bytes_dropped = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def now(self):
+        return (time.time() - self._t0) * self.speedup
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speedup)
+
+    def feed(self, data):
+        # Host to device. Like the Arduino's serial ring buffer, bytes that do not fit are lost.
+        with self._rx_condition:
+            for char in data:
+                if len(self._rx) >= self.rx_buffer_size:
+                    self.bytes_dropped += 1
+                else:
+                    self._rx.append(char)
+            self._rx_condition.notify()
+
+    def read_char(self):
+        with self._rx_condition:
+            while not self._rx:
+                if not self._running:
+                    return None
+                self._rx_condition.wait(0.1)
+            char = self._rx.popleft()
+        self.sleep(motion.link_time(1, self.baudrate))
+        return char
+
+    def emit(self, data):
+        self.sleep(motion.link_time(len(data), self.baudrate))
+        for sink in self._sinks:
+            sink(data)
+
+    def _run(self):
+        while self._running:
+            char = self.read_char()
+            if char is not None:
+                self.handle_char(char)
+
+    def handle_char(self, char):
+        raise NotImplementedError
+
+    def stop(self):
+        self._running = False
+        self._thread.join(1)
+
+    def port(self):
+        return EmulatedPort(self)
+
+    def open_pty(self):
+        return PtyBridge(self).name
+
+
+class EmulatedPort(object):
+    """
+    Host end of an emulated device with the parts of the pyserial interface this package uses.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.timeout = None
+        self._buffer = ''
+        self._condition = threading.Condition()
+        device._sinks.append(self._receive)
+
+    def _receive(self, data):
+        with self._condition:
+            self._buffer += data
+            self._condition.notify_all()
+
+    def write(self, data):
+        self.device.feed(data)
+        return len(data)
+
+    def read(self, size=1):
+        with self._condition:
+            if self.timeout is None:
+                while len(self._buffer) < size:
+                    self._condition.wait(0.1)
+            else:
+                deadline = time.time() + self.timeout
+                while len(self._buffer) < size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+
+    def inWaiting(self):
+        return len(self._buffer)
+
+    def flushInput(self):
+        with self._condition:
+            self._buffer = ''
+
+    def setDTR(self, level=True):
+        pass
+
+    def close(self):
+        if self._receive in self.device._sinks:
+            self.device._sinks.remove(self._receive)
+
+
+class PtyBridge(object):
+    def __init__(self, device):
+        self.device = device
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.name = os.ttyname(slave)
+        self._slave = slave
+        device._sinks.append(self._receive)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _receive(self, data):
+        os.write(self.master, data)
+
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            if not data:
+                break
+            self.device.feed(data)
+
+
+class Axis(object):
+    def __init__(self, position=0, lower_limit=0, upper_limit=None):
+        # Physical state is kept in full steps so that changing the step mode does not move the stage
+        self.full_step_position = float(position)
+        self.lower_limit = lower_limit
+        self.upper_limit = upper_limit
+        self.home_offset = 0.0
+        self.stepping = 16
+        self.acceleration = 160
+        self.deceleration = 160
+        self.max_speed = 1600
+        self.min_speed = 800
+        self.mark = 0
+        self.direction = 1
+        self.profile = None
+        self.move_start = 0.0
+        self.move_origin = 0.0
+        self.move_sign = 1
+
+    def update(self, now):
+        if self.profile is None:
+            return
+        t = now - self.move_start
+        steps = self.move_origin + self.move_sign * self.profile.distance(t)
+        self.full_step_position = steps / self.stepping + self.home_offset
+        if t >= self.profile.duration:
+            self.profile = None
+
+    def position(self, now):
+        self.update(now)
+        return int(round((self.full_step_position - self.home_offset) * self.stepping))
+
+    def is_active(self, now):
+        self.update(now)
+        return self.profile is not None
+
+    def current_speed(self, now):
+        self.update(now)
+        if self.profile is None:
+            return 0
+        return int(self.profile.speed(now - self.move_start))
+
+    def go_to(self, target, now):
+        origin = self.position(now)
+        steps = target - origin
+        self.direction = 1 if steps >= 0 else -1
+        if steps == 0:
+            self.profile = None
+            return
+        self.profile = motion.MoveProfile(steps, self.acceleration, self.deceleration, self.min_speed,
+                                          self.max_speed)
+        self.move_start = now
+        self.move_origin = origin
+        self.move_sign = self.direction
+
+    def hard_stop(self, now):
+        self.update(now)
+        self.profile = None
+
+    def soft_stop(self, now):
+        self.update(now)
+        if self.profile is None:
+            return
+        speed = self.profile.speed(now - self.move_start)
+        remaining = int((speed ** 2 - self.min_speed ** 2) / (2.0 * self.deceleration))
+        self.go_to(self.position(now) + self.direction * remaining, now)
+
+    def set_home(self, now):
+        self.update(now)
+        self.move_origin -= (self.full_step_position - self.home_offset) * self.stepping
+        self.home_offset = self.full_step_position
+
+    def status(self, now):
+        status = STATUS_OK_FLAGS
+        if self.direction > 0:
+            status |= STATUS_DIR
+        return status
+
+    def state(self, now):
+        self.update(now)
+        if self.profile is None:
+            return INACTIVE
+        t = now - self.move_start
+        if t < self.profile.acc_time:
+            return ACCELERATING
+        if t < self.profile.acc_time + self.profile.const_time:
+            return STEADY
+        return DECELERATING
+
+
+class L6474Controller(EmulatedDevice):
+    """
+    Emulates the Dual/Triple L6474 UART firmware. positions gives the starting physical position of each axis in full
+    steps; the lower limit switch of an axis closes at lower_limits[axis] and the upper one at upper_limits[axis].
+    """
+    def __init__(self, num_axes=2, positions=None, lower_limits=None, upper_limits=None, baudrate=9600,
+                 speedup=1.0):
+        if positions is None:
+            positions = [400] * num_axes
+        if lower_limits is None:
+            lower_limits = [0] * num_axes
+        if upper_limits is None:
+            upper_limits = [None] * num_axes
+        self.axes = [Axis(positions[k], lower_limits[k], upper_limits[k]) for k in range(num_axes)]
+        self.commands_executed = 0
+        self._line = None
+        super(L6474Controller, self).__init__(baudrate=baudrate, speedup=speedup)
+
+    def handle_char(self, char):
+        if self._line is None:
+            if char in '\r\n ':
+                return
+            if char != 'C':
+                self.emit('Error>')
+                return
+            self._line = ''
+        elif char == '\n':
+            line, self._line = self._line, None
+            self.handle_command(line)
+        else:
+            self._line += char
+
+    def handle_command(self, line):
+        # Serial.parseInt skips anything that is not a digit or minus sign and returns 0 when nothing is left
+        numbers = [int(x) for x in re.findall(r'-?\d+', line)]
+        numbers += [0] * (4 - len(numbers))
+        command = numbers[0]
+        if command == 0 or command > NB_L6474_UART_COMMAND:
+            self.emit('Error: %d\r\n>' % NB_L6474_UART_COMMAND)
+            return
+        target = uint32(numbers[1])
+        if target > len(self.axes) - 1:
+            target = 0
+        nargs = COMMAND_ARGUMENT_NB[command - 1] if command <= len(COMMAND_ARGUMENT_NB) else 0
+        args = numbers[2:2 + nargs]
+        self.emit('C%d %d%s\r\n' % (command, target, ''.join([' %d' % uint32(arg) for arg in args])))
+        self.execute(command, target, args)
+        self.commands_executed += 1
+        self.emit('>')
+
+    def reply(self, value):
+        self.emit('R %d\r\n' % uint32(value))
+
+    def limits(self, now):
+        data = 0
+        for axis_index, (lower_bit, upper_bit) in LIMIT_BITS.items():
+            if axis_index >= len(self.axes):
+                continue
+            axis = self.axes[axis_index]
+            axis.update(now)
+            if axis.lower_limit is None or axis.full_step_position > axis.lower_limit:
+                data += lower_bit
+            if axis.upper_limit is None or axis.full_step_position < axis.upper_limit:
+                data += upper_bit
+        return data
+
+    def execute(self, command, target, args):
+        axis = self.axes[target]
+        now = self.now()
+        arg1 = args[0] if args else 0
+        if command == 1:
+            self.reply(axis.acceleration)
+        elif command == 2:
+            self.reply(axis.current_speed(now))
+        elif command == 3:
+            self.reply(axis.deceleration)
+        elif command == 4:
+            self.reply(axis.state(now))
+        elif command == 5:
+            self.reply(1)
+        elif command == 6:
+            self.reply(axis.mark)
+        elif command == 7:
+            self.reply(axis.max_speed)
+        elif command == 8:
+            self.reply(axis.min_speed)
+        elif command == 9:
+            self.reply(axis.position(now))
+        elif command == 10:
+            axis.go_to(0, now)
+        elif command == 11:
+            axis.go_to(axis.mark, now)
+        elif command == 12:
+            axis.go_to(int32(arg1), now)
+        elif command == 13:
+            axis.hard_stop(now)
+        elif command == 14:
+            direction = 1 if arg1 == 0 else -1
+            axis.go_to(axis.position(now) + direction * uint32(args[1]), now)
+        elif command == 15:
+            for each in self.axes:
+                each.hard_stop(now)
+                each.set_home(now)
+        elif command == 16:
+            direction = 1 if arg1 == 0 else -1
+            axis.go_to(axis.position(now) + direction * (1 << 21), now)
+        elif command == 17:
+            if arg1 & 0xFFFF and not axis.is_active(now):
+                axis.acceleration = arg1 & 0xFFFF
+        elif command == 18:
+            if arg1 & 0xFFFF and not axis.is_active(now):
+                axis.deceleration = arg1 & 0xFFFF
+        elif command == 19:
+            axis.set_home(now)
+            self.emit('Set home done\r\n')
+        elif command == 20:
+            axis.mark = axis.position(now)
+            self.emit('Set mark done\r\n')
+        elif command == 21:
+            speed = arg1 & 0xFFFF
+            if (L6474_MIN_PWM_FREQ < speed <= L6474_MAX_PWM_FREQ and axis.min_speed <= speed
+                    and not axis.is_active(now)):
+                axis.max_speed = speed
+        elif command == 22:
+            speed = arg1 & 0xFFFF
+            if (L6474_MIN_PWM_FREQ <= speed < L6474_MAX_PWM_FREQ and speed <= axis.max_speed
+                    and not axis.is_active(now)):
+                axis.min_speed = speed
+        elif command == 23:
+            axis.soft_stop(now)
+            self.emit('Soft stop\r\n')
+        elif command == 24:
+            self.emit('W\r\n')
+            if axis.is_active(now):
+                self.sleep(axis.profile.duration - (now - axis.move_start))
+                axis.update(self.now())
+            self.emit('R\r\n')
+        elif command in (27, 28, 31):
+            self.reply(axis.status(now))
+        elif command == 32 or command == 33:
+            pass
+        elif command == 34:
+            axis.hard_stop(now)
+            axis.stepping = arg1 if arg1 in (1, 2, 4, 8, 16) else 1
+            axis.set_home(now)
+        elif command == 35:
+            axis.direction = 1 if arg1 == 0 else -1
+        elif command == 36:
+            self.reply(self.limits(now))
+
+
+class HWPStepperController(EmulatedDevice):
+    """
+    Emulates stepper_oneStepAtATime_incremental: 'a' and 'b' step forward and back, 'r' zeroes the count, and every
+    character is answered with "steps: <count> <index switch>". The index switch reads 0 for switch_width steps of
+    every steps_per_revolution.
+
+    With firmware_version=2 it also answers 'v' with "version: 2", and takes "m<count>\n" (count steps at once) and
+    "e<count>\n" (up to count steps, stopping when the index switch changes) with a single reply. Version 1 answers
+    those characters like any other, one step count each.
+    """
+    def __init__(self, position=50, steps_per_revolution=100, switch_width=3, baudrate=9600, speedup=1.0,
+                 firmware_version=2):
+        self.position = position
+        self.steps_per_revolution = steps_per_revolution
+        self.switch_width = switch_width
+        self.firmware_version = firmware_version
+        self.step_count = 0
+        # myStepper.step(2) at 10 rpm with 200 steps per revolution
+        self.step_time = 2 / (200 * 10 / 60.)
+        self.delay_time = 0.3
+        self._command = None
+        self._argument = ''
+        super(HWPStepperController, self).__init__(baudrate=baudrate, speedup=speedup)
+
+    def switch_state(self):
+        return int(self.position % self.steps_per_revolution >= self.switch_width)
+
+    def step(self, direction):
+        self.position += direction
+        self.step_count += direction
+        self.sleep(self.step_time)
+
+    def reply(self):
+        self.emit('steps: %d %d\r\n' % (self.step_count, self.switch_state()))
+
+    def handle_char(self, char):
+        if self._command is not None:
+            if char != '\n':
+                self._argument += char
+                return
+            self.run_command(self._command, int(self._argument or 0))
+            self._command = None
+            return
+        if self.firmware_version >= 2:
+            if char == 'v':
+                self.emit('version: %d\r\n' % self.firmware_version)
+                return
+            if char in 'me':
+                self._command = char
+                self._argument = ''
+                return
+        if char == 'r':
+            self.step_count = 0
+        else:
+            if char == 'a':
+                self.step(1)
+            elif char == 'b':
+                self.step(-1)
+            self.sleep(self.delay_time)
+        self.reply()
+
+    def run_command(self, command, count):
+        direction = 1 if count >= 0 else -1
+        start_state = self.switch_state()
+        for k in range(abs(count)):
+            self.step(direction)
+            if command == 'e' and self.switch_state() != start_state:
+                break
+        self.sleep(self.delay_time)
+        self.reply()
+
+
+class SR830Lockin(object):
+    """
+    Stands in for the SR830 lockinController that mapper.Mapper reads, with signal() giving the true magnitude in volts
+    (e.g. a beam at the position of an emulated stage) and noise the rms volts added to each reading. Every query
+    takes read_time. A reading overloads, and is clipped, above full scale; auto_range_measure changes the
+    sensitivity one setting at a time, waiting a time constant after each, until the reading is below 90% of full
+    scale and would overload the next lower one.
+    """
+    def __init__(self, signal=lambda: 1e-3, noise=0.0, time_constant=0.1, read_time=0.02, speedup=1.0):
+        self.signal = signal
+        self.noise = noise
+        self.time_constant = time_constant
+        self.read_time = read_time
+        self.speedup = float(speedup)
+        self.sensitivity = len(settling.SR830_SENSITIVITIES) - 1
+        self.range_changes = 0
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speedup)
+
+    def read(self):
+        self.sleep(self.read_time)
+        r = abs(self.signal() + random.gauss(0, self.noise))
+        return min(r, settling.SR830_SENSITIVITIES[self.sensitivity])
+
+    def set_sensitivity(self, sensitivity):
+        if sensitivity != self.sensitivity:
+            self.sensitivity = sensitivity
+            self.range_changes += 1
+
+    def get_idn(self):
+        return 'Stanford_Research_Systems,SR830,emulated,1.0'
+
+    def send(self, command):
+        self.sleep(self.read_time)
+        parts = command.split()
+        if parts[0] == 'SENS':
+            self.set_sensitivity(int(parts[1]))
+
+    def get_data(self):
+        # x, y, r, theta, with the signal all in phase
+        r = self.read()
+        return r, 0.0, r, 0.0
+
+    def snap(self, *parameters):
+        return self.read(), 0.0
+
+    def auto_range_measure(self, debug=False):
+        full_scales = settling.SR830_SENSITIVITIES
+        while True:
+            r = self.read()
+            if r > 0.9 * full_scales[self.sensitivity] and self.sensitivity < len(full_scales) - 1:
+                self.set_sensitivity(self.sensitivity + 1)
+            elif self.sensitivity > 0 and r < 0.9 * full_scales[self.sensitivity - 1]:
+                self.set_sensitivity(self.sensitivity - 1)
+            else:
+                return r, self.sensitivity
+            self.sleep(self.time_constant)
@@ -0,0 +1,248 @@
+"""
+Live feed of the readings of a running map over a Unix socket, so viewers can follow a scan without reading its
+netCDF file.
+
+A Mapper given a live_address owns a Publisher; any number of Subscribers (e.g. mapview.LiveMapViewer) connect to
+its address. Messages are one JSON object per line:
+    {"type": "map", ...}    a map started: file, group, dimensions, coordinates and shape of z. A subscriber that
+                            connects during a map gets it too, followed by nbytes of float32 z holding every reading so
+                            far (NaN where there is none yet).
+    {"type": "point", ...}  one reading: its index into z, the stage position, the value and any extras such as the
+                            lockin sensitivity.
+    {"type": "end"}         the map finished.
+Every subscriber has its own sending thread and queue, so a slow or stuck viewer is dropped instead of holding up the
+scan.
+
+Example:
+    feed = Subscriber()
+    for message in feed:
+        print message
+"""
+import json
+import os
+import Queue
+import socket
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_ADDRESS = '/tmp/xystage_live.sock'
+
+
+def map_header(mapfile):
+    group = mapfile.group
+    z = group.variables['z']
+    return {'filename': mapfile.nc.filepath(), 'group': group.name,
+            'description': getattr(group, 'description', ''),
+            'dimensions': list(z.dimensions), 'shape': list(z.shape),
+            'coordinates': dict((name, group.variables[name][:].tolist()) for name in z.dimensions)}
+
+
+def encode(message):
+    return json.dumps(message) + '\n'
+
+
+class Publisher(object):
+    def __init__(self, address=DEFAULT_ADDRESS, max_queue=100000):
+        self.address = address
+        # Messages a subscriber may fall behind by before it is dropped
+        self.max_queue = max_queue
+        self.header = None
+        self.z = None
+        self._subscribers = []
+        # Reentrant: a subscriber that falls too far behind drops itself while a message is being sent
+        self._lock = threading.RLock()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._remove_stale_socket()
+        self._socket.bind(address)
+        self._socket.listen(5)
+        self._thread = threading.Thread(target=self._accept, name='livefeed')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.address):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.address)
+        except socket.error:
+            # Left behind by a publisher that did not close
+            os.remove(self.address)
+        else:
+            probe.close()
+            raise ValueError("Another scan is already publishing on %s" % self.address)
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except socket.error:
+                break
+            subscriber = _Subscription(connection, self.max_queue, self._drop)
+            with self._lock:
+                if self.header is not None:
+                    header = dict(self.header, nbytes=self.z.nbytes)
+                    subscriber.send(encode(header) + self.z.tostring())
+                self._subscribers.append(subscriber)
+
+    def _drop(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def _send(self, data):
+        for subscriber in list(self._subscribers):
+            subscriber.send(data)
+
+    def start_map(self, header, z=None):
+        """
+        header describes the map, see map_header(). z holds the readings it already has, e.g. when resuming.
+        """
+        with self._lock:
+            self.header = dict(header, type='map')
+            self.z = np.empty(header['shape'], dtype=np.float32)
+            self.z[:] = np.nan
+            if z is not None:
+                self.z[:] = np.ma.filled(np.ma.asarray(z, dtype=np.float32), np.nan)
+            self._send(encode(dict(self.header, nbytes=self.z.nbytes)) + self.z.tostring())
+
+    def publish(self, index, value, **extra):
+        """
+        Send the reading value for z[index]; extra keyword arguments go into the message as they are.
+        """
+        index = [int(i) for i in index]
+        message = dict((key, item.item() if isinstance(item, np.generic) else item) for key, item in extra.items())
+        message.update(type='point', index=index, value=float(value), time=time.time())
+        with self._lock:
+            if self.header is None:
+                return
+            coordinates = self.header['coordinates']
+            message['position'] = [coordinates['x'][index[0]], coordinates['y'][index[1]]]
+            self.z[tuple(index)] = value
+            self._send(encode(message))
+
+    def end_map(self):
+        with self._lock:
+            if self.header is not None:
+                self._send(encode({'type': 'end', 'group': self.header['group']}))
+            self.header = None
+            self.z = None
+
+    def close(self):
+        self._socket.close()
+        with self._lock:
+            for subscriber in list(self._subscribers):
+                subscriber.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class _Subscription(object):
+    # The publisher's end of one subscriber's connection
+    def __init__(self, connection, max_queue, on_drop):
+        self.connection = connection
+        self.on_drop = on_drop
+        self.closed = False
+        self._queue = Queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, name='livefeed subscriber')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, data):
+        if self.closed:
+            return
+        try:
+            self._queue.put_nowait(data)
+        except Queue.Full:
+            self.close()
+
+    def _run(self):
+        while not self.closed:
+            data = self._queue.get()
+            if data is None:
+                break
+            try:
+                self.connection.sendall(data)
+            except socket.error:
+                break
+        self.connection.close()
+        self.on_drop(self)
+
+    def close(self):
+        self.closed = True
+        self.on_drop(self)
+        # Wake the sending thread whether it waits on a stuck viewer or for the next message
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        try:
+            self._queue.put_nowait(None)
+        except Queue.Full:
+            pass
+
+
+class Subscriber(object):
+    """
+    Receives the messages of a Publisher on a background thread. poll() returns those received so far without
+    waiting, which suits GUI timers; iterating waits for each message. The z array of a 'map' message is in its 'z'
+    entry.
+    """
+    def __init__(self, address=DEFAULT_ADDRESS):
+        self.address = address
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(address)
+        self._file = self._socket.makefile('rb')
+        self._queue = Queue.Queue()
+        self.connected = True
+        self._thread = threading.Thread(target=self._run, name='livefeed')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for line in iter(self._file.readline, ''):
+                message = json.loads(line)
+                if message['type'] == 'map':
+                    data = self._file.read(message.pop('nbytes'))
+                    message['z'] = np.frombuffer(data, dtype=np.float32).reshape(message['shape']).copy()
+                self._queue.put(message)
+        except (socket.error, ValueError):
+            pass
+        finally:
+            self.connected = False
+            self._queue.put(None)
+
+    def poll(self):
+        messages = []
+        while True:
+            try:
+                message = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if message is None:
+                # Keep the end of the feed visible to later calls
+                self._queue.put(None)
+                break
+            messages.append(message)
+        return messages
+
+    def get(self, timeout=None):
+        """
+        The next message, or None once the publisher has gone away.
+        """
+        try:
+            message = self._queue.get(timeout=timeout)
+        except Queue.Empty:
+            raise RuntimeError("No message from %s within %s s" % (self.address, timeout))
+        if message is None:
+            self._queue.put(None)
+        return message
+
+    def __iter__(self):
+        return iter(self.get, None)
+
+    def close(self):
+        self._socket.close()
@@ -1,12 +1,17 @@
+import collections
 import numpy as np
 import netCDF4
 import os
 from matplotlib import pyplot as plt
 import time
+import async_devices
+import basemapper
+import mapwriter
+import motion
+import pathplan
+import scheduler
 import stage
 import stepper
-from equipment.srs.lockin import Lockin
-from equipment.hittite.signal_generator import Hittite
 
 LOCKIN_SERIAL_PORT = '/dev/serial/by-id/usb-Keyspan__a_division_of_InnoSys_Inc._Keyspan_USA-19H-if00-port0'
 
@@ -26,17 +31,27 @@ hwp_steps = np.arange(100)
 mmw_frequencies = np.linspace(140e9,161e9,500)
 
 
-class Mapper():
-    def __init__(self, use_hittite=False):
-        self.stage = stage.Stage('/dev/ttyACM0')
+class Mapper(basemapper.BaseMapper):
+    point_name = 'pixels'
+
+    def __init__(self, use_hittite=False, live_address=None, metrics_file=None):
+        # live_address and metrics_file are as in basemapper.BaseMapper
+        super(Mapper, self).__init__(live_address, metrics_file)
+        self.stage = stage.Stage('/dev/ttyACM0', cache=True)
+        self.stage.transport.telemetry = self.telemetry
         self.stage.initialize()
         self.hwp = stepper.SimpleStepper('/dev/ttyACM1')
+        self.hwp.transport.telemetry = self.telemetry
         self.hwp.initialize()
         #self.hwp.initialize_hwp(acceleration=16000, min_speed=30,max_speed=100,stepping=2)
         # self.stage.find_home()
+        # Imported here so the module, e.g. MapDataFile, can be used without the instrument drivers
+        from equipment.srs.lockin import Lockin
         self.lockin = Lockin(LOCKIN_SERIAL_PORT)
-        self._have_found_home = False
+        # Of the lockin output filter, for settle_mode='adaptive'; the default time_constant_wait is five of them
+        self.lockin_time_constant = 0.1
         if use_hittite:
+            from equipment.hittite.signal_generator import Hittite
             self.hittite = Hittite()
         else:
             self.hittite = None
@@ -44,7 +59,125 @@ class Mapper():
 
     def do_simple_map(self, xsteps=x_steps, ysteps=y_steps,
                       settle_time=0.3, hwp_steps=hwp_steps, mmw_frequencies = np.array([-1]), description="",
-                      suffix="", time_constant_wait=0.5):
+                      suffix="", time_constant_wait=0.5, pipelined=False, buffer_size=1000, path=None,
+                      flush_interval=10.0, storage='image', settle_mode='fixed', max_settle_time=None, nc=None):
+        """
+        The map is written to a new file in /data/readout/hwp_mapping, or as a new group of nc, an open
+        netCDF4.Dataset, if given.
+
+        With pipelined=True, once the last reading at a pixel is taken the stage starts moving to the next pixel
+        while the HWP takes its first step there and the Hittite is retuned to the first frequency. File writes and
+        progress reports are done on a background thread holding at most buffer_size pending writes.
+
+        path is an optional list of (x_index, y_index) pixels to visit in order, e.g. from pathplan.plan_path; by
+        default every pixel is visited in a serpentine.
+
+        Readings are buffered in memory and written to the file every flush_interval seconds. storage picks the
+        layout of the file: 'image', 'spectrum' or 'legacy', see mapwriter.StorageProfile. Each reading is also
+        published on the live feed as it is taken (see livefeed), so viewers following that do not need the file
+        and flush_interval can be long.
+
+        settle_mode='fixed' waits time_constant_wait before every reading; 'adaptive' reads the lockin until its
+        output stops changing, at most max_settle_time, and keeps the last reading, see settling.Settler. Either way
+        the time waited is stored for each cell in settle_duration. The time left is predicted from the stage motion
+        model and the measured time of each phase, see motion.ScanTimer.
+        """
+        self._prepare(mmw_frequencies)
+
+        mapfile = MapDataFile(xsteps,ysteps,hwp_steps,mmw_frequencies=mmw_frequencies,parent_nc=nc,suffix=suffix,
+                              storage=storage)
+        #mapfile.group.microstepping =
+        settler = self._begin_map(mapfile, description, 'simple', settle_mode, max_settle_time,
+                                  time_constant_wait=time_constant_wait)
+        if path is None:
+            points = pathplan.serpentine_points(xsteps, ysteps)
+        else:
+            points = list(path)
+            mapwriter.record_path(mapfile.group, points)
+        self._start_feed(mapfile)
+        self._scan(mapfile, points, time_constant_wait, pipelined=pipelined, buffer_size=buffer_size,
+                   flush_interval=flush_interval, settler=settler)
+
+    def do_scheduled_map(self, xsteps=x_steps, ysteps=y_steps, hwp_steps=hwp_steps, mmw_frequencies=np.array([-1]),
+                         description="", suffix="", settle_time=0.3, time_constant_wait=0.5, order=None,
+                         measure_time=0.05, hwp_step_time=0.37, retune_time=0.05, flush_interval=10.0,
+                         storage='image', settle_mode='fixed', max_settle_time=None, nc=None):
+        """
+        Like do_simple_map, but the stage x and y, the HWP and the mmw frequency are nested, and snake, in the order
+        scheduler.schedules predicts is quickest. The predicted time of each nesting order, and of the one
+        do_simple_map uses, is printed before the scan starts. order, e.g. ['hwp_step', 'y', 'x', 'mmw_frequency'],
+        outermost first, forces a nesting order.
+
+        Stage moves are predicted from the speeds and accelerations the stage is set to; measure_time, hwp_step_time
+        and retune_time are what a lockin reading, one HWP step and retuning the Hittite take. Every reading waits
+        time_constant_wait after any move, or settle_time after a stage move if that is longer; with
+        settle_mode='adaptive' it waits until the lockin has settled instead, as in do_simple_map. As in do_simple_map
+        each HWP index is one motor step and the steps make up a full turn.
+        """
+        self._prepare(mmw_frequencies)
+        hwp_steps = np.atleast_1d(hwp_steps)
+        mmw_frequencies = np.atleast_1d(mmw_frequencies)
+        mapfile = MapDataFile(xsteps,ysteps,hwp_steps,mmw_frequencies=mmw_frequencies,parent_nc=nc,suffix=suffix,
+                              storage=storage)
+        settler = self._begin_map(mapfile, description, 'scheduled', settle_mode, max_settle_time,
+                                  settle_time=settle_time, time_constant_wait=time_constant_wait)
+        if settler is None:
+            stage_settle, settle_guess = max(settle_time, time_constant_wait), time_constant_wait
+        else:
+            # Whatever still shakes after a stage move shows in the lockin output too
+            stage_settle = settle_guess = settler.expected_time
+        model = motion.StageMotionModel.from_stage(self.stage)
+        axes = scheduler.stage_axes(model, xsteps, ysteps, settle_time=stage_settle) + [
+            scheduler.ScanAxis('hwp_step', np.arange(len(hwp_steps)), hwp_step_time, settle_time=settle_guess,
+                               period=len(hwp_steps)),
+            scheduler.ScanAxis('mmw_frequency', mmw_frequencies, retune_time, settle_time=settle_guess,
+                               distance=False)]
+        schedule = self._choose_schedule(mapfile, axes, measure_time, ['y', 'x', 'hwp_step', 'mmw_frequency'], order)
+
+        def measure(index, moved, predicted, timer):
+            x, y, hwp_index, mmw_index = index
+            # Index 0 is home; the step count is zeroed there, so it tells where a homed HWP is
+            current = self.hwp.steps % len(hwp_steps)
+            if 2 in moved and hwp_index != current:
+                tic = time.time()
+                self.hwp.move(int(axes[2].displacement(current, hwp_index)))
+                timer.record('hwp_step', time.time() - tic, predicted.get('hwp_step', 0.))
+            if 3 in moved and self.hittite is not None:
+                tic = time.time()
+                self.hittite.set_freq(mmw_frequencies[mmw_index]/12.0)
+                timer.record('mmw_frequency', time.time() - tic, predicted.get('mmw_frequency', 0.))
+            reading, settle = self._settle(max([axes[k].settle_time for k in moved]), settler)
+            timer.record('settle', settle, predicted.get('settle', 0.))
+            tic = time.time()
+            r,theta = self._measure(reading)
+            timer.record('measure', time.time() - tic, measure_time)
+            self._record(mapfile, x, y, hwp_index, mmw_index, mmw_frequencies[mmw_index], r, self.hwp.steps,
+                         self.hwp.switch_state, settle)
+        self._run_schedule(mapfile, schedule, measure, flush_interval=flush_interval)
+
+    def resume(self, filename, group_name=None, pipelined=False, buffer_size=1000, flush_interval=10.0, plan=True):
+        """
+        Finish an interrupted do_simple_map in the file it was writing (its last map group unless group_name is
+        given). Readings left in the crash journal are recovered first; then only the (x, y, hwp_step,
+        mmw_frequency) cells with no reading, or a NaN one, are measured. Pixels are visited in the order
+        pathplan.plan_path predicts is quickest from where the stage is (serpentine with plan=False). The HWP is
+        homed again and still steps through every position at each pixel, but only missing cells are read.
+        """
+        mapfile = MapDataFile.open(netCDF4.Dataset(filename, mode='a'), group_name)
+        todo, points, settler = self._prepare_resume(mapfile, mapfile.mmw_frequency, plan)
+        if not points:
+            return
+        self._scan(mapfile, points, getattr(mapfile.group, 'time_constant_wait', 0.5), pipelined=pipelined,
+                   buffer_size=buffer_size, flush_interval=flush_interval, todo=todo, settler=settler)
+
+    def _verify_home(self):
+        super(Mapper, self)._verify_home()
+        if self._have_found_home:
+            # Where the HWP stopped in its revolution is unknown; _prepare homes it along with the stage otherwise
+            print "homing HWP..."
+            self.hwp.find_home()
+
+    def _prepare(self, mmw_frequencies):
         if mmw_frequencies[0]!=-1 and self.hittite is None:
             raise Exception("Need Hittite for mmw_frequencies other than -1")
         if self.hittite:
@@ -52,64 +185,163 @@ class Mapper():
             self.hittite.on()
         if not self._have_found_home:
             print "homing stage..."
-            self.stage.find_home()
-            self.stage.find_home()
+            self.stage.find_home(method='continuous')
+            print "home repeatability (steps):", self.stage.home_repeatability
             print "homing HWP..."
             self.hwp.find_home()
             self._have_found_home = True
 
-        mapfile = MapDataFile(xsteps,ysteps,hwp_steps,mmw_frequencies=mmw_frequencies,suffix=suffix)
-        mapfile.group.description = description
-        #mapfile.group.microstepping =
-        self.mapfile = mapfile
-        total_measurements = len(xsteps)*len(ysteps)*len(hwp_steps)
-        measured_so_far = 0
-        start_time = time.time()
-
-        for y in range(len(ysteps)):
-            if y % 2:
-                direction = -1
-            else:
-                direction = 1
-            ystep = ysteps[y]
-            for x in range(len(xsteps))[::direction]:
-                xstep = xsteps[x]
-                self.stage.go_to_position(xstep, ystep)
-                if x % 2:
-                    hwp_dir = -1
-                else:
-                    hwp_dir = 1
+    def _settle(self, wait, settler):
+        # Wait for the lockin output to settle. Returns the last (r, theta) read while settling, if any, and the
+        # time that took.
+        tic = time.time()
+        reading = None
+        if settler is None:
+            time.sleep(wait)
+        else:
+            try:
+                reading, waited, settled = settler.settle(lambda: self.lockin.snap(3,4),
+                                                          value=lambda reading: reading[0])
+                if not settled:
+                    print "lockin still settling after %.2f s" % waited
+            except:
+                print "lockin error"
+        return reading, time.time() - tic
+
+    def _measure(self, reading=None):
+        if reading is not None:
+            return reading
+        try:
+            return self.lockin.snap(3,4)
+        except:
+            print "lockin error"
+            return np.nan,np.nan
+
+    def _scan(self, mapfile, points, time_constant_wait, pipelined=False, buffer_size=1000, flush_interval=10.0,
+              todo=None, settler=None, measure_time=0.05, hwp_step_time=0.37):
+        # todo is a boolean (x, y, hwp_step, mmw_frequency) array of the cells to measure; by default all of them.
+        # measure_time and hwp_step_time are first guesses at how long a lockin reading and an HWP step take.
+        xsteps = mapfile.x[:]
+        ysteps = mapfile.y[:]
+        hwp_steps = mapfile.hwp_step[:]
+        mmw_frequencies = mapfile.mmw_frequency[:]
+        if todo is None:
+            todo = np.ones(mapfile.z.shape, dtype=bool)
+        mapfile.open_writer(flush_interval=flush_interval, telemetry=self.telemetry)
+        total_measurements = sum([todo[x, y].any(axis=1).sum() for (x, y) in points])
+        model = motion.StageMotionModel.from_stage(self.stage)
+        move_times = model.visit_times([(xsteps[x], ysteps[y]) for x, y in points], start=self.stage.get_position())
+        readings = sum([todo[x, y].sum() for x, y in points])
+        if settler is None:
+            settle_guess = time_constant_wait
+        else:
+            # The last reading taken while settling is kept
+            settle_guess, measure_time = settler.expected_time, 0.0
+        timer = motion.ScanTimer({'move': move_times.sum(), 'hwp_step': hwp_step_time * len(hwp_steps) * len(points),
+                                  'settle': settle_guess * readings, 'measure': measure_time * readings},
+                                 total_measurements, telemetry=self.telemetry)
+        print "%d readings at %d pixels predicted to take %.1f minutes" % (readings, len(points),
+                                                                          timer.predicted_time / 60.)
+        self.telemetry.start(mapfile.group.name)
+        timer.start()
 
+        if pipelined:
+            writer = async_devices.DeviceWorker('mapfile', maxsize=buffer_size)
+            hwp = async_devices.AsyncSimpleStepper(self.hwp)
+            if self.hittite is not None:
+                hittite = async_devices.AsyncDevice(self.hittite)
+        pending = collections.deque()
+        first_step = None
+        retune = None
+        moving = False
+        try:
+            for index, (x, y) in enumerate(points):
+                if moving:
+                    self.stage.wait_while_active()
+                    moving = False
+                else:
+                    move_start = time.time()
+                    self.stage.go_to_position(xsteps[x], ysteps[y])
+                timer.record('move', time.time() - move_start, move_times[index])
                 hwp_dir = 1
                 for hwp_index in range(len(hwp_steps))[::hwp_dir]:
-                    steps,switch_state = self.hwp.increment()
+                    tic = time.time()
+                    if first_step is not None:
+                        steps,switch_state = first_step.wait()
+                        first_step = None
+                    else:
+                        steps,switch_state = self.hwp.increment()
+                    timer.record('hwp_step', time.time() - tic, hwp_step_time)
 #                    self.hwp._go_to_position(0,hwp_steps[hwp_index])
 #                    self.hwp._wait_while_active(0)
 #                    time.sleep(settle_time)
-                    for mmw_index,mmw_frequency in enumerate(mmw_frequencies):
+                    mmw_indices = np.flatnonzero(todo[x, y, hwp_index])
+                    for k, mmw_index in enumerate(mmw_indices):
+                        mmw_frequency = mmw_frequencies[mmw_index]
                         #z, _, r, theta = self.lockin.get_data()
-                        try:
-                            self.hittite.set_freq(mmw_frequency/12.0)
-                        except AttributeError:
-                            if mmw_frequencies[0] != -1:
-                                raise Exception("Unable to communicate with hittite, but mmw frequency was requested")
-                        time.sleep(time_constant_wait)
-                        try:
-                            r,theta = self.lockin.snap(3,4)
-                        except:
-                            print "lockin error"
-                            r,theta = np.nan,np.nan
-                        mapfile.z[x,y,hwp_index,mmw_index] = r
-                        mapfile.hwp_step_reading[x,y,hwp_index,mmw_index] = steps
-                        mapfile.hwp_home_indicator[x,y,hwp_index,mmw_index] = switch_state
-                        mapfile.nc.sync()
-                        print x, y, hwp_index, mmw_frequency, r
-                    measured_so_far +=1
-                    time_so_far = time.time()-start_time
-                    time_per_point = time_so_far/measured_so_far
-                    time_remaining = time_per_point*(total_measurements-measured_so_far)
-                    print "%.1f minutes remaining, finish at %s" % (time_remaining/60.,time.ctime(time.time()+time_remaining))
-        self.hwp.hard_stop()
+                        tic = time.time()
+                        if retune is not None:
+                            retune.wait()
+                            retune = None
+                            timer.record('mmw_frequency', time.time() - tic)
+                        else:
+                            try:
+                                self.hittite.set_freq(mmw_frequency/12.0)
+                                timer.record('mmw_frequency', time.time() - tic)
+                            except AttributeError:
+                                if mmw_frequencies[0] != -1:
+                                    raise Exception("Unable to communicate with hittite, but mmw frequency was requested")
+                        reading, settle = self._settle(time_constant_wait, settler)
+                        timer.record('settle', settle, settle_guess)
+                        tic = time.time()
+                        r,theta = self._measure(reading)
+                        timer.record('measure', time.time() - tic, measure_time)
+                        if (pipelined and hwp_index == len(hwp_steps) - 1 and k == len(mmw_indices) - 1
+                                and index + 1 < len(points)):
+                            next_x, next_y = points[index + 1]
+                            move_start = time.time()
+                            self.stage.go_to_position(xsteps[next_x], ysteps[next_y], block=False)
+                            moving = True
+                            first_step = hwp.increment()
+                            if self.hittite is not None:
+                                next_mmw_index = np.argwhere(todo[next_x, next_y])[0][1]
+                                retune = hittite.set_freq(mmw_frequencies[next_mmw_index]/12.0)
+                        if pipelined:
+                            pending.append(writer.submit(self._record, mapfile, x, y, hwp_index, mmw_index,
+                                                         mmw_frequency, r, steps, switch_state, settle))
+                        else:
+                            self._record(mapfile, x, y, hwp_index, mmw_index, mmw_frequency, r, steps, switch_state,
+                                         settle)
+                    if not len(mmw_indices):
+                        continue
+                    timer.point_done()
+                    if pipelined:
+                        writer.submit(timer.report)
+                        # Surface write errors without waiting for the writes still in flight
+                        while pending and pending[0].done():
+                            pending.popleft().wait()
+                    else:
+                        timer.report()
+        finally:
+            if pipelined:
+                writer.close()
+                hwp.close()
+                if self.hittite is not None:
+                    hittite.close()
+            self._finish_map(mapfile)
+        async_devices.gather(*pending)
+
+    def _record(self, mapfile, x, y, hwp_index, mmw_index, mmw_frequency, r, steps, switch_state, settle_time):
+        mapfile.writer.write('z', (x,y,hwp_index,mmw_index), r)
+        mapfile.writer.write('hwp_step_reading', (x,y,hwp_index,mmw_index), steps)
+        mapfile.writer.write('hwp_home_indicator', (x,y,hwp_index,mmw_index), switch_state)
+        if 'settle_duration' in mapfile.map_variables:
+            mapfile.writer.write('settle_duration', (x,y,hwp_index,mmw_index), settle_time)
+        if self.feed is not None:
+            self.feed.publish((x,y,hwp_index,mmw_index), r, mmw_frequency=mmw_frequency, hwp_step_reading=steps,
+                              hwp_home_indicator=switch_state, settle_time=settle_time)
+        print x, y, hwp_index, mmw_frequency, r
+
 
 def create_new_netcdf_file(base_dir='/data/readout/hwp_mapping', suffix=''):
     ase_dir = os.path.expanduser(base_dir)
@@ -129,8 +361,8 @@ def create_new_netcdf_file(base_dir='/data/readout/hwp_mapping', suffix=''):
     return nc,filename
 
 
-class MapDataFile():
-    def __init__(self, x, y, hwp_steps, mmw_frequencies=np.array([-1]), parent_nc = None,suffix=''):
+class MapDataFile(object):
+    def __init__(self, x, y, hwp_steps, mmw_frequencies=np.array([-1]), parent_nc = None,suffix='', storage='image'):
         x = np.atleast_1d(x)
         y = np.atleast_1d(y)
         hwp_steps = np.atleast_1d(hwp_steps)
@@ -143,20 +375,59 @@ class MapDataFile():
         group_name = time.strftime('map_%Y%m%d%H%M%S')
         group = parent_nc.createGroup(group_name)
         self.group = group
+        profile = mapwriter.storage_profile(storage)
+        group.storage = storage if isinstance(storage, str) else 'custom'
         group.createDimension('x', x.shape[0])
-        group.createDimension('y', y.shape[0])
+        group.createDimension('y', None if profile.unlimited else y.shape[0])
         group.createDimension('hwp_step', hwp_steps.shape[0])
         group.createDimension('mmw_frequency', mmw_frequencies.shape[0])
         self.x = group.createVariable('x', np.float, dimensions=('x',))
         self.y = group.createVariable('y', np.float, dimensions=('y',))
         self.hwp_step = group.createVariable('hwp_step',np.float,dimensions=('hwp_step'))
-        self.hwp_step_reading = group.createVariable('hwp_step_reading', np.float, dimensions=('x','y','hwp_step',
-                                                                                               'mmw_frequency'))
-        self.hwp_home_indicator = group.createVariable('hwp_home_indicator', np.int, dimensions=('x','y','hwp_step','mmw_frequency'))
         self.mmw_frequency = group.createVariable('mmw_frequency', np.float, dimensions=('mmw_frequency',))
-        self.z = group.createVariable('z', np.float, dimensions=('x', 'y','hwp_step','mmw_frequency'))
         self.x[:] = x
         self.y[:] = y
         self.hwp_step[:] = hwp_steps
         self.mmw_frequency[:] = mmw_frequencies
+        # Created after the coordinates so the chunk shapes see the full size of an unlimited y
+        dimensions = ('x','y','hwp_step','mmw_frequency')
+        self.hwp_step_reading = profile.create_variable(group, 'hwp_step_reading', dimensions, integer_dtype='i4')
+        self.hwp_home_indicator = profile.create_variable(group, 'hwp_home_indicator', dimensions, dtype=np.int,
+                                                          integer_dtype='i2')
+        self.z = profile.create_variable(group, 'z', dimensions)
+        # Time waited for the lockin before each reading
+        self.settle_duration = profile.create_variable(group, 'settle_duration', dimensions)
+        self.map_variables = ['z', 'hwp_step_reading', 'hwp_home_indicator', 'settle_duration']
+        if profile.unlimited:
+            mapwriter.extend_rows(group, self.map_variables)
+        self.writer = None
+
+    @classmethod
+    def open(cls, nc, group_name=None):
+        """
+        A MapDataFile for a map group already in nc, by default the most recent one.
+        """
+        mapfile = cls.__new__(cls)
+        mapfile.nc = nc
+        mapfile.group = group = mapwriter.find_map_group(nc, group_name)
+        for name in ['x', 'y', 'hwp_step', 'mmw_frequency', 'z', 'hwp_step_reading', 'hwp_home_indicator']:
+            setattr(mapfile, name, group.variables[name])
+        mapfile.map_variables = ['z', 'hwp_step_reading', 'hwp_home_indicator']
+        # Maps written before settle times were recorded have no settle_duration
+        if 'settle_duration' in group.variables:
+            mapfile.settle_duration = group.variables['settle_duration']
+            mapfile.map_variables.append('settle_duration')
+        mapfile.writer = None
+        return mapfile
+
+    def append_rows(self, y):
+        # Only possible with an unlimited y dimension; the new rows read as missing until measured
+        n = len(self.y)
+        y = np.atleast_1d(y)
+        self.y[n:n+len(y)] = y
+        mapwriter.extend_rows(self.group, self.map_variables)
+
+    def open_writer(self, **kwargs):
+        self.writer = mapwriter.BufferedMapWriter(self.nc, self.group, **kwargs)
+        return self.writer
 
@@ -1,72 +1,653 @@
+import collections
+import threading
 import numpy as np
 import netCDF4
 import os
 from matplotlib import pyplot as plt
 import time
+import async_devices
+import basemapper
+import mapwriter
+import motion
+import pathplan
+import scheduler
+import settling
 import stage
-from kid_readout.equipment.lockin_controller import lockinController
-from kid_readout.equipment.hittite_controller import hittiteController
 
 
-class Mapper():
-    def __init__(self):
-        self.stage = stage.Stage()
+class Mapper(basemapper.BaseMapper):
+    def __init__(self, live_address=None, metrics_file=None):
+        # live_address and metrics_file are as in basemapper.BaseMapper
+        super(Mapper, self).__init__(live_address, metrics_file)
+        self.stage = stage.Stage(cache=True)
+        self.stage.transport.telemetry = self.telemetry
         self.stage.initialize()
         # self.stage.find_home()
+        # Imported here so the module, e.g. MapDataFile, can be used without the instrument drivers
+        from kid_readout.equipment.lockin_controller import lockinController
         self.lockin = lockinController(serial_port='/dev/ttyUSB2')
         print self.lockin.get_idn()
         self.lockin.send('OFLT 8') # 100 ms
+        self.lockin_time_constant = settling.SR830_TIME_CONSTANTS[8]
         self.hittite = None
-        self._have_found_home = False
 
     def do_simple_map(self, xsteps=np.arange(0, 10000, 1000), ysteps=np.arange(0, 10000, 1000),
-                      settle_time=0.1, mmw_source_frequencies=-1, description="",suffix=""):
+                      settle_time=0.1, mmw_source_frequencies=-1, description="",suffix="", pipelined=False,
+                      buffer_size=100, path=None, flush_interval=10.0, storage='image', settle_mode='fixed',
+                      max_settle_time=None, range_mode='full', nc=None):
+        """
+        The map is written to a new file in /data/readout/beams, or as a new group of nc, an open netCDF4.Dataset,
+        if given.
+
+        With pipelined=True the move to the next point starts as soon as the last measurement at the current point is
+        taken, the Hittite is retuned to the first frequency during the move, and file writes and progress reports
+        are done on a background thread holding at most buffer_size pending writes.
+
+        path is an optional list of (x_index, y_index) cells to visit in order, e.g. from pathplan.plan_path; by
+        default every cell is visited in a serpentine.
+
+        Readings are buffered in memory and written to the file every flush_interval seconds. storage picks the
+        layout of the file: 'image', 'spectrum' or 'legacy', see mapwriter.StorageProfile. Each reading is also
+        published on the live feed as it is taken (see livefeed), so viewers following that do not need the file
+        and flush_interval can be long.
+
+        settle_mode='fixed' waits settle_time before every reading; 'adaptive' reads the lockin until its output
+        stops changing, at most max_settle_time, see settling.Settler. Either way the time waited is stored for
+        each cell in settle_duration. The time left is predicted from the stage motion model and the measured time
+        of each phase, see motion.ScanTimer.
+
+        range_mode='full' auto-ranges the lockin for every reading; 'predictive' sets the sensitivity that suited the
+        neighbouring readings, see SensitivityPredictor, and only auto-ranges when the reading overloads or
+        under-ranges it.
+        """
+        if np.isscalar(mmw_source_frequencies):
+            mmw_source_frequencies = np.array([mmw_source_frequencies])
+        self._prepare(mmw_source_frequencies)
+
+        mapfile = MapDataFile(xsteps,ysteps,mmw_source_frequencies,parent_nc=nc,suffix=suffix,storage=storage)
+        #mapfile.group.microstepping =
+        settler = self._begin_map(mapfile, description, 'simple', settle_mode, max_settle_time,
+                                  settle_time=settle_time, range_mode=range_mode)
+        if path is None:
+            points = pathplan.serpentine_points(xsteps, ysteps)
+        else:
+            points = list(path)
+            mapwriter.record_path(mapfile.group, points)
+        self._start_feed(mapfile)
+        self._scan(mapfile, points, settle_time, pipelined=pipelined, buffer_size=buffer_size,
+                   flush_interval=flush_interval, settler=settler, predictor=self._predictor(mapfile, range_mode))
+
+    def do_scheduled_map(self, xsteps=np.arange(0, 10000, 1000), ysteps=np.arange(0, 10000, 1000),
+                         settle_time=0.1, mmw_source_frequencies=-1, description="", suffix="", order=None,
+                         measure_time=0.1, retune_time=0.05, flush_interval=10.0, storage='image', settle_mode='fixed',
+                         max_settle_time=None, range_mode='full', nc=None):
+        """
+        Like do_simple_map, but the stage x and y and the source frequency are nested, and snake, in the order
+        scheduler.schedules predicts is quickest. The predicted time of each nesting order, and of the one
+        do_simple_map uses, is printed before the scan starts. order, e.g. ['frequency', 'y', 'x'], outermost first,
+        forces a nesting order.
+
+        Stage moves are predicted from the speeds and accelerations the stage is set to; measure_time and
+        retune_time are what a lockin reading and retuning the Hittite take. Every reading waits settle_time after
+        any move, or until the lockin has settled with settle_mode='adaptive' as in do_simple_map. range_mode is as in
+        do_simple_map too.
+        """
+        if np.isscalar(mmw_source_frequencies):
+            mmw_source_frequencies = np.array([mmw_source_frequencies])
+        self._prepare(mmw_source_frequencies)
+        mapfile = MapDataFile(xsteps,ysteps,mmw_source_frequencies,parent_nc=nc,suffix=suffix,storage=storage)
+        settler = self._begin_map(mapfile, description, 'scheduled', settle_mode, max_settle_time,
+                                  settle_time=settle_time, range_mode=range_mode)
+        settle_guess = settle_time if settler is None else settler.expected_time
+        model = motion.StageMotionModel.from_stage(self.stage)
+        axes = scheduler.stage_axes(model, xsteps, ysteps, settle_time=settle_guess) + [
+            scheduler.ScanAxis('frequency', mmw_source_frequencies, retune_time, settle_time=settle_guess,
+                               distance=False)]
+        schedule = self._choose_schedule(mapfile, axes, measure_time, ['y', 'x', 'frequency'], order)
+        predictor = self._predictor(mapfile, range_mode)
+
+        def measure(index, moved, predicted, timer):
+            x, y, freq_index = index
+            freq = mmw_source_frequencies[freq_index]
+            if 2 in moved and freq > 0:
+                tic = time.time()
+                self.hittite.set_freq(freq/12.0)
+                timer.record('frequency', time.time() - tic, predicted.get('frequency', 0.))
+            settle = self._settle(settle_time, settler)
+            timer.record('settle', settle, predicted.get('settle', 0.))
+            tic = time.time()
+            r,sensitivity = self._measure(predictor, index)
+            timer.record('measure', time.time() - tic, measure_time)
+            self._record(mapfile, x, y, freq_index, freq, r, sensitivity, settle)
+        try:
+            self._run_schedule(mapfile, schedule, measure, flush_interval=flush_interval)
+        finally:
+            self._range_summary(mapfile, predictor)
+
+    def resume(self, filename, group_name=None, pipelined=False, buffer_size=100, flush_interval=10.0, plan=True):
+        """
+        Finish an interrupted do_simple_map in the file it was writing (its last map group unless group_name is
+        given). Readings left in the crash journal are recovered first; then only the cells with no reading, or a NaN
+        one, are measured, in the order pathplan.plan_path predicts is quickest from where the stage is. plan=False
+        visits them in serpentine order instead.
+        """
+        mapfile = MapDataFile.open(netCDF4.Dataset(filename, mode='a'), group_name)
+        todo, points, settler = self._prepare_resume(mapfile, mapfile.frequency, plan)
+        if not points:
+            return
+        predictor = self._predictor(mapfile, getattr(mapfile.group, 'range_mode', 'full'))
+        self._scan(mapfile, points, getattr(mapfile.group, 'settle_time', 0.1), pipelined=pipelined,
+                   buffer_size=buffer_size, flush_interval=flush_interval, todo=todo, settler=settler,
+                   predictor=predictor)
+
+    def _prepare(self, mmw_source_frequencies):
         if not self._have_found_home:
             print "homing..."
-            self.stage.find_home()
-            self.stage.find_home()
+            self.stage.find_home(method='continuous')
+            print "home repeatability (steps):", self.stage.home_repeatability
             self._have_found_home = True
-        if np.isscalar(mmw_source_frequencies):
-            mmw_source_frequencies = np.array([mmw_source_frequencies])
         # if CW mode is used, frequency is > 0
         if mmw_source_frequencies[0] > 0:
             if self.hittite is None:
+                from kid_readout.equipment.hittite_controller import hittiteController
                 self.hittite = hittiteController()
                 self.hittite.set_power(0)
                 self.hittite.on()
 
-        mapfile = MapDataFile(xsteps,ysteps,mmw_source_frequencies,suffix=suffix)
+    def _settle(self, settle_time, settler):
+        # Wait for the lockin output to settle and return the time that took
+        tic = time.time()
+        if settler is None:
+            time.sleep(settle_time)
+        else:
+            reading, waited, settled = settler.settle(lambda: self.lockin.get_data()[2])
+            if not settled:
+                print "lockin still settling after %.2f s" % waited
+        return time.time() - tic
+
+    def _predictor(self, mapfile, range_mode):
+        # None to auto-range every reading. Sensitivities already in mapfile, e.g. when resuming, seed the predictor.
+        if range_mode == 'full':
+            return None
+        if range_mode == 'predictive':
+            return SensitivityPredictor(np.ma.filled(mapfile.sensitivity[:], -1),
+                                        np.ma.filled(mapfile.z[:].astype(np.float), np.nan))
+        raise ValueError("Unknown range mode %r, must be 'full' or 'predictive'" % range_mode)
+
+    def _measure(self, predictor, cell):
+        # A lockin reading and the sensitivity it was taken at
+        if predictor is not None:
+            sensitivity = predictor.predict(*cell)
+            if sensitivity is not None:
+                if sensitivity != predictor.current:
+                    self.lockin.send('SENS %d' % sensitivity)
+                    predictor.current = sensitivity
+                    predictor.range_changes += 1
+                    time.sleep(self.lockin_time_constant)
+                z, _, r, theta = self.lockin.get_data()
+                if predictor.in_range(r, sensitivity):
+                    predictor.update(cell, sensitivity, r, predicted=True)
+                    return r, sensitivity
+                predictor.fallbacks += 1
+        r,sensitivity = self.lockin.auto_range_measure(debug=True)
+        if predictor is not None:
+            predictor.current = sensitivity
+            predictor.update(cell, sensitivity, r)
+        return r, sensitivity
+
+    def _range_summary(self, mapfile, predictor):
+        if predictor is None:
+            return
+        print predictor.summary()
+        mapfile.group.auto_ranges = predictor.auto_ranges
+        mapfile.group.auto_ranges_saved = predictor.auto_ranges_saved
+        mapfile.group.range_changes = predictor.range_changes
+
+    def _scan(self, mapfile, points, settle_time, pipelined=False, buffer_size=100, flush_interval=10.0, todo=None,
+              settler=None, measure_time=0.1, predictor=None):
+        # todo is a boolean (x, y, frequency) array of the cells to measure; by default all of them. measure_time is
+        # the first guess at how long a lockin reading takes.
+        xsteps = mapfile.x[:]
+        ysteps = mapfile.y[:]
+        mmw_source_frequencies = mapfile.frequency[:]
+        if todo is None:
+            todo = np.ones(mapfile.z.shape, dtype=bool)
+        mapfile.open_writer(flush_interval=flush_interval, telemetry=self.telemetry)
+        model = motion.StageMotionModel.from_stage(self.stage)
+        move_times = model.visit_times([(xsteps[x], ysteps[y]) for x, y in points], start=self.stage.get_position())
+        readings = sum([todo[x, y].sum() for x, y in points])
+        settle_guess = settle_time if settler is None else settler.expected_time
+        timer = motion.ScanTimer({'move': move_times.sum(), 'settle': settle_guess * readings,
+                                  'measure': measure_time * readings}, len(points), telemetry=self.telemetry)
+        print "%d readings at %d points predicted to take %.1f minutes" % (readings, len(points),
+                                                                          timer.predicted_time / 60.)
+        self.telemetry.start(mapfile.group.name)
+        timer.start()
+
+        if pipelined:
+            writer = async_devices.DeviceWorker('mapfile', maxsize=buffer_size)
+            if self.hittite is not None:
+                hittite = async_devices.AsyncDevice(self.hittite)
+        pending = collections.deque()
+        retune = None
+        moving = False
+        try:
+            for index, (x, y) in enumerate(points):
+                if moving:
+                    self.stage.wait_while_active()
+                    moving = False
+                else:
+                    move_start = time.time()
+                    self.stage.go_to_position(xsteps[x], ysteps[y])
+                timer.record('move', time.time() - move_start, move_times[index])
+                freq_indices = np.flatnonzero(todo[x, y])
+                for k, freq_index in enumerate(freq_indices):
+                    freq = mmw_source_frequencies[freq_index]
+                    tic = time.time()
+                    if retune is not None:
+                        retune.wait()
+                        retune = None
+                        timer.record('frequency', time.time() - tic)
+                    elif freq > 0:
+                        self.hittite.set_freq(freq/12.0)
+                        timer.record('frequency', time.time() - tic)
+                    settle = self._settle(settle_time, settler)
+                    timer.record('settle', settle, settle_guess)
+                    tic = time.time()
+                    #z, _, r, theta = self.lockin.get_data()
+                    r,sensitivity = self._measure(predictor, (x, y, freq_index))
+                    timer.record('measure', time.time() - tic, measure_time)
+                    if pipelined and k == len(freq_indices) - 1 and index + 1 < len(points):
+                        next_x, next_y = points[index + 1]
+                        move_start = time.time()
+                        self.stage.go_to_position(xsteps[next_x], ysteps[next_y], block=False)
+                        moving = True
+                        if mmw_source_frequencies[0] > 0:
+                            next_freq = mmw_source_frequencies[np.flatnonzero(todo[next_x, next_y])[0]]
+                            retune = hittite.set_freq(next_freq/12.0)
+                    if pipelined:
+                        pending.append(writer.submit(self._record, mapfile, x, y, freq_index, freq, r, sensitivity,
+                                                     settle))
+                    else:
+                        self._record(mapfile, x, y, freq_index, freq, r, sensitivity, settle)
+                timer.point_done()
+                if pipelined:
+                    writer.submit(timer.report)
+                    # Surface write errors without waiting for the writes still in flight
+                    while pending and pending[0].done():
+                        pending.popleft().wait()
+                else:
+                    timer.report()
+        finally:
+            if pipelined:
+                writer.close()
+                if self.hittite is not None:
+                    hittite.close()
+            self._range_summary(mapfile, predictor)
+            self._finish_map(mapfile)
+        async_devices.gather(*pending)
+
+    def do_fly_map(self, xsteps=np.arange(0, 10000, 1000), ysteps=np.arange(0, 10000, 1000), velocity=200,
+                   sample_interval=0.05, position_interval=0.1, lag=0.0, max_lag=1.0, overscan=0,
+                   mmw_source_frequency=-1, description="", suffix="", flush_interval=10.0, nc=None):
+        """
+        Continuous scan: each row of the serpentine is driven at constant velocity (steps/s, through set_speed) while
+        the lockin is read every sample_interval seconds and the x position polled every position_interval seconds,
+        all with host timestamps. Samples are placed on xsteps by interpolating the position in time, shifted by lag
+        seconds to undo the lockin's output delay. lag='auto' picks the lag between 0 and max_lag that best lines up
+        forward and backward rows, and z is only filled in once the scan is done. The raw time-stamped samples are
+        stored next to the gridded z, a row at a time.
+
+        As in do_simple_map, the gridded readings are buffered and written every flush_interval seconds, published on
+        the live feed, and written to nc if given.
+        """
+        self._prepare([mmw_source_frequency])
+        if mmw_source_frequency > 0:
+            self.hittite.set_freq(mmw_source_frequency/12.0)
+
+        mapfile = MapDataFile(xsteps,ysteps,mmw_source_frequency,parent_nc=nc,suffix=suffix)
+        self._begin_map(mapfile, description, 'fly', settle_mode=None, velocity=velocity)
+        mapfile.create_fly_scan_variables()
+        mapfile.sensitivity[:] = np.ma.masked
+
+        scan_speed = self.stage.get_speed(axis=0)
+        xmin = np.min(xsteps) - overscan
+        xmax = np.max(xsteps) + overscan
+        rows = []
+        start_time = time.time()
+        self._start_feed(mapfile)
+        mapfile.open_writer(flush_interval=flush_interval, telemetry=self.telemetry)
+        self.telemetry.start(mapfile.group.name)
+        try:
+            try:
+                for y in range(len(ysteps)):
+                    if y % 2:
+                        start, end = xmax, xmin
+                    else:
+                        start, end = xmin, xmax
+                    tic = time.time()
+                    self.stage.set_speed(*scan_speed, axis=0)
+                    self.stage.go_to_position(start, ysteps[y])
+                    self.stage.set_speed(velocity, velocity, axis=0)
+                    self.telemetry.phase('move', time.time() - tic)
+                    row_start = time.time()
+                    logger = PositionLogger(self.stage, 0, end, position_interval)
+                    logger.record(start)
+                    self.stage.go_to_position(end, ysteps[y], block=False)
+                    logger.start()
+                    sample_times = []
+                    samples = []
+                    while not logger.finished.is_set():
+                        tic = time.time()
+                        z, _, r, theta = self.lockin.get_data()
+                        sample_times.append((tic + time.time()) / 2)
+                        samples.append(r)
+                        time.sleep(max(0, sample_interval - (time.time() - tic)))
+                    logger.join()
+                    self.stage.wait_while_active()
+                    self.telemetry.phase('fly', time.time() - row_start)
+                    row = (np.array(sample_times), np.array(samples, dtype=np.float), np.array(logger.times),
+                           np.array(logger.positions, dtype=np.float))
+                    rows.append(row)
+                    mapfile.append_fly_scan_row(y, *row)
+                    mapfile.nc.sync()
+                    if lag != 'auto':
+                        self._record_row(mapfile, y, grid_row(xsteps, row, lag))
+                    self.telemetry.point_done()
+                    print_progress(start_time, y + 1, len(ysteps))
+            finally:
+                self.stage.set_speed(*scan_speed, axis=0)
+            if lag == 'auto':
+                lag = estimate_lag(xsteps, rows, max_lag)
+                print "estimated lag %.3f s" % lag
+                for y, row in enumerate(rows):
+                    self._record_row(mapfile, y, grid_row(xsteps, row, lag))
+            mapfile.group.lag = lag
+        finally:
+            self._finish_map(mapfile)
+
+    def _record_row(self, mapfile, y, values):
+        # Gridded readings of a fly scan row, NaN where the row did not reach
+        for x, value in enumerate(values):
+            mapfile.writer.write('z', (x, y, 0), value)
+            if self.feed is not None and np.isfinite(value):
+                self.feed.publish((x, y, 0), value)
+
+    def do_adaptive_map(self, xsteps=np.arange(0, 10000, 250), ysteps=np.arange(0, 10000, 250), coarse_stride=8,
+                        max_points=None, min_size=1, gradient_threshold=0.05, signal_threshold=0.1, settle_time=0.1,
+                        mmw_source_frequency=-1, description="", suffix="", flush_interval=10.0, nc=None):
+        """
+        Adaptive map on the grid xsteps x ysteps: measure every coarse_stride-th cell first, then repeatedly split the
+        squares whose corners differ by more than gradient_threshold of the range seen so far, or reach more than
+        signal_threshold of the peak, and measure the new corners. Stops when no square needs refining, squares are
+        down to min_size cells, or max_points (default half the grid) have been measured; the squares most in need of
+        refining go first, and any whose new corners no longer fit in max_points are skipped. The coarse grid alone
+        must fit in max_points. Each batch of points is visited in an order from pathplan.
+
+        Readings are buffered and written every flush_interval seconds as in do_simple_map, and at the end of every
+        level. Each level is also stored in the point variables of the map group, and z holds the bilinear
+        interpolation over the squares so far so MapFileViewer can show it. The map is written to nc if given.
+        """
+        if max_points is None:
+            max_points = len(xsteps)*len(ysteps)//2
+        xcorners = sorted(set(range(0, len(xsteps), coarse_stride)) | set([len(xsteps) - 1]))
+        ycorners = sorted(set(range(0, len(ysteps), coarse_stride)) | set([len(ysteps) - 1]))
+        if len(xcorners) * len(ycorners) > max_points:
+            raise ValueError("The coarse grid has %d points, more than max_points=%d; use a larger coarse_stride"
+                             % (len(xcorners) * len(ycorners), max_points))
+        self._prepare([mmw_source_frequency])
+        if mmw_source_frequency > 0:
+            self.hittite.set_freq(mmw_source_frequency/12.0)
+
+        mapfile = MapDataFile(xsteps,ysteps,mmw_source_frequency,parent_nc=nc,suffix=suffix)
         mapfile.group.description = description
-        #mapfile.group.microstepping =
+        mapfile.group.scan_mode = 'adaptive'
+        mapfile.create_point_variables()
         self.mapfile = mapfile
-        total_measurements = len(xsteps)*len(ysteps)
-        measured_so_far = 0
-        start_time = time.time()
+        model = motion.StageMotionModel.from_stage(self.stage)
 
-        for y in range(len(ysteps)):
-            if y % 2:
-                direction = -1
-            else:
-                direction = 1
-            ystep = ysteps[y]
-            for x in range(len(xsteps))[::direction]:
-                xstep = xsteps[x]
-                self.stage.go_to_position(xstep, ystep)
-                for freq_index,freq in enumerate(mmw_source_frequencies):
-                    if freq > 0:
-                        self.hittite.set_freq(freq/12.0)
+        squares = [(x0, x1, y0, y1) for x0, x1 in zip(xcorners[:-1], xcorners[1:])
+                   for y0, y1 in zip(ycorners[:-1], ycorners[1:])]
+        if len(xcorners) == 1 or len(ycorners) == 1:
+            squares = [(xcorners[0], xcorners[-1], ycorners[0], ycorners[-1])]
+        measured = {}
+        new_points = [(x, y) for y in ycorners for x in xcorners]
+        level = 0
+        start_time = time.time()
+        mapfile.open_writer(flush_interval=flush_interval)
+        try:
+            while new_points:
+                print "level %d: measuring %d points" % (level, len(new_points))
+                planned = pathplan.plan_path(new_points, xsteps, ysteps, model, start=self.stage.get_position())
+                sensitivities = []
+                for x, y in planned.points:
+                    self.stage.go_to_position(xsteps[x], ysteps[y])
                     time.sleep(settle_time)
-                    #z, _, r, theta = self.lockin.get_data()
                     r,sensitivity = self.lockin.auto_range_measure(debug=True)
-                    mapfile.z[x,y,freq_index] = r
-                    mapfile.sensitivity[x,y,freq_index] = sensitivity
-                    mapfile.nc.sync()
-                    print x, y, freq, r
-                measured_so_far +=1
-                time_so_far = time.time()-start_time
-                time_per_point = time_so_far/measured_so_far
-                time_remaining = time_per_point*(total_measurements-measured_so_far)
-                print "%.1f minutes remaining, finish at %s" % (time_remaining/60.,time.ctime(time.time()+time_remaining))
+                    measured[(x, y)] = r
+                    sensitivities.append(sensitivity)
+                    mapfile.writer.write('z', (x, y, 0), r)
+                    mapfile.writer.write('sensitivity', (x, y, 0), sensitivity)
+                    print x, y, r
+                mapfile.writer.flush()
+                mapfile.append_points(planned.points, [measured[point] for point in planned.points], sensitivities,
+                                      level)
+                mapfile.z[:,:,0] = interpolate_squares(xsteps, ysteps, squares, measured)
+                mapfile.nc.sync()
+                print "%d points measured in %.1f minutes" % (len(measured), (time.time() - start_time)/60.)
+
+                values = np.array(measured.values())
+                value_range = np.ptp(values)
+                peak = np.max(np.abs(values))
+                candidates = []
+                for square in squares:
+                    x0, x1, y0, y1 = square
+                    if x1 - x0 <= min_size and y1 - y0 <= min_size:
+                        continue
+                    corners = np.array([measured[(x0, y0)], measured[(x1, y0)], measured[(x0, y1)],
+                                        measured[(x1, y1)]])
+                    gradient = np.ptp(corners) / value_range if value_range > 0 else 0
+                    signal = np.max(np.abs(corners)) / peak if peak > 0 else 0
+                    if gradient > gradient_threshold or signal > signal_threshold:
+                        candidates.append((max(gradient, signal) * (x1 - x0) * (y1 - y0), square))
+                candidates.sort(reverse=True)
+                new_points = []
+                for priority, square in candidates:
+                    children = split_square(square)
+                    points = set([corner for child in children for corner in square_corners(child)])
+                    points = [point for point in points if point not in measured and point not in new_points]
+                    if len(measured) + len(new_points) + len(points) > max_points:
+                        continue
+                    new_points += points
+                    squares.remove(square)
+                    squares += children
+                level += 1
+        finally:
+            mapfile.writer.close()
+        mapfile.group.levels = level
+
+    def _record(self, mapfile, x, y, freq_index, freq, r, sensitivity, settle_time):
+        mapfile.writer.write('z', (x,y,freq_index), r)
+        mapfile.writer.write('sensitivity', (x,y,freq_index), sensitivity)
+        if 'settle_duration' in mapfile.map_variables:
+            mapfile.writer.write('settle_duration', (x,y,freq_index), settle_time)
+        if self.feed is not None:
+            self.feed.publish((x,y,freq_index), r, sensitivity=sensitivity, frequency=freq, settle_time=settle_time)
+        print x, y, freq, r
+
+
+class SensitivityPredictor(object):
+    """
+    Predicts the lockin sensitivity for a reading at (x, y, frequency index) from the readings nearby: the last
+    frequency read at this pixel, or else the previous pixel of the path at the same frequency, carried on by how
+    much the reading changed from the pixel before, or else the neighbouring pixels in the rows above and below. The
+    sensitivity is chosen to put the predicted reading at the geometric middle of the range between under_range and
+    over_range of full scale, unless the sensitivity the lockin is at already has it well inside that range; a reading
+    outside that range is auto-ranged instead.
+
+    sensitivity and r hold the sensitivity and reading of every cell so far, -1 and NaN where there is none.
+    """
+    def __init__(self, sensitivity, r, over_range=0.9, under_range=0.05):
+        self.sensitivity = np.array(sensitivity, dtype=np.int)
+        self.r = np.abs(np.array(r, dtype=np.float))
+        self.over_range = over_range
+        self.under_range = under_range
+        # Sensitivity the lockin is set to, if known
+        self.current = None
+        self.auto_ranges = 0
+        self.auto_ranges_saved = 0
+        self.fallbacks = 0
+        self.range_changes = 0
+        self._pixels = [None, None]
+        self._frequency = None
+
+    def estimate(self, x, y, freq_index):
+        if (x, y) == self._pixels[-1]:
+            return self.r[x, y, self._frequency]
+        before, previous = self._pixels
+        if previous is not None and np.isfinite(self.r[previous + (freq_index,)]):
+            r = self.r[previous + (freq_index,)]
+            if before is not None and self.r[before + (freq_index,)] > 0:
+                r *= np.clip(r / self.r[before + (freq_index,)], 0.1, 10)
+            return r
+        rows = [self.r[x, row, freq_index] for row in [y - 1, y + 1] if 0 <= row < self.r.shape[1]]
+        rows = [r for r in rows if np.isfinite(r)]
+        if rows:
+            return max(rows)
+        return np.nan
+
+    def predict(self, x, y, freq_index):
+        r = self.estimate(x, y, freq_index)
+        if not np.isfinite(r):
+            return None
+        if self.current is not None:
+            # Stay put while the prediction is well inside the current range
+            fraction = r / settling.SR830_SENSITIVITIES[self.current]
+            if 2 * self.under_range <= fraction <= self.over_range / 2 or (fraction <= self.over_range / 2 and
+                                                                            self.current == 0):
+                return self.current
+        middle = np.sqrt(self.over_range * self.under_range)
+        for sensitivity, full_scale in enumerate(settling.SR830_SENSITIVITIES):
+            if r <= middle * full_scale:
+                return sensitivity
+        return len(settling.SR830_SENSITIVITIES) - 1
+
+    def in_range(self, r, sensitivity):
+        full_scale = settling.SR830_SENSITIVITIES[sensitivity]
+        if not np.isfinite(r):
+            return False
+        if sensitivity < len(settling.SR830_SENSITIVITIES) - 1 and abs(r) > self.over_range * full_scale:
+            return False
+        return sensitivity == 0 or abs(r) >= self.under_range * full_scale
+
+    def update(self, cell, sensitivity, r, predicted=False):
+        x, y, freq_index = cell
+        self.sensitivity[cell] = sensitivity
+        self.r[cell] = abs(r)
+        if predicted:
+            self.auto_ranges_saved += 1
+        else:
+            self.auto_ranges += 1
+        if (x, y) != self._pixels[-1]:
+            self._pixels = [self._pixels[-1], (x, y)]
+        self._frequency = freq_index
+
+    def summary(self):
+        return ("auto-ranged %d readings (%d predicted sensitivities failed), saved %d auto-ranges with %d range "
+                "changes" % (self.auto_ranges, self.fallbacks, self.auto_ranges_saved, self.range_changes))
+
+
+class PositionLogger(threading.Thread):
+    """
+    Polls one axis position in the background until it reaches target or stops moving, keeping host timestamps
+    taken half way through each query.
+    """
+    def __init__(self, stage, axis, target, interval):
+        super(PositionLogger, self).__init__()
+        self.daemon = True
+        self.stage = stage
+        self.axis = axis
+        self.target = target
+        self.interval = interval
+        self.times = []
+        self.positions = []
+        self.finished = threading.Event()
+
+    def record(self, position, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.times.append(timestamp)
+        self.positions.append(position)
+
+    def run(self):
+        try:
+            while True:
+                tic = time.time()
+                position = self.stage._get_position(self.axis)
+                self.record(position, (tic + time.time()) / 2)
+                if position == self.target or (len(self.positions) > 3 and
+                                               self.positions[-3:] == [position, position, position]):
+                    break
+                time.sleep(max(0, self.interval - (time.time() - tic)))
+        finally:
+            self.finished.set()
+
+
+def grid_row(xsteps, row, lag):
+    # Position of the stage when each lockin sample was taken, lag seconds before the sample was read
+    sample_times, samples, position_times, positions = row
+    sample_positions = np.interp(sample_times - lag, position_times, positions)
+    order = np.argsort(sample_positions)
+    return np.interp(xsteps, sample_positions[order], samples[order], left=np.nan, right=np.nan)
+
+
+def estimate_lag(xsteps, rows, max_lag, num_lags=101):
+    # Forward and backward rows are shifted in opposite directions by a wrong lag, so pick the lag that minimizes the
+    # mismatch between neighbouring rows
+    lags = np.linspace(0, max_lag, num_lags)
+    mismatch = []
+    for lag in lags:
+        grid = np.array([grid_row(xsteps, row, lag) for row in rows])
+        mismatch.append(np.nanmean((grid[1:] - grid[:-1]) ** 2))
+    return lags[np.nanargmin(mismatch)]
+
+
+def square_corners(square):
+    x0, x1, y0, y1 = square
+    return [(x0, y0), (x1, y0), (x0, y1), (x1, y1)]
+
+
+def split_square(square):
+    # Halve each side that is longer than one cell
+    x0, x1, y0, y1 = square
+    xm = (x0 + x1) // 2
+    ym = (y0 + y1) // 2
+    xs = [(x0, xm), (xm, x1)] if xm > x0 else [(x0, x1)]
+    ys = [(y0, ym), (ym, y1)] if ym > y0 else [(y0, y1)]
+    return [(a, b, c, d) for a, b in xs for c, d in ys]
+
+
+def interpolate_squares(xsteps, ysteps, squares, measured):
+    # Bilinear interpolation inside each square from its corners; measured cells keep their values
+    z = np.empty((len(xsteps), len(ysteps)))
+    z[:] = np.nan
+    for x0, x1, y0, y1 in squares:
+        u = (xsteps[x0:x1+1] - xsteps[x0]) / float(xsteps[x1] - xsteps[x0]) if x1 > x0 else np.zeros(1)
+        v = (ysteps[y0:y1+1] - ysteps[y0]) / float(ysteps[y1] - ysteps[y0]) if y1 > y0 else np.zeros(1)
+        u = u[:, None]
+        v = v[None, :]
+        z[x0:x1+1, y0:y1+1] = ((1 - u) * (1 - v) * measured[(x0, y0)] + u * (1 - v) * measured[(x1, y0)] +
+                               (1 - u) * v * measured[(x0, y1)] + u * v * measured[(x1, y1)])
+    for (x, y), value in measured.items():
+        z[x, y] = value
+    return z
+
+
+def print_progress(start_time, measured_so_far, total_measurements):
+    time_so_far = time.time()-start_time
+    time_per_point = time_so_far/measured_so_far
+    time_remaining = time_per_point*(total_measurements-measured_so_far)
+    print "%.1f minutes remaining, finish at %s" % (time_remaining/60.,time.ctime(time.time()+time_remaining))
 
 
 def create_new_netcdf_file(base_dir='/data/readout/beams', suffix=''):
@@ -87,8 +668,8 @@ def create_new_netcdf_file(base_dir='/data/readout/beams', suffix=''):
     return nc,filename
 
 
-class MapDataFile():
-    def __init__(self, x, y, frequency, parent_nc = None,suffix=''):
+class MapDataFile(object):
+    def __init__(self, x, y, frequency, parent_nc = None,suffix='', storage='image'):
         if np.isscalar(frequency):
             frequency = np.array([frequency])
         if parent_nc is None:
@@ -99,16 +680,97 @@ class MapDataFile():
         group_name = time.strftime('map_%Y%m%d%H%M%S')
         group = parent_nc.createGroup(group_name)
         self.group = group
+        profile = mapwriter.storage_profile(storage)
+        group.storage = storage if isinstance(storage, str) else 'custom'
         group.createDimension('x', x.shape[0])
-        group.createDimension('y', y.shape[0])
+        group.createDimension('y', None if profile.unlimited else y.shape[0])
         group.createDimension('frequency', frequency.shape[0])
         self.x = group.createVariable('x', np.float, dimensions=('x',))
         self.y = group.createVariable('y', np.float, dimensions=('y',))
         self.frequency = group.createVariable('frequency', np.float, dimensions=('frequency',))
-        self.z = group.createVariable('z', np.float, dimensions=('x', 'y','frequency'))
-        self.sensitivity = group.createVariable('sensitivity', np.float, dimensions=('x', 'y','frequency'))
         self.x[:] = x
         self.y[:] = y
         self.frequency[:] = frequency
+        # Created after the coordinates so the chunk shapes see the full size of an unlimited y
+        self.z = profile.create_variable(group, 'z', ('x', 'y','frequency'))
+        self.sensitivity = profile.create_variable(group, 'sensitivity', ('x', 'y','frequency'), integer_dtype='i2')
+        # Time waited for the lockin before each reading
+        self.settle_duration = profile.create_variable(group, 'settle_duration', ('x', 'y','frequency'))
+        self.map_variables = ['z', 'sensitivity', 'settle_duration']
+        if profile.unlimited:
+            mapwriter.extend_rows(group, self.map_variables)
+        self.writer = None
+
+    @classmethod
+    def open(cls, nc, group_name=None):
+        """
+        A MapDataFile for a map group already in nc, by default the most recent one.
+        """
+        mapfile = cls.__new__(cls)
+        mapfile.nc = nc
+        mapfile.group = group = mapwriter.find_map_group(nc, group_name)
+        mapfile.x = group.variables['x']
+        mapfile.y = group.variables['y']
+        mapfile.frequency = group.variables['frequency']
+        mapfile.z = group.variables['z']
+        mapfile.sensitivity = group.variables['sensitivity']
+        mapfile.map_variables = ['z', 'sensitivity']
+        # Maps written before settle times were recorded have no settle_duration
+        if 'settle_duration' in group.variables:
+            mapfile.settle_duration = group.variables['settle_duration']
+            mapfile.map_variables.append('settle_duration')
+        mapfile.writer = None
+        return mapfile
+
+    def append_rows(self, y):
+        # Only possible with an unlimited y dimension; the new rows of z read as missing until measured
+        n = len(self.y)
+        y = np.atleast_1d(y)
+        self.y[n:n+len(y)] = y
+        mapwriter.extend_rows(self.group, self.map_variables)
+
+    def open_writer(self, **kwargs):
+        self.writer = mapwriter.BufferedMapWriter(self.nc, self.group, **kwargs)
+        return self.writer
+
+    def create_point_variables(self):
+        group = self.group
+        group.createDimension('point', None)
+        self.point_x_index = group.createVariable('point_x_index', np.int32, dimensions=('point',))
+        self.point_y_index = group.createVariable('point_y_index', np.int32, dimensions=('point',))
+        self.point_level = group.createVariable('point_level', np.int32, dimensions=('point',))
+        self.point_z = group.createVariable('point_z', np.float, dimensions=('point',))
+        self.point_sensitivity = group.createVariable('point_sensitivity', np.float, dimensions=('point',))
+
+    def append_points(self, points, z, sensitivity, level):
+        # points is a list of (x_index, y_index), all measured at the same level
+        n = len(self.point_z)
+        m = n + len(points)
+        self.point_x_index[n:m] = [x for (x, y) in points]
+        self.point_y_index[n:m] = [y for (x, y) in points]
+        self.point_level[n:m] = level
+        self.point_z[n:m] = z
+        self.point_sensitivity[n:m] = sensitivity
+
+    def create_fly_scan_variables(self):
+        group = self.group
+        group.createDimension('sample', None)
+        group.createDimension('position_sample', None)
+        self.sample_time = group.createVariable('sample_time', np.float, dimensions=('sample',))
+        self.sample_row = group.createVariable('sample_row', np.int32, dimensions=('sample',))
+        self.sample_r = group.createVariable('sample_r', np.float, dimensions=('sample',))
+        self.position_time = group.createVariable('position_time', np.float, dimensions=('position_sample',))
+        self.position_row = group.createVariable('position_row', np.int32, dimensions=('position_sample',))
+        self.position_x = group.createVariable('position_x', np.float, dimensions=('position_sample',))
+
+    def append_fly_scan_row(self, y, sample_times, samples, position_times, positions):
+        n = len(self.sample_time)
+        self.sample_time[n:n+len(samples)] = sample_times
+        self.sample_row[n:n+len(samples)] = y
+        self.sample_r[n:n+len(samples)] = samples
+        n = len(self.position_time)
+        self.position_time[n:n+len(positions)] = position_times
+        self.position_row[n:n+len(positions)] = y
+        self.position_x[n:n+len(positions)] = positions
 
 
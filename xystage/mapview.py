@@ -1,22 +1,43 @@
 # based on: http://scipy-central.org/item/22/4/building-a-simple-interactive-2d-data-viewer-with-matplotlib
+import collections
 import os
+import threading
 import time
 
 __author__ = 'gjones'
 
 import netCDF4
-from matplotlib.widgets import Cursor, Button
+from matplotlib.widgets import Cursor, Button, Slider
 import matplotlib.pyplot as plt
 import numpy as np
+import async_devices
+import livefeed
 plt.rcParams['font.size']=8
 
 
+class NearestIndex(object):
+    """
+    Index of the value nearest to a given one, by bisection: the same as np.argmin(np.abs(values - value)) but
+    without scanning every value. values need not be sorted.
+    """
+    def __init__(self, values):
+        values = np.asarray(values, dtype=np.float)
+        self.order = np.argsort(values, kind='mergesort')
+        ordered = values[self.order]
+        self.midpoints = (ordered[1:] + ordered[:-1]) / 2.
+
+    def __call__(self, value):
+        return self.order[np.searchsorted(self.midpoints, value)]
+
+
 class Viewer2d(object):
-    def __init__(self,z,x=None, y=None):
+    def __init__(self,z,x=None, y=None, fast=True, frame_rate=60):
         """
         Shows a given array in a 2d-viewer.
         Input: z, an 2d array.
         x,y coordinters are optional.
+        With fast, the cuts follow the mouse by redrawing only the two cut lines over a cached background, at most
+        frame_rate times a second; otherwise the whole figure is drawn for every mouse motion event.
         """
         if x is None:
             self.x=np.arange(z.shape[0])
@@ -36,8 +57,19 @@ class Viewer2d(object):
         self.overview.autoscale(1,'both',1)
         self.x_subplot=plt.subplot2grid((8,4),(0,2),rowspan=4,colspan=2)
         self.y_subplot=plt.subplot2grid((8,4),(4,2),rowspan=4,colspan=2)
-        self.xline, = self.x_subplot.plot(self.x,z[z.shape[0]//2,:])
-        self.yline, = self.y_subplot.plot(self.y,z[:,z.shape[0]//2])
+        self.xline, = self.x_subplot.plot(self.x,z[z.shape[0]//2,:],animated=fast)
+        self.yline, = self.y_subplot.plot(self.y,z[:,z.shape[0]//2],animated=fast)
+        self.fast = fast
+        self.x_index = NearestIndex(self.x)
+        self.y_index = NearestIndex(self.y)
+        self.frame_rate = frame_rate
+        self._cursor = None
+        self._cursor_index = None
+        self._last_render = 0
+        self._render_pending = False
+        self._render_timer = self.fig.canvas.new_timer(interval=int(1000. / frame_rate))
+        self._render_timer.single_shot = True
+        self._render_timer.add_callback(self._render_pending_cursor)
 
 
         #Adding widgets, to not be gc'ed, they are put in a list:
@@ -53,6 +85,41 @@ class Viewer2d(object):
         legend_button.on_clicked(self.show_legend)
         self.fig.canvas.mpl_connect('button_press_event',self.click)
         self.fig.canvas.mpl_connect('motion_notify_event',self.motion)
+        self._backgrounds = {}
+        self.fig.canvas.mpl_connect('draw_event',self._cache_backgrounds)
+
+    def _cache_backgrounds(self, event):
+        for ax in [self.overview,self.x_subplot,self.y_subplot]:
+            self._backgrounds[ax] = self.fig.canvas.copy_from_bbox(ax.bbox)
+        if self.fast:
+            # Full draws leave out the animated cut lines
+            for line in [self.xline,self.yline]:
+                line.axes.draw_artist(line)
+
+    def blit(self, artists):
+        """
+        Redraw only the given artists, each over the background its axes had at the last full draw.
+        """
+        canvas = self.fig.canvas
+        axes = []
+        for artist in artists:
+            if artist.axes not in axes:
+                axes.append(artist.axes)
+        if not canvas.supports_blit or any(ax not in self._backgrounds for ax in axes):
+            canvas.draw_idle()
+            return
+        for ax in axes:
+            canvas.restore_region(self._backgrounds[ax])
+        for artist in artists:
+            artist.axes.draw_artist(artist)
+        for ax in axes:
+            canvas.blit(ax.bbox)
+
+    def mesh_values(self, z):
+        # pcolormesh drops the last row and column of z when it has as many as there are x and y coordinates
+        if self.quad.get_array().size == z.size:
+            return np.ma.ravel(z)
+        return np.ma.ravel(z[:-1,:-1])
 
     def show_legend(self, event):
         """Shows legend for the plots"""
@@ -72,11 +139,36 @@ class Viewer2d(object):
         pass
     def motion(self,event):
         if event.inaxes == self.overview:
-            xpos=np.argmin(np.abs(event.xdata-self.x))
-            ypos=np.argmin(np.abs(event.ydata-self.y))
-            self.xline.set_ydata(self.z[ypos,:])
-            self.yline.set_ydata(self.z[:,xpos])
-            plt.draw()
+            if not self.fast:
+                xpos=np.argmin(np.abs(event.xdata-self.x))
+                ypos=np.argmin(np.abs(event.ydata-self.y))
+                self.xline.set_ydata(self.z[ypos,:])
+                self.yline.set_ydata(self.z[:,xpos])
+                plt.draw()
+                return
+            # Events faster than the frame rate only move the cursor; the latest position is drawn by the timer
+            self._cursor = (event.xdata,event.ydata)
+            if time.time() - self._last_render >= 1. / self.frame_rate:
+                self.render_cursor()
+            elif not self._render_pending:
+                self._render_pending = True
+                self._render_timer.start()
+
+    def _render_pending_cursor(self):
+        self._render_pending = False
+        self.render_cursor()
+
+    def render_cursor(self):
+        if self._cursor is None:
+            return
+        index = (self.x_index(self._cursor[0]),self.y_index(self._cursor[1]))
+        self._last_render = time.time()
+        if index == self._cursor_index:
+            return
+        self._cursor_index = xpos,ypos = index
+        self.xline.set_ydata(self.z[ypos,:])
+        self.yline.set_ydata(self.z[:,xpos])
+        self.blit([self.xline,self.yline])
 
     def click(self,event):
         """
@@ -88,8 +180,8 @@ class Viewer2d(object):
         """
         if event.inaxes==self.overview:
             #Get nearest data
-            xpos=np.argmin(np.abs(event.xdata-self.x))
-            ypos=np.argmin(np.abs(event.ydata-self.y))
+            xpos=self.x_index(event.xdata)
+            ypos=self.y_index(event.ydata)
 
             #Check which mouse button:
             if event.button==1:
@@ -103,63 +195,371 @@ class Viewer2d(object):
                 self.overview.axhline(self.y[ypos],color=c.get_color(),lw=2)
 
         if event.inaxes==self.y_subplot:
-            ypos=np.argmin(np.abs(event.xdata-self.y))
+            ypos=self.y_index(event.xdata)
             c,=self.x_subplot.plot(self.x, self.z[ypos,:],label=str(self.y[ypos]))
             self.overview.axhline(self.y[ypos],color=c.get_color(),lw=2)
 
         if event.inaxes==self.x_subplot:
-            xpos=np.argmin(np.abs(event.xdata-self.x))
+            xpos=self.x_index(event.xdata)
             c,=self.y_subplot.plot(self.y, self.z[:,xpos],label=str(self.x[xpos]))
             self.overview.axvline(self.x[xpos],color=c.get_color(),lw=2)
         #Show it
         plt.draw()
 
-class MapFileViewer(Viewer2d):
-    def __init__(self,filename):
+class PlaneCache(object):
+    """
+    The most recently used planes of a map, up to max_bytes in total. load(key) reads the plane for key when it is
+    not cached.
+    """
+    def __init__(self, load, max_bytes=256e6):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.planes = collections.OrderedDict()
+        self.nbytes = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.planes
+
+    def get(self, key):
+        with self.lock:
+            plane = self.planes.pop(key, None)
+            if plane is not None:
+                self.planes[key] = plane
+                return plane
+        generation = self.generation
+        plane = self.load(key)
+        with self.lock:
+            # A plane read before clear() may be out of date; return it but do not keep it
+            if generation != self.generation:
+                return plane
+        self.put(key, plane)
+        return plane
+
+    def put(self, key, plane):
+        with self.lock:
+            old = self.planes.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.planes[key] = plane
+            self.nbytes += plane.nbytes
+            while self.nbytes > self.max_bytes and len(self.planes) > 1:
+                key, old = self.planes.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.planes.clear()
+            self.nbytes = 0
+            self.generation += 1
+
+
+class PlaneViewer(Viewer2d):
+    def __init__(self,z,x,y,plane_names,plane_values,plane_key):
+        """
+        Viewer2d for one plane at a time of a map with more dimensions than x and y, named plane_names with
+        coordinates plane_values: one frequency, or one HWP step and frequency for map_hwp maps. plane_key holds the
+        index along each of them of the plane z. A slider per dimension, or the left/right keys (last dimension) and
+        up/down keys (the one before), pick the plane; subclasses show it in plane_selected.
+        """
+        self.plane_names = list(plane_names)
+        self.plane_values = list(plane_values)
+        self.plane_shape = tuple([len(values) for values in self.plane_values])
+        self.plane_key = tuple([min(index,size-1) for index,size in zip(plane_key,self.plane_shape)])
+        super(PlaneViewer,self).__init__(z,x,y)
+        self.zlim = data_limits(self.z)
+        if self.zlim is not None:
+            self.quad.set_clim(*self.zlim)
+        self.add_plane_sliders()
+        self.fig.canvas.mpl_connect('key_press_event',self.key_press)
+
+    def add_plane_sliders(self):
+        self.fig.subplots_adjust(bottom=0.05+0.04*len(self.plane_shape))
+        self.sliders = []
+        for k,name in enumerate(self.plane_names):
+            ax = self.fig.add_axes([0.1,0.01+0.04*k,0.8,0.025])
+            slider = Slider(ax,name,0,self.plane_shape[k]-1,valinit=self.plane_key[k],valfmt='%d')
+            slider.on_changed(lambda value,k=k: self.select_plane(k,int(round(value))))
+            self.sliders.append(slider)
+        self._widgets += self.sliders
+        self.label_sliders()
+
+    def label_sliders(self):
+        for slider,values,index in zip(self.sliders,self.plane_values,self.plane_key):
+            slider.valtext.set_text('%d: %g' % (index,values[index]))
+
+    def key_press(self,event):
+        steps = {'left':(-1,-1),'right':(-1,1),'down':(-2,-1),'up':(-2,1)}
+        if event.key not in steps or -steps[event.key][0] > len(self.plane_shape):
+            return
+        k,step = steps[event.key]
+        k %= len(self.plane_shape)
+        index = min(max(self.plane_key[k]+step,0),self.plane_shape[k]-1)
+        # Goes through select_plane
+        self.sliders[k].set_val(index)
+
+    def select_plane(self,k,index):
+        key = list(self.plane_key)
+        key[k] = index
+        key = tuple(key)
+        if key == self.plane_key:
+            return
+        self.plane_key = key
+        self.label_sliders()
+        self.plane_selected(key)
+
+    def plane_selected(self,key):
+        pass
+
+    def show_plane(self,plane):
+        self.z = plane
+        self.quad.set_array(self.mesh_values(self.z))
+        self.zlim = data_limits(self.z)
+        if self.zlim is not None:
+            self.quad.set_clim(*self.zlim)
+            self.x_subplot.set_ylim(*self.zlim)
+            self.y_subplot.set_ylim(*self.zlim)
+        if self._cursor_index is not None:
+            xpos,ypos = self._cursor_index
+        else:
+            xpos,ypos = self.z.shape[1]//2,self.z.shape[0]//2
+        self.xline.set_ydata(self.z[ypos,:])
+        self.yline.set_ydata(self.z[:,xpos])
+        self.fig.canvas.draw_idle()
+
+    def show_changed_rows(self,changed):
+        """
+        Show new data in the rows (columns of z) listed in changed: only the image is redrawn, unless the new values
+        fall outside the color scale.
+        """
+        self.quad.set_array(self.mesh_values(self.z))
+        zlim = data_limits(self.z[:,changed])
+        if zlim is not None and (self.zlim is None or zlim[0] < self.zlim[0] or zlim[1] > self.zlim[1]):
+            # The color scale and the cut axes change, so everything is drawn again
+            if self.zlim is not None:
+                zlim = (min(zlim[0],self.zlim[0]),max(zlim[1],self.zlim[1]))
+            self.zlim = zlim
+            self.quad.set_clim(*zlim)
+            self.x_subplot.set_ylim(*zlim)
+            self.y_subplot.set_ylim(*zlim)
+            self.fig.canvas.draw_idle()
+        else:
+            self.blit([self.quad] + self.overview.lines)
+
+
+class MapFileViewer(PlaneViewer):
+    def __init__(self,filename,full_refresh_interval=10,freq_index=3,hwp_index=0,cache_bytes=256e6):
+        """
+        Only the plane of z being shown is read: one frequency, or one HWP step and frequency for map_hwp files.
+        Recently shown planes are kept in a cache of at most cache_bytes, and the neighbouring planes are read ahead
+        on a background thread so scrubbing does not wait on the file.
+
+        Every 2 s, if the file has changed, only the rows that were still missing data are read again, stopping at the
+        first one still empty since maps fill in row by row. Every full_refresh_interval refreshes all rows still
+        missing data are read, to catch maps that fill in out of order.
+        """
         self.filename = filename
-        x,y,z = self.get_data()
-        self.freq_index = 3
-        super(MapFileViewer,self).__init__(z[:,:,self.freq_index],x,y)
+        self.nc = None
+        self.nc_lock = threading.RLock()
+        self.reopen()
+        z = self.group.variables['z']
+        # The planes are indexed by every dimension of z after x and y
+        names = z.dimensions[2:]
+        values = [self.group.variables[name][:] if name in self.group.variables else np.arange(size)
+                  for name,size in zip(names,z.shape[2:])]
+        if len(names) == 2:
+            plane_key = (hwp_index,freq_index)
+        else:
+            plane_key = (freq_index,)
+        plane_key = tuple([min(index,size-1) for index,size in zip(plane_key,z.shape[2:])])
+        self.planes = PlaneCache(self.read_plane,max_bytes=cache_bytes)
+        self.loader = async_devices.DeviceWorker('planes')
+        self._loading = {}
+        self._wanted = None
+        y = self.group.variables['x'][:]
+        x = self.group.variables['y'][:]
+        super(MapFileViewer,self).__init__(self.planes.get(plane_key),x,y,names,values,plane_key)
+        self.full_refresh_interval = full_refresh_interval
+        self._refreshes = 0
+        self.prefetch()
+        self.plane_timer = self.fig.canvas.new_timer(interval=50)
+        self.plane_timer.add_callback(self.show_loaded_plane)
         self.last_mtime = os.path.getmtime(self.filename)
         self.timer = self.fig.canvas.new_timer(interval=2000)
         self.timer.add_callback(self.update_data,None)
         self.timer.start()
 
+    def plane_selected(self,key):
+        if key in self.planes:
+            self.show_plane(self.planes.get(key))
+        else:
+            # Shown by show_loaded_plane once read, so the GUI does not wait on the file
+            self._wanted = key
+            self.load(key)
+            self.plane_timer.start()
+
+    def load(self,key):
+        if key not in self._loading:
+            self._loading[key] = self.loader.submit(self.planes.get,key)
+            self._loading[key].add_done_callback(lambda operation,key=key: self._loading.pop(key,None))
+        return self._loading.get(key)
 
-    def get_data(self):
-        nc = netCDF4.Dataset(self.filename,mode='r')
-        group = nc.groups[nc.groups.keys()[0]]
-        y = group.variables['x'][:]
-        x = group.variables['y'][:]
-        z = group.variables['z'][:]
-        nc.close()
-        return x,y,z
+    def prefetch(self):
+        for k in range(len(self.plane_shape)):
+            for step in [1,-1]:
+                key = list(self.plane_key)
+                key[k] += step
+                if 0 <= key[k] < self.plane_shape[k] and tuple(key) not in self.planes:
+                    self.load(tuple(key))
+
+    def show_loaded_plane(self):
+        if self._wanted is None or self._wanted not in self.planes:
+            return
+        self.plane_timer.stop()
+        key,self._wanted = self._wanted,None
+        if key == self.plane_key:
+            self.show_plane(self.planes.get(key))
+
+    def show_plane(self,plane):
+        super(MapFileViewer,self).show_plane(plane)
+        self.prefetch()
+
+    def read_plane(self,key):
+        with self.nc_lock:
+            plane = self.group.variables['z'][(slice(None),slice(None))+key]
+        return np.ma.masked_array(plane,mask=np.ma.getmaskarray(plane))
+
+    def reopen(self):
+        # The dataset stays open between refreshes, but HDF5 only shows what another process has written since it
+        # was opened once every handle to the file in this process is closed
+        with self.nc_lock:
+            if self.nc is not None:
+                self.nc.close()
+            self.nc = netCDF4.Dataset(self.filename,mode='r')
+            self.group = self.nc.groups[self.nc.groups.keys()[0]]
+
+    def read_changed_rows(self, full=False):
+        """
+        Read into self.z the rows (y indices in the file, columns here) that were still missing data, and return
+        those that changed.
+        """
+        z = self.group.variables['z']
+        changed = []
+        for j in np.flatnonzero(np.ma.getmaskarray(self.z).any(axis=0)):
+            with self.nc_lock:
+                row = z[(slice(None),j)+self.plane_key]
+            missing = np.ma.getmaskarray(row)
+            if missing.all() and not full:
+                break
+            if (missing != np.ma.getmaskarray(self.z[:,j])).any():
+                self.z[:,j] = row
+                changed.append(j)
+        return changed
 
     def update_data(self,event):
         mtime = os.path.getmtime(self.filename)
         if mtime == self.last_mtime:
             return
         self.last_mtime = mtime
-        tic = time.time()
-        x,y,z = self.get_data()
-        self.z = z[:,:,self.freq_index]
-        xlim = self.overview.get_xlim()
-        ylim = self.overview.get_ylim()
-        del self.overview.collections[0]
-        self.quad = self.overview.pcolormesh(self.x,self.y,self.z)
-        zmin = z.min()
-        zmax = z.max()
+        self.reopen()
+        self._refreshes += 1
+        changed = self.read_changed_rows(full=self._refreshes % self.full_refresh_interval == 0)
+        if not changed:
+            return
+        # Other cached planes are missing the new readings too
+        self.planes.clear()
+        self.planes.put(self.plane_key,self.z)
+        self.prefetch()
+        self.show_changed_rows(changed)
 
-        self.x_subplot.set_ylim(zmin,zmax)
-        self.y_subplot.set_ylim(zmin,zmax)
-#        self.overview.set_xlim(xlim)
-#        self.overview.set_ylim(ylim)
-        plt.draw()
-        print time.time() - tic
 
+class LiveMapViewer(PlaneViewer):
+    def __init__(self,address=livefeed.DEFAULT_ADDRESS,freq_index=3,hwp_index=0,interval=200,feed=None,
+                 message=None):
+        """
+        Follows the map a Mapper is taking through its live feed (see livefeed) instead of reading the file, so any
+        number of viewers can watch one scan. The readings received are kept in memory, so every plane is available
+        at once. New readings are drawn every interval ms. Waits for a map to start if there is none yet; a viewer
+        for the next map, showing the same plane, replaces this one when it does.
+        """
+        if feed is None:
+            feed = livefeed.Subscriber(address)
+        self.feed = feed
+        while message is None:
+            message = self.feed.get()
+            if message is None:
+                raise ValueError("Live feed at %s closed before a map started" % address)
+            if message['type'] != 'map':
+                message = None
+        self.header = message
+        self.freq_index = freq_index
+        self.hwp_index = hwp_index
+        self.cube = message['z']
+        names = message['dimensions'][2:]
+        values = [np.array(message['coordinates'][name]) for name in names]
+        if len(names) == 2:
+            plane_key = (hwp_index,freq_index)
+        else:
+            plane_key = (freq_index,)
+        plane_key = tuple([min(index,len(v)-1) for index,v in zip(plane_key,values)])
+        y = np.array(message['coordinates']['x'])
+        x = np.array(message['coordinates']['y'])
+        self.next_viewer = None
+        super(LiveMapViewer,self).__init__(self.read_plane(plane_key),x,y,names,values,plane_key)
+        self.fig.suptitle('%s %s' % (os.path.basename(message['filename']),message['group']))
+        self.interval = interval
+        self.timer = self.fig.canvas.new_timer(interval=interval)
+        self.timer.add_callback(self.update_data)
+        self.timer.start()
 
+    def read_plane(self,key):
+        return np.ma.masked_invalid(self.cube[(slice(None),slice(None))+key])
 
-if __name__=='__main__':
+    def plane_selected(self,key):
+        self.show_plane(self.read_plane(key))
+
+    def update_data(self,messages=None):
+        if messages is None:
+            messages = self.feed.poll()
+        changed = set()
+        for k,message in enumerate(messages):
+            if message['type'] == 'point':
+                index = tuple(message['index'])
+                self.cube[index] = message['value']
+                if index[2:] == self.plane_key:
+                    self.z[index[:2]] = message['value']
+                    changed.add(index[1])
+            elif message['type'] == 'end':
+                self.fig.suptitle('%s %s (finished)' % (os.path.basename(self.header['filename']),
+                                                        self.header['group']))
+                self.fig.canvas.draw_idle()
+            elif message['type'] == 'map':
+                self.timer.stop()
+                plt.close(self.fig)
+                # Keep showing the plane picked with the sliders
+                if len(self.plane_key) == 2:
+                    hwp_index,freq_index = self.plane_key
+                else:
+                    hwp_index,freq_index = self.hwp_index,self.plane_key[0]
+                self.next_viewer = LiveMapViewer(freq_index=freq_index,hwp_index=hwp_index,interval=self.interval,
+                                                 feed=self.feed,message=message)
+                self.next_viewer.update_data(messages[k+1:])
+                return
+        if changed:
+            self.show_changed_rows(sorted(changed))
+
+
+def data_limits(z):
+    values = np.ma.compressed(z)
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return None
+    return values.min(),values.max()
+
+
+def demo_data():
     #Build some strange looking data:
     x=np.linspace(-3,3,300)
     y=np.linspace(-4,4,400)
@@ -167,6 +567,11 @@ if __name__=='__main__':
     z=np.sqrt(X**2+Y**2)+np.sin(X**2+Y**2)
     w, h = 512, 512
     A = np.random.randn(512,512)
+    return x,y,z,A
+
+
+if __name__=='__main__':
+    x,y,z,A = demo_data()
     #Put it in the viewer
     fig_v=Viewer2d(z,x,y)
     fig_v2=Viewer2d(A)
@@ -0,0 +1,239 @@
+"""
+Buffered writes into the variables of a map group.
+
+Individual readings are collected in memory and written out every flush_interval seconds or flush_points readings,
+followed by a single sync: one call per pixel, i.e. the (x, y, ...) slab of a variable, when the readings span fewer
+pixels than planes (e.g. frequencies), and otherwise one call per plane covering just the pixels around its readings.
+Either way only the chunks holding new readings are rewritten, whichever order a scan nests its axes in. Until then each
+reading is also appended to a small text journal next to the netCDF file, so a crash loses nothing:
+replay_journal() puts the readings back. close() does the final flush and removes the journal.
+
+How the variables themselves are laid out on disk is set by a StorageProfile: 'image' chunks each frequency (and
+HWP step) plane as a unit for reading maps, 'spectrum' chunks each pixel for reading spectra, both compressed and in
+float32; 'legacy' is the original uncompressed float64 layout.
+"""
+import os
+import time
+
+import numpy as np
+
+
+class StorageProfile(object):
+    """
+    layout is 'image', 'spectrum' or None for netCDF's default chunking. With quantize, variables that only ever hold
+    small integers (e.g. lockin sensitivity settings) are stored with their integer type instead of dtype. With
+    unlimited, the y dimension is unlimited so rows can be added to a map after it is created.
+    """
+    def __init__(self, dtype='f4', layout='image', zlib=True, complevel=4, shuffle=True, quantize=True,
+                 unlimited=True, chunk_bytes=256e3, max_chunk_cache=512e6):
+        self.dtype = dtype
+        self.layout = layout
+        self.zlib = zlib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.quantize = quantize
+        self.unlimited = unlimited
+        self.chunk_bytes = chunk_bytes
+        self.max_chunk_cache = max_chunk_cache
+
+    def chunksizes(self, group, dimensions, itemsize):
+        # x and y are always the first two dimensions of a map variable
+        sizes = [max(len(group.dimensions[dimension]), 1) for dimension in dimensions]
+        if self.layout == 'image':
+            # Whole planes, stacked about chunk_bytes deep: one plane per chunk would make every pixel written
+            # touch thousands of chunks
+            depth = max(1, int(self.chunk_bytes / (itemsize * sizes[0] * sizes[1])))
+            per_dimension = max(1, int(depth ** (1.0 / max(len(sizes) - 2, 1))))
+            return sizes[:2] + [min(size, per_dimension) for size in sizes[2:]]
+        if self.layout == 'spectrum':
+            return [1, 1] + sizes[2:]
+        return None
+
+    def create_variable(self, group, name, dimensions, dtype=None, integer_dtype=None):
+        if self.quantize and integer_dtype is not None:
+            dtype = integer_dtype
+        elif dtype is None:
+            dtype = self.dtype
+        chunksizes = self.chunksizes(group, dimensions, np.dtype(dtype).itemsize)
+        variable = group.createVariable(name, dtype, dimensions=dimensions, zlib=self.zlib, complevel=self.complevel,
+                                        shuffle=self.shuffle, chunksizes=chunksizes)
+        if chunksizes is not None:
+            # Maps are written a pixel at a time, which touches many chunks of an image layout; keep them in memory
+            # between syncs instead of decompressing and compressing them again for every pixel
+            size = np.prod([max(len(group.dimensions[dimension]), 1) for dimension in dimensions])
+            nchunks = int(np.ceil(size / float(np.prod(chunksizes))))
+            variable.set_var_chunk_cache(size=int(min(size * variable.dtype.itemsize * 2, self.max_chunk_cache)),
+                                         nelems=max(nchunks * 4 + 1, 521), preemption=0.75)
+        return variable
+
+
+STORAGE_PROFILES = {
+    'image': StorageProfile(layout='image'),
+    'spectrum': StorageProfile(layout='spectrum'),
+    'legacy': StorageProfile(dtype='f8', layout=None, zlib=False, shuffle=False, quantize=False, unlimited=False),
+}
+
+
+def storage_profile(profile):
+    if isinstance(profile, StorageProfile):
+        return profile
+    try:
+        return STORAGE_PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown storage profile %r, expected one of %s" % (profile, sorted(STORAGE_PROFILES)))
+
+
+def extend_rows(group, names):
+    """
+    Write the last row of each named variable as missing so its storage covers the whole, unlimited, y dimension.
+    Reading rows of a variable beyond the last one written corrupts memory in netCDF-C 4.6, and BufferedMapWriter
+    reads the pixels around those it writes.
+    """
+    n = len(group.dimensions['y'])
+    if n:
+        for name in names:
+            group.variables[name][:, n - 1] = np.ma.masked
+
+
+def find_map_group(nc, group_name=None):
+    if group_name is not None:
+        return nc.groups[group_name]
+    names = sorted(name for name in nc.groups if name.startswith('map_'))
+    if not names:
+        raise ValueError("No map groups in %s" % nc.filepath())
+    return nc.groups[names[-1]]
+
+
+def record_path(group, points):
+    # Only cells on the path belong to the scan, which matters when it is resumed
+    group.createDimension('path', len(points))
+    group.createVariable('path_x_index', np.int32, dimensions=('path',))[:] = [x for (x, y) in points]
+    group.createVariable('path_y_index', np.int32, dimensions=('path',))[:] = [y for (x, y) in points]
+
+
+def missing_cells(group):
+    """
+    Boolean array shaped like z that is True for the cells of the scan with no reading yet, or a NaN reading.
+    """
+    z = np.ma.filled(group.variables['z'][:].astype(np.float), np.nan)
+    missing = np.isnan(z)
+    if 'path_x_index' in group.variables:
+        on_path = np.zeros(z.shape[:2], dtype=bool)
+        on_path[group.variables['path_x_index'][:], group.variables['path_y_index'][:]] = True
+        missing &= on_path.reshape(on_path.shape + (1,) * (z.ndim - 2))
+    return missing
+
+
+def journal_filename(nc, group):
+    return '%s.%s.journal' % (nc.filepath(), group.name)
+
+
+class BufferedMapWriter(object):
+    def __init__(self, nc, group, flush_interval=10.0, flush_points=1000, journal=True, fsync=False, telemetry=None):
+        self.nc = nc
+        self.group = group
+        self.flush_interval = flush_interval
+        self.flush_points = flush_points
+        # fsync makes the journal survive a power cut as well as a crash, at the cost of a disk flush per reading
+        self.fsync = fsync
+        # Flushes are recorded as the 'write' phase of a telemetry.Telemetry, if given
+        self.telemetry = telemetry
+        # Readings by variable name and full index
+        self._cells = {}
+        self._pending = 0
+        self._last_flush = time.time()
+        if journal:
+            self.journal_filename = journal_filename(nc, group)
+            self._journal = open(self.journal_filename, 'a')
+        else:
+            self.journal_filename = None
+            self._journal = None
+
+    def write(self, name, index, value):
+        """
+        Equivalent to group.variables[name][index] = value for a full index tuple whose first two entries are the
+        pixel (x, y).
+        """
+        self._cells.setdefault(name, {})[tuple([int(i) for i in index])] = value
+        if self._journal is not None:
+            self._journal.write('%s\t%s\t%r\n' % (name, ','.join([str(int(i)) for i in index]), value))
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+        self._pending += 1
+        if self._pending >= self.flush_points or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        tic = time.time()
+        for name, cells in self._cells.items():
+            variable = self.group.variables[name]
+            pixels = {}
+            planes = {}
+            for index, value in cells.items():
+                pixels.setdefault(index[:2], []).append((index[2:], value))
+                planes.setdefault(index[2:], []).append((index[0], index[1], value))
+            if len(pixels) <= len(planes):
+                # E.g. a scan stepping the frequency innermost: one call per pixel
+                for pixel, readings in pixels.items():
+                    if len(readings) == np.prod(variable.shape[2:]):
+                        slab = np.empty(variable.shape[2:], dtype=variable.dtype)
+                    else:
+                        # Start from what is already in the file so the other planes keep their readings
+                        slab = np.ma.filled(variable[pixel]).copy()
+                    for plane, value in readings:
+                        slab[plane] = value
+                    variable[pixel] = slab
+                continue
+            # E.g. a scan stepping the frequency outermost: one call per plane, covering the pixels with new readings
+            for plane, readings in planes.items():
+                x, y, values = [np.array(column) for column in zip(*readings)]
+                box = (slice(x.min(), x.max() + 1), slice(y.min(), y.max() + 1)) + plane
+                shape = (x.max() - x.min() + 1, y.max() - y.min() + 1)
+                if len(values) == shape[0] * shape[1]:
+                    block = np.empty(shape, dtype=variable.dtype)
+                else:
+                    block = np.ma.filled(variable[box]).copy()
+                block[x - x.min(), y - y.min()] = values
+                variable[box] = block
+        self.nc.sync()
+        self._cells = {}
+        self._pending = 0
+        self._last_flush = time.time()
+        if self._journal is not None:
+            # Everything in the journal is now in the file
+            self._journal.seek(0)
+            self._journal.truncate()
+        if self.telemetry is not None:
+            self.telemetry.phase('write', time.time() - tic)
+
+    def close(self):
+        self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            os.remove(self.journal_filename)
+            self._journal = None
+
+
+def replay_journal(nc, group, filename=None):
+    """
+    Write the readings left in a journal by an interrupted scan into group, then remove the journal. Returns the
+    number of readings.
+    """
+    if filename is None:
+        filename = journal_filename(nc, group)
+    if not os.path.exists(filename):
+        return 0
+    count = 0
+    with open(filename) as journal:
+        for line in journal:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) != 3:
+                # A line cut short by the crash
+                continue
+            name, index, value = parts
+            group.variables[name][tuple([int(i) for i in index.split(',')])] = float(value)
+            count += 1
+    nc.sync()
+    os.remove(filename)
+    return count
@@ -0,0 +1,237 @@
+import math
+import time
+
+import numpy as np
+
+
+class MoveProfile(object):
+    """
+    Speed profile the L6474 library uses for a GoTo/Move: start at min_speed, ramp at acceleration up to max_speed,
+    cruise, then ramp down at deceleration. Short moves never reach max_speed and become triangular.
+    Distances are in (micro)steps, speeds in steps/s and accelerations in steps/s^2, all as set through the UART.
+    """
+    def __init__(self, steps, acceleration, deceleration, min_speed, max_speed):
+        self.steps = abs(steps)
+        self.acceleration = float(acceleration)
+        self.deceleration = float(deceleration)
+        self.min_speed = float(min_speed)
+        self.max_speed = float(max(max_speed, min_speed))
+        dv2 = self.max_speed ** 2 - self.min_speed ** 2
+        acc_steps = dv2 / (2 * self.acceleration)
+        dec_steps = dv2 / (2 * self.deceleration)
+        if acc_steps + dec_steps > self.steps:
+            acc_steps = self.steps * self.deceleration / (self.acceleration + self.deceleration)
+            dec_steps = self.steps - acc_steps
+            self.peak_speed = math.sqrt(self.min_speed ** 2 + 2 * self.acceleration * acc_steps)
+        else:
+            self.peak_speed = self.max_speed
+        self.acc_steps = acc_steps
+        self.dec_steps = dec_steps
+        self.const_steps = self.steps - acc_steps - dec_steps
+        if self.steps == 0:
+            self.acc_time = self.const_time = self.dec_time = 0.0
+        else:
+            self.acc_time = (self.peak_speed - self.min_speed) / self.acceleration
+            self.const_time = self.const_steps / self.peak_speed
+            self.dec_time = (self.peak_speed - self.min_speed) / self.deceleration
+        self.duration = self.acc_time + self.const_time + self.dec_time
+
+    def distance(self, t):
+        if t <= 0:
+            return 0.0
+        if t < self.acc_time:
+            return self.min_speed * t + 0.5 * self.acceleration * t ** 2
+        t -= self.acc_time
+        if t < self.const_time:
+            return self.acc_steps + self.peak_speed * t
+        t -= self.const_time
+        if t < self.dec_time:
+            return self.acc_steps + self.const_steps + self.peak_speed * t - 0.5 * self.deceleration * t ** 2
+        return float(self.steps)
+
+    def speed(self, t):
+        if t < 0 or t >= self.duration:
+            return 0.0
+        if t < self.acc_time:
+            return self.min_speed + self.acceleration * t
+        t -= self.acc_time
+        if t < self.const_time:
+            return self.peak_speed
+        t -= self.const_time
+        return self.peak_speed - self.deceleration * t
+
+
+def move_time(steps, acceleration, deceleration, min_speed, max_speed):
+    return MoveProfile(steps, acceleration, deceleration, min_speed, max_speed).duration
+
+
+def link_time(nbytes, baudrate=9600):
+    # 8N1 framing: 10 bits on the wire per byte
+    return nbytes * 10.0 / baudrate
+
+
+def move_times(steps, acceleration, deceleration, min_speed, max_speed):
+    """
+    Vectorized MoveProfile(...).duration for an array of move lengths.
+    """
+    steps = np.abs(np.asarray(steps, dtype=np.float))
+    max_speed = max(max_speed, min_speed)
+    dv2 = float(max_speed) ** 2 - float(min_speed) ** 2
+    ramp_steps = dv2 / (2. * acceleration) + dv2 / (2. * deceleration)
+    acc_steps = steps * deceleration / float(acceleration + deceleration)
+    peak_speed = np.sqrt(min_speed ** 2 + 2. * acceleration * acc_steps)
+    triangular = (peak_speed - min_speed) / acceleration + (peak_speed - min_speed) / deceleration
+    trapezoidal = ((max_speed - min_speed) / float(acceleration) + (max_speed - min_speed) / float(deceleration)
+                   + (steps - ramp_steps) / float(max_speed))
+    times = np.where(steps > ramp_steps, trapezoidal, triangular)
+    times[steps == 0] = 0
+    return times
+
+
+class StageMotionModel(object):
+    """
+    Predicts how long stage moves take. Each axis has its own acceleration, deceleration, min and max speed (a
+    scalar applies to all axes). Axes move at the same time, so a move lasts as long as its slowest axis, plus a
+    fixed overhead per move for the serial round trips.
+    """
+    def __init__(self, acceleration=200, min_speed=200, max_speed=400, deceleration=None, num_axes=2,
+                 overhead=0.0):
+        if deceleration is None:
+            deceleration = acceleration
+        self.num_axes = num_axes
+        self.acceleration = self._per_axis(acceleration)
+        self.deceleration = self._per_axis(deceleration)
+        self.min_speed = self._per_axis(min_speed)
+        self.max_speed = self._per_axis(max_speed)
+        self.overhead = overhead
+
+    def _per_axis(self, value):
+        if np.isscalar(value):
+            return [value] * self.num_axes
+        return list(value)
+
+    @classmethod
+    def from_stage(cls, stage, overhead=None):
+        """
+        Model of a Stage using the speeds and accelerations it is currently configured with. Positions, speeds and
+        accelerations are all counted in steps of the step mode the stage is in, so the step mode does not change
+        how long a move takes and is not needed here.
+        """
+        acceleration = []
+        deceleration = []
+        min_speed = []
+        max_speed = []
+        for axis in range(len(stage.positions)):
+            low, high = stage.get_speed(axis=axis)
+            min_speed.append(low)
+            max_speed.append(high)
+            acc, dec = stage.get_acceleration(axis=axis)
+            acceleration.append(acc)
+            deceleration.append(dec)
+        if overhead is None:
+            # A blocking move costs four command round trips, each echoed back with its prompt
+            overhead = link_time(4 * 2 * len("C12 0 10000\r\n>"))
+        return cls(acceleration, min_speed, max_speed, deceleration=deceleration, num_axes=len(max_speed),
+                   overhead=overhead)
+
+    def axis_times(self, axis, steps):
+        return move_times(steps, self.acceleration[axis], self.deceleration[axis], self.min_speed[axis],
+                          self.max_speed[axis])
+
+    def move_times(self, start, end):
+        """
+        Duration of moves from start to end, which are arrays of positions with one column per axis.
+        """
+        start = np.atleast_2d(start)
+        end = np.atleast_2d(end)
+        times = [self.axis_times(axis, end[..., axis] - start[..., axis]) for axis in range(start.shape[-1])]
+        return np.max(times, axis=0) + self.overhead
+
+    def move_time(self, start, end):
+        return float(self.move_times(start, end)[0])
+
+    def path_time(self, positions):
+        positions = np.asarray(positions, dtype=np.float)
+        if len(positions) < 2:
+            return 0.0
+        return float(np.sum(self.move_times(positions[:-1], positions[1:])))
+
+    def visit_times(self, positions, start=None):
+        """
+        Duration of the move to each of positions in turn, the first from start; no time for the first without a
+        start, or for a move that stays put.
+        """
+        positions = np.atleast_2d(np.asarray(positions, dtype=np.float))
+        if start is None:
+            start = positions[:1]
+        previous = np.vstack([np.atleast_2d(np.asarray(start, dtype=np.float)), positions[:-1]])
+        times = self.move_times(previous, positions)
+        times[(previous == positions).all(axis=1)] = 0
+        return times
+
+
+class ScanTimer(object):
+    """
+    Predicts how long a scan has left from what each phase of it (stage moves, settling, lockin readings, HWP steps,
+    ...) was predicted to take in total, e.g. by a StageMotionModel, and corrects that as the scan goes. Every
+    measured duration is recorded along with what it was predicted to be; what is left of a phase is then scaled by
+    the ratio of its measured to predicted time so far, weighted against the prediction as if prior_weight seconds
+    had agreed with it, so the first few points do not throw the estimate off. Time spent outside every phase
+    (writes, retuning, ...) is added on per point still to do.
+
+    Every duration recorded, with a prediction or not, and every point done are also passed on to telemetry, a
+    telemetry.Telemetry, if given.
+    """
+    def __init__(self, predicted, num_points, prior_weight=1.0, telemetry=None):
+        self.predicted = dict(predicted)
+        self.telemetry = telemetry
+        self.num_points = num_points
+        self.prior_weight = prior_weight
+        self.measured = dict((phase, 0.0) for phase in self.predicted)
+        self.expected = dict((phase, 0.0) for phase in self.predicted)
+        self.points_done = 0
+        self.start_time = None
+        self.predicted_time = float(sum(self.predicted.values()))
+
+    def start(self):
+        self.start_time = time.time()
+
+    def record(self, phase, seconds, predicted=0.0):
+        # The time of a phase without a prediction is left to the time per point outside the phases
+        if phase in self.predicted:
+            self.measured[phase] += seconds
+            self.expected[phase] += predicted
+        if self.telemetry is not None:
+            self.telemetry.phase(phase, seconds)
+
+    def point_done(self):
+        self.points_done += 1
+        if self.telemetry is not None:
+            self.telemetry.point_done()
+
+    def scale(self, phase):
+        weight = float(self.prior_weight)
+        return (self.measured[phase] + weight) / (self.expected[phase] + weight)
+
+    def other_time(self):
+        # Time per point outside the recorded phases
+        if self.start_time is None or not self.points_done:
+            return 0.0
+        return max(time.time() - self.start_time - sum(self.measured.values()), 0.0) / self.points_done
+
+    def estimates(self):
+        """
+        Ratio of measured to predicted time of each phase so far, and the time per point outside them.
+        """
+        estimates = dict((phase, self.scale(phase)) for phase in self.predicted)
+        estimates['other'] = self.other_time()
+        return estimates
+
+    def remaining(self):
+        total = sum([max(self.predicted[phase] - self.expected[phase], 0.0) * self.scale(phase)
+                     for phase in self.predicted])
+        return float(total + self.other_time() * (self.num_points - self.points_done))
+
+    def report(self):
+        time_remaining = self.remaining()
+        print "%.1f minutes remaining, finish at %s" % (time_remaining/60.,time.ctime(time.time()+time_remaining))
@@ -0,0 +1,147 @@
+"""
+Plan the order in which a scan visits an arbitrary set of map cells, using a motion.StageMotionModel to predict how
+long each move takes.
+
+Points are (x_index, y_index) pairs into the xsteps and ysteps arrays of the map, so a planned path can be handed to
+do_simple_map(path=...) and every measurement still lands in its own cell of MapDataFile.
+
+Example:
+    model = motion.StageMotionModel.from_stage(mapper.stage)
+    points = pathplan.aperture_points(xsteps, ysteps, center=(2300, 2300), radius=2000)
+    planned = pathplan.plan_path(points, xsteps, ysteps, model)
+    planned.report(pathplan.serpentine_points(xsteps, ysteps))
+    mapper.do_simple_map(xsteps, ysteps, path=planned.points)
+"""
+import numpy as np
+
+
+def grid_points(xsteps, ysteps):
+    return [(x, y) for y in range(len(ysteps)) for x in range(len(xsteps))]
+
+
+def serpentine_points(xsteps, ysteps):
+    # The order do_simple_map uses by default
+    points = []
+    for y in range(len(ysteps)):
+        if y % 2:
+            direction = -1
+        else:
+            direction = 1
+        for x in range(len(xsteps))[::direction]:
+            points.append((x, y))
+    return points
+
+
+def aperture_points(xsteps, ysteps, center, radius):
+    return [(x, y) for (x, y) in grid_points(xsteps, ysteps)
+            if (xsteps[x] - center[0]) ** 2 + (ysteps[y] - center[1]) ** 2 <= radius ** 2]
+
+
+def polar_points(xsteps, ysteps, center, radii, num_angles):
+    """
+    Cells nearest to a polar grid of rings around center, each ring sampled at num_angles angles. Cells hit more than
+    once are only visited once.
+    """
+    points = []
+    for radius in np.atleast_1d(radii):
+        for angle in np.arange(num_angles) * 2 * np.pi / num_angles:
+            x = np.argmin(np.abs(np.asarray(xsteps) - (center[0] + radius * np.cos(angle))))
+            y = np.argmin(np.abs(np.asarray(ysteps) - (center[1] + radius * np.sin(angle))))
+            if (x, y) not in points:
+                points.append((x, y))
+    return points
+
+
+def point_positions(points, xsteps, ysteps):
+    return np.array([(xsteps[x], ysteps[y]) for (x, y) in points], dtype=np.float)
+
+
+class PlannedPath(object):
+    def __init__(self, points, positions, model, start=None):
+        self.points = points
+        self.positions = positions
+        self.model = model
+        self.start = start
+        self.predicted_time = path_time(positions, model, start)
+
+    def report(self, reference_points=None, dwell=0.0):
+        """
+        Print the predicted time to run the path, with dwell seconds spent at each point, and optionally the time for
+        reference_points (e.g. the default serpentine) over the same grid.
+        """
+        total = self.predicted_time + dwell * len(self.points)
+        print "planned path: %d points, %.1f s moving, %.1f minutes total" % (len(self.points), self.predicted_time,
+                                                                               total / 60.)
+        if reference_points is not None:
+            reference = path_time(self._positions_of(reference_points), self.model, self.start)
+            reference_total = reference + dwell * len(reference_points)
+            print "reference path: %d points, %.1f s moving, %.1f minutes total" % (len(reference_points), reference,
+                                                                                     reference_total / 60.)
+
+    def _positions_of(self, points):
+        lookup = dict(zip(self.points, self.positions))
+        missing = [point for point in points if point not in lookup]
+        if missing:
+            raise ValueError("Reference points %s are not on the planned grid" % missing[:5])
+        return np.array([lookup[point] for point in points])
+
+
+def path_time(positions, model, start=None):
+    positions = np.asarray(positions, dtype=np.float)
+    if start is not None:
+        positions = np.vstack(([start], positions))
+    return model.path_time(positions)
+
+
+def plan_path(points, xsteps, ysteps, model, start=None, two_opt=True, max_passes=50):
+    """
+    Order points by nearest neighbour in predicted move time starting from the stage position start (or the first
+    point), or in the serpentine of do_simple_map if that is predicted to be quicker, then improve the order with
+    2-opt segment reversals until no reversal helps or max_passes is reached.
+    """
+    points = list(points)
+    if not points:
+        raise ValueError("No points to plan a path through")
+    positions = point_positions(points, xsteps, ysteps)
+    n = len(points)
+    # Node n stands for the starting position; it stays first in the path
+    if start is None:
+        nodes = np.vstack((positions, positions[:1]))
+    else:
+        nodes = np.vstack((positions, [start]))
+    cost = model.move_times(nodes[:, None, :], nodes[None, :, :])
+
+    path = [n]
+    unvisited = np.ones(n + 1, dtype=bool)
+    unvisited[n] = False
+    for k in range(n):
+        candidates = np.where(unvisited, cost[path[-1]], np.inf)
+        nearest = int(np.argmin(candidates))
+        path.append(nearest)
+        unvisited[nearest] = False
+    path = np.array(path)
+    # Nearest neighbour can lose to the serpentine, e.g. when one axis is much slower, and 2-opt may not recover
+    serpentine = np.array([n] + sorted(range(n), key=lambda k: (points[k][1], points[k][0] * (-1) ** points[k][1])))
+    if cost[serpentine[:-1], serpentine[1:]].sum() < cost[path[:-1], path[1:]].sum():
+        path = serpentine
+
+    if two_opt:
+        for k in range(max_passes):
+            improved = False
+            for i in range(1, n):
+                # Reverse path[i:j+1] for every j at once and keep the best
+                j = np.arange(i + 1, n + 1)
+                before, first, last = path[i - 1], path[i], path[j]
+                after = np.where(j + 1 <= n, path[np.minimum(j + 1, n)], -1)
+                delta = cost[before, last] - cost[before, first]
+                has_after = after >= 0
+                delta[has_after] += cost[first, after[has_after]] - cost[last[has_after], after[has_after]]
+                best = int(np.argmin(delta)) if len(delta) else 0
+                if len(delta) and delta[best] < -1e-9:
+                    path[i:j[best] + 1] = path[i:j[best] + 1][::-1].copy()
+                    improved = True
+            if not improved:
+                break
+
+    order = path[1:]
+    return PlannedPath([points[k] for k in order], positions[order], model, start=start)
@@ -0,0 +1,226 @@
+"""
+Choose the order in which a scan nests its axes (stage x and y, HWP step, source frequency, ...) and which of them
+snake, i.e. run backwards on every other pass instead of returning to their first value.
+
+Each ScanAxis declares what a move along it costs and how long to settle after it. predict() gives the total time of
+a Schedule in closed form, so every nesting order and snake choice can be compared before the scan starts; cells()
+then walks the scan cell by cell as indices into the axes, which are the indices into MapDataFile.
+
+Example:
+    model = motion.StageMotionModel.from_stage(mapper.stage)
+    axes = scheduler.stage_axes(model, xsteps, ysteps, settle_time=0.3) + [
+        scheduler.ScanAxis('hwp_step', hwp_steps, move_time=0.37, settle_time=0.5, period=100),
+        scheduler.ScanAxis('mmw_frequency', mmw_frequencies, move_time=0.05, settle_time=0.5, distance=False)]
+    candidates = scheduler.schedules(axes, measure_time=0.05)
+    scheduler.report(candidates)
+    for index in candidates[0].cells():
+        ...
+"""
+import itertools
+
+import numpy as np
+
+
+class ScanAxis(object):
+    def __init__(self, name, values, move_time, settle_time=0.0, actuator=None, overhead=0.0, period=None,
+                 distance=True):
+        """
+        move_time is the time to move a given (signed) distance between values, as a function taking an array of
+        distances, or a number: the time per unit distance, or per move with distance=False (e.g. retuning a source
+        costs the same whatever the step). Axes with the same actuator (the x and y of the stage) move together, so
+        their move lasts as long as the slowest plus overhead; different actuators move one after another. With a
+        period, values wrap around (a rotating HWP), and moves go the short way round.
+        """
+        self.name = name
+        self.values = np.asarray(values, dtype=np.float)
+        self.move_time = move_time
+        self.settle_time = settle_time
+        self.actuator = name if actuator is None else actuator
+        self.overhead = overhead
+        self.period = period
+        self.distance = distance
+
+    def __len__(self):
+        return len(self.values)
+
+    def displacement(self, start, end):
+        # Signed distance from the values at index (arrays) start to those at end
+        d = self.values[end] - self.values[start]
+        if self.period is not None:
+            d = (d + self.period / 2.) % self.period - self.period / 2.
+        return d
+
+    def move_times(self, start, end):
+        d = np.atleast_1d(self.displacement(start, end))
+        if callable(self.move_time):
+            times = np.asarray(self.move_time(d), dtype=np.float)
+        elif self.distance:
+            times = np.abs(d) * self.move_time
+        else:
+            times = np.where(d != 0, float(self.move_time), 0.)
+        return np.where(d != 0, times, 0.)
+
+
+def stage_axes(model, xsteps, ysteps, settle_time=0.0):
+    """
+    ScanAxis for x and y of a stage, timed by a motion.StageMotionModel.
+    """
+    return [ScanAxis(name, steps, lambda d, axis=axis: model.axis_times(axis, d), settle_time=settle_time,
+                     actuator='stage', overhead=model.overhead)
+            for axis, (name, steps) in enumerate([('x', xsteps), ('y', ysteps)])]
+
+
+def transition_times(moves, parts=False):
+    """
+    Time for the axes in moves, a list of (axis, start, end) with start and end indices (arrays of the same length,
+    or single indices), to move at once and settle. With parts, a dictionary of the move time of each actuator and
+    the settle time instead of their sum.
+    """
+    by_actuator = {}
+    settle = 0.
+    for axis, start, end in moves:
+        times = axis.move_times(start, end)
+        if axis.actuator in by_actuator:
+            times = np.maximum(times, by_actuator[axis.actuator][0])
+        by_actuator[axis.actuator] = (times, axis.overhead)
+        settle = np.maximum(settle, np.where(times > 0, axis.settle_time, 0.))
+    phases = dict((actuator, np.where(times > 0, times + overhead, 0.))
+                  for actuator, (times, overhead) in by_actuator.items())
+    if parts:
+        phases['settle'] = settle
+        # Every part as long as the moves, even those of an axis making the same move each time
+        names = phases.keys()
+        return dict(zip(names, np.broadcast_arrays(*[phases[name] for name in names])))
+    total = settle
+    for times in phases.values():
+        total = total + times
+    return total
+
+
+class Schedule(object):
+    def __init__(self, axes, order, snake, measure_time=0.0):
+        """
+        order lists the indices of axes from the outermost loop to the innermost; snake says, for each of them, if it
+        runs backwards on every other pass.
+        """
+        self.axes = axes
+        self.order = list(order)
+        self.snake = list(snake)
+        self.measure_time = measure_time
+        self.num_cells = int(np.prod([len(axis) for axis in axes]))
+        self.predicted_time = self.predict()
+
+    @property
+    def names(self):
+        return [self.axes[a].name for a in self.order]
+
+    def __str__(self):
+        return ' > '.join(['%s%s' % (self.axes[a].name, ' (snake)' if snake else '')
+                           for a, snake in zip(self.order, self.snake) if len(self.axes[a]) > 1])
+
+    def predict(self, by_phase=False):
+        """
+        Total time of the scan, or with by_phase a dictionary of the time spent measuring, settling and moving each
+        actuator.
+        """
+        totals = {'measure': self.measure_time * self.num_cells}
+        passes = 1
+        for position, a in enumerate(self.order):
+            axis = self.axes[a]
+            n = len(axis)
+            if n > 1:
+                # Inner axes that do not snake go back to their first value whenever this one steps
+                inner = zip(self.order[position + 1:], self.snake[position + 1:])
+                resets = [(self.axes[b], len(self.axes[b]) - 1, 0) for b, snake in inner if not snake]
+                k = np.arange(n - 1)
+                if self.snake[position]:
+                    forward, backward = (passes + 1) // 2, passes // 2
+                else:
+                    forward, backward = passes, 0
+                for count, moves in [(forward, [(axis, k, k + 1)] + resets), (backward, [(axis, k + 1, k)] + resets)]:
+                    if count:
+                        for phase, times in transition_times(moves, parts=True).items():
+                            totals[phase] = totals.get(phase, 0.) + count * times.sum()
+            passes *= n
+        if by_phase:
+            return dict((phase, float(total)) for phase, total in totals.items())
+        return float(sum(totals.values()))
+
+    def transition(self, start, end):
+        """
+        Predicted time of each phase, as from predict(by_phase=True), of going from cell start to cell end.
+        """
+        moves = [(axis, a, b) for axis, a, b in zip(self.axes, start, end) if a != b]
+        phases = dict((phase, float(np.sum(times))) for phase, times in transition_times(moves, parts=True).items())
+        phases['measure'] = self.measure_time
+        return phases
+
+    def cells(self):
+        """
+        Index tuples, one entry per axis in the order axes were given, of every cell in the order the scan visits
+        them.
+        """
+        sizes = [len(self.axes[a]) for a in self.order]
+        index = [0] * len(self.axes)
+        for t in xrange(self.num_cells):
+            rest = t
+            for position in range(len(sizes) - 1, -1, -1):
+                digit = rest % sizes[position]
+                rest //= sizes[position]
+                # rest now counts the passes of the loops outside this one
+                if self.snake[position] and rest % 2:
+                    digit = sizes[position] - 1 - digit
+                index[self.order[position]] = digit
+            yield tuple(index)
+
+
+def schedules(axes, measure_time=0.0):
+    """
+    Every nesting order and choice of snaking axes, quickest first. Axes with a single value are left where they
+    were given, since they never move.
+    """
+    moving = [a for a, axis in enumerate(axes) if len(axis) > 1]
+    fixed = [a for a in range(len(axes)) if a not in moving]
+    candidates = []
+    for order in itertools.permutations(moving):
+        # The outermost loop makes a single pass, so whether it snakes does not matter
+        for snake in itertools.product([False, True], repeat=max(len(order) - 1, 0)):
+            candidates.append(Schedule(axes, fixed + list(order), [False] * (len(fixed) + 1) + list(snake),
+                                       measure_time))
+    if not moving:
+        candidates.append(Schedule(axes, fixed, [False] * len(fixed), measure_time))
+    candidates.sort(key=lambda schedule: schedule.predicted_time)
+    return candidates
+
+
+def find_schedule(candidates, names, snake=None):
+    """
+    The quickest of candidates nesting the axes as names, outermost first, or the one where exactly the axes named
+    in snake snake. Axes with a single value may be left out, and are ignored in snake.
+    """
+    sizes = dict((axis.name, len(axis)) for axis in candidates[0].axes)
+    names = [name for name in names if sizes[name] > 1]
+    for schedule in candidates:
+        moving = [(name, snakes) for name, snakes, a in zip(schedule.names, schedule.snake, schedule.order)
+                  if len(schedule.axes[a]) > 1]
+        if [name for name, snakes in moving] != names:
+            continue
+        if snake is None or set([name for name, snakes in moving[1:] if snakes]) == set(snake) & set(names[1:]):
+            return schedule
+    raise ValueError("No schedule nests the axes as %s" % (names,))
+
+
+def report(candidates, reference=None):
+    """
+    Print the predicted time of the best schedule for each nesting order, and optionally of a reference schedule
+    such as the order do_simple_map uses.
+    """
+    best = {}
+    for schedule in candidates:
+        key = tuple(schedule.names)
+        if key not in best:
+            best[key] = schedule
+    for schedule in sorted(best.values(), key=lambda schedule: schedule.predicted_time):
+        print "%9.2f minutes  %s" % (schedule.predicted_time / 60., schedule)
+    if reference is not None:
+        print "%9.2f minutes  %s (reference)" % (reference.predicted_time / 60., reference)
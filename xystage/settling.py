@@ -0,0 +1,83 @@
+"""
+Wait for the lockin output to settle after a move or retune by reading it until successive readings agree, instead of
+sleeping a fixed time.
+
+Readings are taken one time constant apart, starting one time constant after the change. The output has settled once
+the last `agreements` pairs of successive readings each differ by no more than tolerance of the reading or
+noise_factor times the typical difference between readings of a settled output. That noise is learned from the last
+pair read at every point that settled, so points that time out while still settling do not raise it. max_time bounds
+the wait.
+
+Example:
+    settler = settling.Settler(time_constant=0.1)
+    (r, theta), settle_time, settled = settler.settle(lambda: lockin.snap(3, 4), value=lambda reading: reading[0])
+"""
+import collections
+import time
+
+import numpy as np
+
+# Time constant in seconds of each OFLT setting of an SR830
+SR830_TIME_CONSTANTS = [10e-6, 30e-6, 100e-6, 300e-6, 1e-3, 3e-3, 10e-3, 30e-3, 100e-3, 300e-3, 1, 3, 10, 30, 100,
+                        300, 1e3, 3e3, 10e3, 30e3]
+
+# Full scale in volts of each SENS setting of an SR830, which auto_range_measure reports as the sensitivity
+SR830_SENSITIVITIES = [[2e-9, 5e-9, 10e-9][k % 3] * 10 ** (k // 3) for k in range(27)]
+
+
+class Settler(object):
+    def __init__(self, time_constant, tolerance=0.01, noise_factor=3.0, agreements=2, max_time=None, history=50):
+        """
+        max_time defaults to ten time constants, enough for a 24 dB/octave filter to settle to 1e-3.
+        """
+        self.time_constant = time_constant
+        self.tolerance = tolerance
+        self.noise_factor = noise_factor
+        self.agreements = agreements
+        self.max_time = 10 * time_constant if max_time is None else max_time
+        self.differences = collections.deque(maxlen=history)
+
+    @property
+    def expected_time(self):
+        # Wait for an output that agrees from the first pair on
+        return min((1 + self.agreements) * self.time_constant, self.max_time)
+
+    @property
+    def noise(self):
+        # Typical difference between successive readings of a settled output
+        if not self.differences:
+            return 0.0
+        return float(np.median(self.differences))
+
+    def settle(self, read, value=None):
+        """
+        Call read until its value, value(reading) if given, has settled or max_time has passed since the call.
+        Returns the last reading, the time waited and whether the output settled.
+        """
+        if value is None:
+            value = lambda reading: reading
+        start = time.time()
+        time.sleep(min(self.time_constant, self.max_time))
+        reading = read()
+        last = value(reading)
+        threshold = self.noise_factor * self.noise
+        agreed = 0
+        difference = np.nan
+        while agreed < self.agreements:
+            tic = time.time()
+            if tic - start + self.time_constant > self.max_time:
+                break
+            time.sleep(self.time_constant)
+            reading = read()
+            current = value(reading)
+            difference = abs(current - last)
+            # A NaN reading (e.g. a lockin error) never agrees
+            if difference <= max(self.tolerance * abs(current), threshold):
+                agreed += 1
+            else:
+                agreed = 0
+            last = current
+        settled = agreed >= self.agreements
+        if settled and np.isfinite(difference):
+            self.differences.append(difference)
+        return reading, time.time() - start, settled
@@ -1,17 +1,32 @@
-import time
 import platform
+import time
 
 if platform.system() == 'Windows':
     default_port = 'COM6'
 else:
     default_port = '/dev/ttyACM1'
 
-import serial
+import transport
 
 hwp_speed = 800, 8000
 hwp_acceleration = 2000
 hwp_stepping = 16
 
+L6474_MIN_PWM_FREQ = 30
+L6474_MAX_PWM_FREQ = 10000
+
+# C36 bit of the lower limit switch of each axis; it reads 1 while the switch is open. The Triple firmware only reads
+# the switches of the first two axes.
+LIMIT_BITS = [0x02, 0x08]
+
+# Highest position each axis can safely go to
+MAX_POSITIONS = [7000, 4500]
+
+AXIS_NAMES = ['x', 'y']
+
+# C4 shield state of an axis that is not moving
+SHIELD_INACTIVE = 3
+
 
 class StatusBits(object):
     def __repr__(self):
@@ -19,28 +34,87 @@ class StatusBits(object):
 
 
 class Stage(object):
-    def __init__(self, port=default_port):
-        # Open serial port in following way to make sure DTR isn't asserted, which would reset the arduino
-        self.s = serial.Serial()
-        self.s.setPort(port)
-        try:
-            self.s.setDTR(False)
-        except Exception:
-            pass
-        self.s.timeout = 0
-        self.s.open()
+    def __init__(self, port=default_port, cache=False, snapshot_ttl=0.05, num_axes=2, max_positions=None,
+                 limit_bits=None):
+        """
+        With cache=True the stage keeps a model of the controller: registers written through set_speed,
+        set_acceleration and initialize are remembered instead of read back, positions are dead-reckoned from
+        completed moves, and limit and status queries are answered from a snapshot up to snapshot_ttl seconds old
+        as long as nothing has moved since.
+
+        num_axes is 2 for the Dual and 3 for the Triple controller. max_positions gives the highest position each
+        axis may go to (None for no limit) and limit_bits the C36 bit of its lower limit switch (None for an axis
+        without one, which find_home leaves alone); they default to MAX_POSITIONS and LIMIT_BITS for the first two
+        axes.
+        """
+        self.transport = transport.SerialTransport(port, terminator='>', name='stage')
+        self.s = self.transport.s
+        self.cache = cache
+        self.snapshot_ttl = snapshot_ttl
+        self.axes = range(num_axes)
+        if max_positions is None:
+            max_positions = (MAX_POSITIONS + [None] * num_axes)[:num_axes]
+        if limit_bits is None:
+            limit_bits = (LIMIT_BITS + [None] * num_axes)[:num_axes]
+        if len(max_positions) != num_axes or len(limit_bits) != num_axes:
+            raise ValueError("max_positions and limit_bits need one entry for each of the %d axes" % num_axes)
+        self.max_positions = list(max_positions)
+        self.limit_bits = list(limit_bits)
+        self.homing_axes = [axis for axis in self.axes if self.limit_bits[axis] is not None]
+        # Spread of the home positions found by the last find_home, None until one measures it
+        self.home_repeatability = None
+        self.registers = {}
+        self.positions = [None] * num_axes
+        self._targets = [None] * num_axes
+        # Axes that may be moving; at first nothing is known
+        self._active = set(self.axes)
+        self._snapshots = {}
+
+    @property
+    def _moving(self):
+        return bool(self._active)
+
+    def _axes(self, axes):
+        if axes is None:
+            return list(self.axes)
+        axes = list(axes)
+        for axis in axes:
+            if axis not in self.axes:
+                raise ValueError("No axis %r, the stage has %d" % (axis, len(self.axes)))
+        return axes
+
+    def axis_name(self, axis):
+        return AXIS_NAMES[axis] if axis < len(AXIS_NAMES) else 'axis %d' % axis
+
+    def invalidate(self, registers=False):
+        self._snapshots = {}
+        self.positions = [None] * len(self.axes)
+        self._targets = [None] * len(self.axes)
+        if registers:
+            self.registers = {}
 
     def sendget(self, cmdstr, timeout=2):
-        self.s.readlines()
-        self.s.write(cmdstr)
-        tic = time.time()
-        resp = ''
-        while time.time() - tic < timeout:
-            resp += self.s.read()
-            if '>' in resp:
-                break
-            time.sleep(0.001)
-        return resp
+        return self.transport.sendget(cmdstr, timeout=timeout)
+
+    def transaction(self, commands, timeout=2):
+        """
+        Pipeline a list of commands (e.g. ["C21 0 400\n", "C7 0\n"]) through the controller and return the replies.
+        Each reply is checked against the "C<n> <target>" line the firmware echoes for its command.
+        """
+        replies = self.transport.transaction(commands, timeout=timeout)
+        for command, reply in zip(commands, replies):
+            if reply.split()[:2] != command.split()[:2]:
+                raise ValueError("Reply %r does not match command %r" % (reply, command))
+        return replies
+
+    def _snapshot(self, key, commands):
+        if self.cache and key in self._snapshots:
+            tic, values = self._snapshots[key]
+            if time.time() - tic < self.snapshot_ttl:
+                return values
+        values = [self.parse_reply(reply) for reply in self.transaction(commands)]
+        self._snapshots[key] = time.time(), values
+        return values
 
     def parse_reply(self, reply):
         lines = reply.splitlines()
@@ -52,18 +126,26 @@ class Stage(object):
                 return int(parts[1])
 
     def _get_position(self, axis):
-        return self.parse_reply(self.sendget("C9 %d\n" % axis))
+        position = self.parse_reply(self.sendget("C9 %d\n" % axis))
+        # The firmware prints the 32 bit position as unsigned
+        if position >= 0x80000000:
+            position -= 0x100000000
+        return position
 
     def get_position(self):
-        return self._get_position(0), self._get_position(1)
+        if self.cache and None not in self.positions:
+            return tuple(self.positions)
+        replies = self.transaction(["C9 %d\n" % axis for axis in self.axes])
+        # The firmware prints the 32 bit positions as unsigned
+        return tuple([position - 0x100000000 if position >= 0x80000000 else position
+                      for position in [self.parse_reply(reply) for reply in replies]])
 
     def get_status(self):
-        st0 = self.parse_reply(self.sendget("C31 0\n"))
-        st1 = self.parse_reply(self.sendget("C31 1\n"))
-        return self.decode_status_bits(st0), self.decode_status_bits(st1)
+        return tuple([self.decode_status_bits(status)
+                      for status in self._snapshot('status', ["C31 %d\n" % axis for axis in self.axes])])
 
     def get_limits(self):
-        return self.parse_reply(self.sendget("C36 0\n"))
+        return self._snapshot('limits', ["C36 0\n"])[0]
 
     def decode_status_bits(self, status_reg):
         bits = StatusBits()
@@ -77,75 +159,241 @@ class Stage(object):
         bits.hiz = bool(status_reg & 0x0001)
         return bits
 
+    def _moved(self, axis, position):
+        self._snapshots = {}
+        self._targets[axis] = position
+        self.positions[axis] = None
+        self._active.add(axis)
+
+    def _stopped(self, axes):
+        self._snapshots = {}
+        for axis in axes:
+            if self._targets[axis] is not None:
+                self.positions[axis] = self._targets[axis]
+            self._active.discard(axis)
+
     def _wait_while_active(self, axis, timeout=10):
         self.sendget(("C24 %d\n" % axis), timeout=timeout)
+        self._stopped([axis])
+
+    def wait_while_active(self, timeout=30, axes=None, poll_interval=0.01):
+        """
+        Wait until every one of axes (all by default) is idle. The shield states of all of them are read in one
+        pass per poll, rather than waiting on each in turn with C24, which holds up the firmware until that axis
+        stops; once a single axis is left, C24 waits for it without polling.
+        """
+        self._wait_idle(self._axes(axes), [], timeout, poll_interval)
 
-    def wait_while_active(self, timeout=30):
-        self._wait_while_active(0, timeout=timeout)
-        self._wait_while_active(1, timeout=timeout)
+    def _wait_idle(self, axes, commands, timeout, poll_interval):
+        # Send commands followed by the first poll of axes in one transaction, then poll until all of axes are idle
+        deadline = time.time() + timeout
+        waiting = list(axes)
+        while len(waiting) > 1:
+            polls = ["C4 %d\n" % axis for axis in waiting]
+            replies = self.transaction(commands + polls, timeout=timeout)[len(commands):]
+            commands = []
+            states = [self.parse_reply(reply) for reply in replies]
+            idle = [axis for axis, state in zip(waiting, states) if state == SHIELD_INACTIVE]
+            self._stopped(idle)
+            waiting = [axis for axis in waiting if axis not in idle]
+            if len(waiting) > 1:
+                if time.time() > deadline:
+                    raise IOError("Axes %s still moving after %s s" % (waiting, timeout))
+                time.sleep(poll_interval)
+        if waiting or commands:
+            self.transaction(commands + ["C24 %d\n" % axis for axis in waiting],
+                             timeout=max(deadline - time.time(), 0.1))
+            self._stopped(waiting)
 
     def _go_to_position(self, axis, position):
         self.sendget("C12 %d %d\n" % (axis, position))
+        self._moved(axis, position)
 
-    def go_to_position(self, x, y, block=True):
-        if x > 7000:
-            raise ValueError("Cannot safely go to x locations higher than 7000")
-        if y > 4500:
-            raise ValueError("Cannot safely go to y locations higher than 4500")
-        self._go_to_position(0, x)
-        self._go_to_position(1, y)
+    def go_to_position(self, *positions, **kwargs):
+        """
+        go_to_position(x, y[, z], block=True) moves the first len(positions) axes at once, and with block waits
+        until all of them have stopped.
+        """
+        block = kwargs.pop('block', True)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments %s" % kwargs.keys())
+        if len(positions) > len(self.axes):
+            raise ValueError("%d positions for a stage with %d axes" % (len(positions), len(self.axes)))
+        self._go_to(dict(enumerate(positions)), block=block)
+
+    def _go_to(self, targets, block=True, timeout=30):
+        # targets maps axes to the positions they should go to
+        axes = sorted(targets)
+        for axis in axes:
+            limit = self.max_positions[axis]
+            if limit is not None and targets[axis] > limit:
+                raise ValueError("Cannot safely go to %s locations higher than %d" % (self.axis_name(axis), limit))
+        commands = ["C12 %d %d\n" % (axis, targets[axis]) for axis in axes]
+        # An idle axis already at its target stops as soon as it is told to go there, no need to wait for it
+        moving = [axis for axis in axes
+                  if not self.cache or axis in self._active or self.positions[axis] != targets[axis]]
+        for axis in axes:
+            self._moved(axis, targets[axis])
         if block:
-            self.wait_while_active()
+            self._stopped([axis for axis in axes if axis not in moving])
+            self._wait_idle(moving, commands, timeout, poll_interval=0.01)
+        else:
+            self.transaction(commands)
 
     def hwp_go_to_position(self, position, stop=True):
         self._go_to_position(0, position)
         if stop:
-            self.wait_while_active()
+            self.wait_while_active(axes=[0])
             self.hard_stop()
 
+    def _register_readback_commands(self, axis):
+        return ["C1 %d\n" % axis, "C3 %d\n" % axis, "C7 %d\n" % axis, "C8 %d\n" % axis]
+
+    def _store_readback(self, axis, replies):
+        values = [self.parse_reply(reply) for reply in replies]
+        for name, value in zip(['acceleration', 'deceleration', 'max_speed', 'min_speed'], values):
+            self.registers[(axis, name)] = value
+
+    def _per_axis(self, value):
+        if isinstance(value, (list, tuple)):
+            if len(value) != len(self.axes):
+                raise ValueError("Need one value for each of the %d axes, got %r" % (len(self.axes), value))
+            return list(value)
+        return [value] * len(self.axes)
+
     def initialize(self, acceleration=200, min_speed=200, max_speed=400, stepping=4):
-        for axis in [0, 1]:
-            self.set_acceleration(acceleration, axis=axis)
-            self.set_speed(min_speed, max_speed, axis=axis)
-            self.set_speed(min_speed, max_speed, axis=axis)
-            self.set_stepping(stepping)
+        """
+        Each parameter is either one value for all axes or a list with one value per axis.
+        """
+        acceleration, min_speed, max_speed = [self._per_axis(value) for value in [acceleration, min_speed, max_speed]]
+        commands = []
+        for axis in self.axes:
+            commands += self._acceleration_commands(acceleration[axis], axis)
+            commands += self._speed_commands(min_speed[axis], max_speed[axis], axis)
+        commands += self._stepping_commands(stepping)
+        if self.cache:
+            for axis in self.axes:
+                commands += self._register_readback_commands(axis)
+        replies = self.transaction(commands)
+        self._stepping_changed(stepping)
+        if self.cache:
+            readback = replies[-4 * len(self.axes):]
+            for axis in self.axes:
+                self._store_readback(axis, readback[4 * axis:4 * axis + 4])
 
     def initialize_hwp(self, acceleration=2000, min_speed=800, max_speed=8000, stepping=16):
         axis = 0
-        self.set_acceleration(acceleration, axis=axis)
-        self.set_speed(min_speed, max_speed, axis=axis)
-        self.set_speed(min_speed, max_speed, axis=axis)
-        self.set_stepping(stepping)
+        self.transaction(self._acceleration_commands(acceleration, axis) +
+                         self._speed_commands(min_speed, max_speed, axis) +
+                         self._stepping_commands(stepping))
+        self._stepping_changed(stepping)
+        for name in ['acceleration', 'deceleration', 'max_speed', 'min_speed']:
+            self.registers.pop((axis, name), None)
 
-    def find_home(self):
-        self.reset_home()
+    def find_home(self, method='stepped', **kwargs):
+        """
+        method='stepped' walks toward the limit switches in blocking steps of 400, 40 and 4.
+        method='continuous' drives toward them in one move, see _find_home_continuous for its options, and also
+        measures the repeatability of home in steps, which is kept in home_repeatability (None after stepped homing).
+        """
+        if method == 'stepped':
+            self._find_home_stepped()
+        elif method == 'continuous':
+            self._find_home_continuous(**kwargs)
+        else:
+            raise ValueError("Unknown homing method %r, must be 'stepped' or 'continuous'" % method)
+
+    def _find_home_stepped(self):
+        axes = self.homing_axes
+        self.home_repeatability = None
+        self.reset_home(axes)
         self._find_home(stepsize=400)
-        self.go_to_position(200, 200)
-        self.reset_home()
+        self._go_to(dict((axis, 200) for axis in axes))
+        self.reset_home(axes)
         self._find_home(stepsize=40)
-        self.go_to_position(100, 100)
-        self.reset_home()
+        self._go_to(dict((axis, 100) for axis in axes))
+        self.reset_home(axes)
         self._find_home(stepsize=4)
 
     def _find_home(self, stepsize=40):
-        xdone = not (self.get_limits() & 0x02)
-        ydone = not (self.get_limits() & 0x08)
-        x = 0
-        y = 0
-        self.go_to_position(x, y)
-        while not (xdone and ydone):
-            if not xdone:
-                x -= stepsize
-            if not ydone:
-                y -= stepsize
-            self.go_to_position(x, y)
-            xdone = not (self.get_limits() & 0x02)
-            ydone = not (self.get_limits() & 0x08)
-        self.reset_home()
+        targets = dict((axis, 0) for axis in self.homing_axes)
+        self._go_to(targets)
+        moving = [axis for axis in self.homing_axes if self.get_limits() & self.limit_bits[axis]]
+        while moving:
+            for axis in moving:
+                targets[axis] -= stepsize
+            self._go_to(targets)
+            limits = self.get_limits()
+            moving = [axis for axis in moving if limits & self.limit_bits[axis]]
+        self.reset_home(self.homing_axes)
 
-    def reset_home(self):
-        self.sendget("C19 0\n")
-        self.sendget("C19 1\n")
+    def _find_home_continuous(self, travel=8000, backoff=100, fine_speed=50, passes=2, poll_interval=0.02,
+                              timeout=120):
+        """
+        Drive both axes toward their limit switches in one move, hard stopping each one as soon as its switch closes,
+        then back off by backoff steps and approach again at fine_speed, passes times. Home is set where the last
+        approach stopped. The spread of the fine approach stop positions of each axis in steps is kept in
+        home_repeatability.
+        """
+        axes = self.homing_axes
+        replies = self.transaction(sum([["C8 %d\n" % axis, "C7 %d\n" % axis] for axis in axes], []))
+        speeds = [self.parse_reply(reply) for reply in replies]
+        self.reset_home(axes)
+        positions = self._approach_limits(dict((axis, -travel) for axis in axes), poll_interval, timeout)
+        for axis in axes:
+            self.set_speed(fine_speed, fine_speed, axis=axis)
+        edges = []
+        try:
+            for k in range(passes):
+                self._go_to(dict((axis, positions[axis] + backoff) for axis in axes))
+                positions = self._approach_limits(dict((axis, positions[axis] - backoff) for axis in axes),
+                                                  poll_interval, timeout)
+                edges.append(positions)
+        finally:
+            for k, axis in enumerate(axes):
+                self.set_speed(speeds[2 * k], speeds[2 * k + 1], axis=axis)
+        self.reset_home(axes)
+        self.home_repeatability = tuple([max(edge[axis] for edge in edges) - min(edge[axis] for edge in edges)
+                                         for axis in axes])
+
+    def _approach_limits(self, targets, poll_interval, timeout):
+        # Start every axis whose switch is still open toward its target and hard stop each one when its switch closes.
+        # Polls the limits no more often than every poll_interval and checks every tenth poll that the moves have not
+        # ended without reaching a switch. targets maps axes to positions; returns the signed positions where those
+        # axes stopped, in the same form.
+        self._snapshots = {}
+        limits = self.get_limits()
+        moving = [axis for axis in sorted(targets) if limits & self.limit_bits[axis]]
+        if moving:
+            self.transaction(["C12 %d %d\n" % (axis, targets[axis]) for axis in moving])
+            for axis in moving:
+                self._moved(axis, targets[axis])
+        deadline = time.time() + timeout
+        polls = 0
+        while moving:
+            tic = time.time()
+            limits = self.parse_reply(self.transaction(["C36 0\n"])[0])
+            done = [axis for axis in moving if not limits & self.limit_bits[axis]]
+            if done:
+                self.transaction(["C13 %d\n" % axis for axis in done])
+                moving = [axis for axis in moving if axis not in done]
+            elif polls % 10 == 9 or time.time() > deadline:
+                states = [self.parse_reply(reply) for reply in self.transaction(["C4 %d\n" % axis for axis in moving])]
+                if SHIELD_INACTIVE in states or time.time() > deadline:
+                    self.hard_stop(moving)
+                    raise IOError("Did not reach the limit switch of axis %d" % moving[0])
+            polls += 1
+            time.sleep(max(0, poll_interval - (time.time() - tic)))
+        self._stopped(targets.keys())
+        self.invalidate()
+        return dict((axis, self._get_position(axis)) for axis in sorted(targets))
+
+    def reset_home(self, axes=None):
+        axes = self._axes(axes)
+        self.transaction(["C19 %d\n" % axis for axis in axes])
+        self._snapshots = {}
+        for axis in axes:
+            self._targets[axis] = self.positions[axis] = None if axis in self._active else 0
 
     def reset(self):
         self.go_to_position(-3000, -3000)
@@ -153,29 +401,90 @@ class Stage(object):
 
     def reset_stages(self):
         self.sendget("C15 0\n")
+        self.invalidate(registers=True)
+        self._active.clear()
+
+    def _stepping_commands(self, microsteps):
+        microsteps = self._per_axis(microsteps)
+        for each in microsteps:
+            if each not in [1, 2, 4, 8, 16]:
+                raise ValueError("Invalid number of microsteps, must be 1,2,4,8,16")
+        return ["C34 %d %d\n" % (axis, microsteps[axis]) for axis in self.axes]
+
+    def _stepping_changed(self, microsteps):
+        # Selecting the step mode hard stops every axis and resets its home
+        self.invalidate()
+        self._active.clear()
+        self.positions = [0] * len(self.axes)
+        self._targets = [0] * len(self.axes)
+        for axis, each in zip(self.axes, self._per_axis(microsteps)):
+            self.registers[(axis, 'stepping')] = each
 
     def set_stepping(self, microsteps):
-        if microsteps not in [1, 2, 4, 8, 16]:
-            raise ValueError("Invalid number of microsteps, must be 1,2,4,8,16")
-        self.sendget("C34 0 %d\n" % microsteps)
-        self.sendget("C34 1 %d\n" % microsteps)
+        self.transaction(self._stepping_commands(microsteps))
+        self._stepping_changed(microsteps)
+
+    def _speed_commands(self, min, max, axis):
+        # The firmware refuses a max speed below the current min speed and a min speed above the current max speed,
+        # so setting max, min, max again reaches the new range from any old one.
+        return ["C21 %d %d\n" % (axis, max), "C22 %d %d\n" % (axis, min), "C21 %d %d\n" % (axis, max)]
+
+    def get_speed(self, axis=0):
+        if self.cache and (axis, 'min_speed') in self.registers and (axis, 'max_speed') in self.registers:
+            return self.registers[(axis, 'min_speed')], self.registers[(axis, 'max_speed')]
+        replies = self.transaction(["C8 %d\n" % axis, "C7 %d\n" % axis])
+        self.registers[(axis, 'min_speed')], self.registers[(axis, 'max_speed')] = [self.parse_reply(reply)
+                                                                                    for reply in replies]
+        return self.registers[(axis, 'min_speed')], self.registers[(axis, 'max_speed')]
 
     def set_speed(self, min, max=None, axis=0):
         if max is None:
             max = min
-        self.sendget("C21 %d %d\n" % (axis, max))
-        self.sendget("C22 %d %d\n" % (axis, min))
-        actual_max = self.parse_reply(self.sendget("C7 %d\n" % axis))
-        actual_min = self.parse_reply(self.sendget("C8 %d\n" % axis))
+        # Only trust the cache when the firmware will certainly accept the new values: the axis is known to be idle
+        # and the speeds are within what the L6474 library allows
+        if (self.cache and not self._moving and L6474_MIN_PWM_FREQ <= min <= max <= L6474_MAX_PWM_FREQ
+                and max > L6474_MIN_PWM_FREQ and min < L6474_MAX_PWM_FREQ):
+            current = self.registers.get((axis, 'min_speed')), self.registers.get((axis, 'max_speed'))
+            if current != (min, max):
+                self.transaction(self._speed_commands(min, max, axis))
+                self.registers[(axis, 'min_speed')] = min
+                self.registers[(axis, 'max_speed')] = max
+            return min, max
+        replies = self.transaction(self._speed_commands(min, max, axis) + ["C7 %d\n" % axis, "C8 %d\n" % axis])
+        actual_max = self.parse_reply(replies[-2])
+        actual_min = self.parse_reply(replies[-1])
+        self.registers[(axis, 'min_speed')] = actual_min
+        self.registers[(axis, 'max_speed')] = actual_max
         return actual_min, actual_max
 
+    def _acceleration_commands(self, accel, axis):
+        return ["C17 %d %d\n" % (axis, accel), "C18 %d %d\n" % (axis, accel)]
+
+    def get_acceleration(self, axis=0):
+        if self.cache and (axis, 'acceleration') in self.registers and (axis, 'deceleration') in self.registers:
+            return self.registers[(axis, 'acceleration')], self.registers[(axis, 'deceleration')]
+        replies = self.transaction(["C1 %d\n" % axis, "C3 %d\n" % axis])
+        self.registers[(axis, 'acceleration')], self.registers[(axis, 'deceleration')] = [self.parse_reply(reply)
+                                                                                          for reply in replies]
+        return self.registers[(axis, 'acceleration')], self.registers[(axis, 'deceleration')]
+
     def set_acceleration(self, accel, axis=0):
-        self.sendget("C17 %d %d\n" % (axis, accel))
-        self.sendget("C18 %d %d\n" % (axis, accel))
-        actual_accel = self.parse_reply(self.sendget("C1 %d\n" % axis))
-        actual_decel = self.parse_reply(self.sendget("C3 %d\n" % axis))
+        if self.cache and not self._moving and 0 < accel <= 0xFFFF:
+            current = self.registers.get((axis, 'acceleration')), self.registers.get((axis, 'deceleration'))
+            if current != (accel, accel):
+                self.transaction(self._acceleration_commands(accel, axis))
+                self.registers[(axis, 'acceleration')] = accel
+                self.registers[(axis, 'deceleration')] = accel
+            return accel, accel
+        replies = self.transaction(self._acceleration_commands(accel, axis) + ["C1 %d\n" % axis, "C3 %d\n" % axis])
+        actual_accel = self.parse_reply(replies[-2])
+        actual_decel = self.parse_reply(replies[-1])
+        self.registers[(axis, 'acceleration')] = actual_accel
+        self.registers[(axis, 'deceleration')] = actual_decel
         return actual_decel, actual_accel
 
-    def hard_stop(self):
-        self.sendget("C13 0\n")
-        self.sendget("C13 1\n")
+    def hard_stop(self, axes=None):
+        axes = self._axes(axes)
+        self.transaction(["C13 %d\n" % axis for axis in axes])
+        self._stopped(axes)
+        self.invalidate()
@@ -1,40 +1,31 @@
-import time
-
-import serial
+import transport
 
 
 class SimpleStepper(object):
+    """
+    HWP stepper running arduino/stepper_oneStepAtATime_incremental. Firmware version 2 and later move several steps,
+    or search for an edge of the index switch, in one command; with older firmware the same methods fall back to a
+    command per step.
+    """
 
     name = 'hwp_motor'
+    # One step at the firmware's 10 rpm, used to size the timeout of multi-step commands
+    step_time = 0.06
 
     def __init__(self, port='/dev/ttyACM1'):
-        self.s = serial.Serial()
-        self.s.setPort(port)
-        # The following avoids resetting the arduino
-        try:
-            self.s.setDTR(False)
-        except Exception:
-            pass
-        self.s.timeout = 0
-        self.s.open()
+        # Commands are a letter, followed by the count for m and e
+        self.transport = transport.SerialTransport(port, terminator='\n', name=self.name, command_length=1)
+        self.s = self.transport.s
         self.switch_state = None
         self.steps = None
+        self.firmware_version = None
 
     @property
     def state(self):
         return dict(steps=self.steps, index_switch=self.switch_state)
 
     def sendget(self, cmdstr, timeout=2):
-        self.s.readlines()
-        self.s.write(cmdstr)
-        tic = time.time()
-        resp = ''
-        while time.time() - tic < timeout:
-            resp += self.s.read()
-            if '\n' in resp:
-                break
-            time.sleep(0.001)
-        return resp
+        return self.transport.sendget(cmdstr, timeout=timeout)
 
     def parse_response(self, response):
         try:
@@ -49,8 +40,16 @@ class SimpleStepper(object):
         steps, state = self.parse_response(self.sendget('r'))
         self.switch_state = state
         self.steps = steps
+        self.firmware_version = self.get_firmware_version()
         print "switch state:", self.switch_state
 
+    def get_firmware_version(self):
+        # Firmware before version 2 does not know 'v' and answers it like any other character, with the step count
+        response = self.sendget('v')
+        if response.startswith('version:'):
+            return int(response.split(':')[1])
+        return 1
+
     def increment(self):
         self.steps, self.switch_state = self.parse_response(self.sendget('a'))
         return self.steps, self.switch_state
@@ -59,15 +58,45 @@ class SimpleStepper(object):
         self.steps, self.switch_state = self.parse_response(self.sendget('b'))
         return self.steps, self.switch_state
 
-    def find_home(self):
+    def _multi_step(self, command, count):
+        response = self.sendget('%s%d\n' % (command, count), timeout=2 + 2 * abs(count) * self.step_time)
+        self.steps, self.switch_state = self.parse_response(response)
+        return self.steps, self.switch_state
+
+    def find_edge(self, direction=1, max_steps=1000):
+        """
+        Step forward (direction 1) or back (-1) until the index switch changes state, at most max_steps steps.
+        """
+        if self.firmware_version >= 2:
+            return self._multi_step('e', direction * max_steps)
+        if direction > 0:
+            action = self.increment
+        else:
+            action = self.decrement
+        start_state = self.switch_state
+        for k in range(max_steps):
+            action()
+            if self.switch_state != start_state:
+                break
+        return self.steps, self.switch_state
+
+    def find_home(self, max_steps=1000):
         self.initialize()
-        while self.switch_state:
-            self.increment()
-        while not self.switch_state:
-            self.decrement()
-        self.steps = 0
+        if self.switch_state:
+            self.find_edge(1, max_steps)
+        if self.switch_state:
+            raise Exception("Index switch not found within %d steps" % max_steps)
+        self.find_edge(-1, max_steps)
+        # Count steps from home from now on
+        self.steps, self.switch_state = self.parse_response(self.sendget('r'))
 
     def move(self, steps_to_move, verbose=False):
+        if self.firmware_version >= 2:
+            if steps_to_move:
+                result = self._multi_step('m', steps_to_move)
+                if verbose:
+                    print result
+            return self.steps, self.switch_state
         if steps_to_move > 0:
             action = self.increment
         else:
@@ -0,0 +1,179 @@
+"""
+Where the time of a scan goes: round trip latency of every serial command, by device and command, the duration of
+every phase of the scan (moves, HWP steps, retuning, settling, lockin readings, file writes), and the bytes sent and
+received on each serial link.
+
+Durations are counted in fixed logarithmic bins, so recording one is a few additions whatever the length of the
+scan. SerialTransport records its commands once its telemetry is set, motion.ScanTimer the phases it is given and
+mapwriter.BufferedMapWriter its flushes. At the end of a map the summary is written to the map group's attributes,
+and with a metrics_file the running totals are appended to it as JSON lines every stream_interval seconds.
+
+Example:
+    t = telemetry.Telemetry(metrics_file='/data/readout/beams/metrics.jsonl')
+    stage.transport.telemetry = t
+    t.start('map_20160101_120000')
+    ...
+    t.finish(mapfile.group)
+    print t.report()
+"""
+import json
+import math
+import time
+
+# Durations are binned from 1 us to 1000 s, five bins a decade
+LOW, HIGH, BINS_PER_DECADE = -6, 3, 5
+
+
+class Histogram(object):
+    """
+    Counts of durations in bins of 10 ** (1. / bins_per_decade) from 10 ** low to 10 ** high seconds; shorter and
+    longer durations are counted in the first and last bin.
+    """
+    def __init__(self, low=LOW, high=HIGH, bins_per_decade=BINS_PER_DECADE):
+        self.low = low
+        self.bins_per_decade = bins_per_decade
+        self.counts = [0] * ((high - low) * bins_per_decade)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds > 0:
+            index = min(max(int((math.log10(seconds) - self.low) * self.bins_per_decade), 0), len(self.counts) - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def edge(self, index):
+        return 10 ** (self.low + float(index) / self.bins_per_decade)
+
+    def quantile(self, q):
+        # Upper edge of the bin the q quantile falls in, but no more than the longest duration
+        if not self.count:
+            return float('nan')
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= q * self.count:
+                return min(self.edge(index + 1), self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return dict(count=0, total=0.0)
+        used = [index for index, count in enumerate(self.counts) if count]
+        return dict(count=self.count, total=self.total, mean=self.total / self.count, min=self.min, max=self.max,
+                    p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99), first_bin=used[0],
+                    counts=self.counts[used[0]:used[-1] + 1])
+
+
+class Telemetry(object):
+    def __init__(self, metrics_file=None, stream_interval=10.0):
+        self.metrics_file = metrics_file
+        self.stream_interval = stream_interval
+        self.start()
+
+    def start(self, name=None):
+        """
+        Forget everything recorded so far, e.g. at the start of a map called name.
+        """
+        self.name = name
+        self.start_time = time.time()
+        self.commands = {}
+        self.phases = {}
+        self.bytes_out = {}
+        self.bytes_in = {}
+        self.points = 0
+        self._last_stream = self.start_time
+
+    def command(self, device, command, seconds, sent, received):
+        key = (device, command)
+        histogram = self.commands.get(key)
+        if histogram is None:
+            histogram = self.commands[key] = Histogram()
+        histogram.add(seconds)
+        self.bytes_out[device] = self.bytes_out.get(device, 0) + sent
+        self.bytes_in[device] = self.bytes_in.get(device, 0) + received
+
+    def phase(self, phase, seconds):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram()
+        histogram.add(seconds)
+
+    def point_done(self):
+        self.points += 1
+        if self.metrics_file is not None and time.time() - self._last_stream >= self.stream_interval:
+            self.stream(self.totals())
+
+    def totals(self):
+        """
+        Time so far in total and in each phase, number of commands and bytes sent and received per device.
+        """
+        devices = sorted(set(self.bytes_out) | set(self.bytes_in))
+        return dict(name=self.name, time=time.time(), elapsed=time.time() - self.start_time, points=self.points,
+                    phases=dict((phase, histogram.total) for phase, histogram in self.phases.items()),
+                    commands=dict((device, sum([histogram.count for (d, c), histogram in self.commands.items()
+                                                if d == device])) for device in devices),
+                    bytes_out=dict(self.bytes_out), bytes_in=dict(self.bytes_in))
+
+    def summary(self):
+        """
+        totals() along with the statistics and histogram of each phase and of each command, keyed by
+        "device command". Bin k of a histogram that starts at first_bin spans Histogram.edge(k) to edge(k + 1).
+        """
+        summary = self.totals()
+        summary['bins'] = dict(low=LOW, bins_per_decade=BINS_PER_DECADE)
+        summary['phases'] = dict((phase, histogram.summary()) for phase, histogram in self.phases.items())
+        summary['commands'] = dict(('%s %s' % key, histogram.summary()) for key, histogram in self.commands.items())
+        return summary
+
+    def stream(self, record):
+        with open(self.metrics_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self._last_stream = time.time()
+
+    def write_attributes(self, group):
+        # The totals as numbers, for a quick look with ncdump, and everything as JSON in the telemetry attribute
+        summary = self.summary()
+        group.elapsed_time = summary['elapsed']
+        for phase, statistics in summary['phases'].items():
+            setattr(group, 'phase_time_%s' % phase, statistics['total'])
+        group.serial_commands = sum([statistics['count'] for statistics in summary['commands'].values()])
+        group.serial_bytes_out = sum(self.bytes_out.values())
+        group.serial_bytes_in = sum(self.bytes_in.values())
+        group.telemetry = json.dumps(summary)
+        return summary
+
+    def finish(self, group=None):
+        """
+        Write the summary to the attributes of group, if given, and to the metrics file, if any.
+        """
+        if group is not None:
+            summary = self.write_attributes(group)
+        else:
+            summary = self.summary()
+        if self.metrics_file is not None:
+            self.stream(summary)
+        return summary
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        phases = sorted(self.phases.items(), key=lambda item: -item[1].total)
+        lines = ["%.1f s: %s" % (elapsed, ', '.join(["%s %.1f s" % (phase, histogram.total)
+                                                    for phase, histogram in phases]))]
+        for (device, command), histogram in sorted(self.commands.items()):
+            lines.append("%s %s: %d commands, %.1f ms median, %.1f ms 99th percentile, %.1f ms max"
+                         % (device, command, histogram.count, 1e3 * histogram.quantile(0.5),
+                            1e3 * histogram.quantile(0.99), 1e3 * histogram.max))
+        for device in sorted(self.bytes_out):
+            lines.append("%s: %d bytes out, %d bytes in" % (device, self.bytes_out[device],
+                                                            self.bytes_in.get(device, 0)))
+        return '\n'.join(lines)
@@ -0,0 +1,130 @@
+import collections
+import threading
+import time
+
+import serial
+
+
+def open_port(port, baudrate=9600):
+    # Open serial port in following way to make sure DTR isn't asserted, which would reset the arduino
+    s = serial.Serial()
+    s.setPort(port)
+    s.baudrate = baudrate
+    try:
+        s.setDTR(False)
+    except Exception:
+        pass
+    s.open()
+    return s
+
+
+class SerialTransport(object):
+    """
+    Terminator-aware request/reply channel on top of a serial port.
+
+    Reads block in the kernel until bytes arrive instead of polling, and pull everything that is waiting in one
+    call. Bytes received after a terminator are kept for the next reply rather than discarded, so the input is only
+    flushed when a previous exchange timed out and the stream may be out of step.
+
+    port can be a device name or an already open serial-like object. sendget and transaction hold the port's lock
+    for the whole exchange, so several threads can share one transport.
+
+    Once telemetry is set to a telemetry.Telemetry, the round trip time and bytes of every command are recorded
+    under name and the command's name: the first command_length characters of the command, or by default all of
+    it up to the first space.
+    """
+    def __init__(self, port, terminator='>', baudrate=9600, poll_interval=0.05, name='serial', command_length=None):
+        if isinstance(port, basestring):
+            self.s = open_port(port, baudrate=baudrate)
+        else:
+            self.s = port
+        # read() returns as soon as any byte arrives; the timeout only bounds how long we sleep when the line is idle
+        self.s.timeout = poll_interval
+        self.terminator = terminator
+        self._buffer = ''
+        self._stale = True
+        self.lock = threading.RLock()
+        self.name = name
+        self.command_length = command_length
+        self.telemetry = None
+
+    def flush_input(self):
+        self.s.flushInput()
+        self._buffer = ''
+        self._stale = False
+
+    def write(self, data):
+        if self._stale:
+            self.flush_input()
+        self.s.write(data)
+
+    def read_until(self, terminator=None, timeout=2):
+        if terminator is None:
+            terminator = self.terminator
+        deadline = time.time() + timeout
+        while terminator not in self._buffer:
+            if time.time() >= deadline:
+                self._stale = True
+                resp, self._buffer = self._buffer, ''
+                return resp
+            self._buffer += self.s.read(max(1, self.s.inWaiting()))
+        index = self._buffer.index(terminator) + len(terminator)
+        resp, self._buffer = self._buffer[:index], self._buffer[index:]
+        return resp
+
+    def command_name(self, cmdstr):
+        if self.command_length is not None:
+            return cmdstr[:self.command_length]
+        return cmdstr.split(' ', 1)[0].strip()
+
+    def _record(self, cmdstr, sent, reply):
+        self.telemetry.command(self.name, self.command_name(cmdstr), time.time() - sent, len(cmdstr), len(reply))
+
+    def sendget(self, cmdstr, timeout=2, terminator=None):
+        with self.lock:
+            sent = time.time()
+            self.write(cmdstr)
+            reply = self.read_until(terminator=terminator, timeout=timeout)
+            if self.telemetry is not None:
+                self._record(cmdstr, sent, reply)
+            return reply
+
+    def transaction(self, commands, timeout=2, window=64, terminator=None):
+        """
+        Send several commands and return their replies in order.
+
+        Commands are written back to back without waiting for each reply, but no more than window bytes are ever
+        unanswered so a slow command (e.g. a wait) cannot overflow the device's receive buffer. Raises IOError if
+        a reply does not arrive within timeout.
+        """
+        with self.lock:
+            return self._transaction(commands, timeout, window, terminator)
+
+    def _transaction(self, commands, timeout, window, terminator):
+        replies = []
+        pending = collections.deque()
+        outstanding = 0
+        index = 0
+        while index < len(commands) or pending:
+            chunk = ''
+            sent = time.time()
+            while index < len(commands) and (not pending or outstanding + len(commands[index]) <= window):
+                chunk += commands[index]
+                pending.append((commands[index], sent))
+                outstanding += len(commands[index])
+                index += 1
+            if chunk:
+                self.write(chunk)
+            command, sent = pending.popleft()
+            outstanding -= len(command)
+            reply = self.read_until(terminator=terminator, timeout=timeout)
+            if self._stale:
+                raise IOError("Timed out waiting for reply to %r, got %r" % (command, reply))
+            if self.telemetry is not None:
+                # Time from writing the command, so commands queued behind others count their wait
+                self._record(command, sent, reply)
+            replies.append(reply)
+        return replies
+
+    def close(self):
+        self.s.close()